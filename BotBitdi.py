@@ -1,109 +1,47 @@
 import logging
-import json
 import sqlite3
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ConversationHandler
-import os
-from dotenv import load_dotenv
-import asyncio
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, PollAnswerHandler, ContextTypes, filters, ConversationHandler
+from database import db, write_queue
+from results import RANK_SQL, RANK_WINDOW_SQL, save_result, save_answers, mark_asked, note_response_time
+from leaderboard import top_by_percentage
+from migrations import ensure_schema
+from config import config, is_admin
+from assignments import assign_test_to_all
+import outbox
+from outbox import outbox_sender, outbox_stats
+from progress import Progress
+from callback_tokens import callback_tokens, show_expired
+from students import student_cache
+from answer_key import ANSWER_KEY_HINT, parse_answer_key
+from quiz_polls import quiz_questions, quiz_sender
+from update_processor import build_update_processor
+from persistence import build_persistence, requires_session
+from webhook import apply_api_url, run
+from callback_router import CallbackRouter
+import question_bank
+from question_bank import bank_cache
+from question_views import render_question
+import question_views
 
 # Configure logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
-# Get bot token and admin ID from environment variables
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-ADMIN_ID = int(os.getenv('ADMIN_TELEGRAM_ID'))
-
-# Update ADMIN_IDs list
-ADMIN_IDS = [ADMIN_ID]
-
 # Define conversation states
 SELECTING_ACTION, CREATING_TEST_FILE, CREATING_TEST, ANSWERING_QUESTION, ENTERING_NAME, ENTERING_SURNAME = range(6)
 
-# Ensure tests directory exists
-def ensure_tests_directory_exists():
-    if not os.path.exists("tests"):
-        os.makedirs("tests")
-
-# Connect to SQLite database
-def get_db_connection():
-    conn = sqlite3.connect('test_bot.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
-# Initialize database
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS students (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        first_name TEXT,
-        last_name TEXT,
-        telegram_id INTEGER UNIQUE,
-        registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS students_results (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id INTEGER,
-        test_id TEXT,
-        correct_answers INTEGER,
-        wrong_answers INTEGER,
-        total_questions INTEGER,
-        rank INTEGER,
-        FOREIGN KEY(student_id) REFERENCES students(id)
-    )
-    ''')
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS available_tests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id INTEGER,
-        test_file TEXT,
-        completed INTEGER DEFAULT 0,
-        FOREIGN KEY(student_id) REFERENCES students(id)
-    )
-    ''')
-    conn.commit()
-    conn.close()
-
-# Initialize database
-init_db()
-
-# Function to check if user is admin
-def is_admin(user_id):
-    return user_id in ADMIN_IDS
-
-# Load tests from JSON file
-def load_tests(file_name):
-    file_path = f"tests/{file_name}"
-    if not os.path.exists(file_path):
-        logger.error(f"Test file not found: {file_path}")
-        return None, "Test fayli topilmadi."
+# Load the shared, read-only TestBank of a file from the question bank
+async def load_tests(file_name):
     try:
-        with open(file_path, 'r') as f:
-            content = f.read().strip()
-            if not content:
-                logger.warning(f"Empty test file: {file_path}")
-                return None, "Test fayli bo'sh."
-            return json.loads(content), None
-    except json.JSONDecodeError as e:
-        logger.error(f"Error decoding JSON from file {file_path}: {e}")
-        return None, "Test faylini o'qishda xatolik yuz berdi."
+        bank = await bank_cache.get(file_name)
     except Exception as e:
-        logger.error(f"Unexpected error loading tests from {file_path}: {e}")
+        logger.error(f"Unexpected error loading tests from {file_name}: {e}")
         return None, "Kutilmagan xatolik yuz berdi."
-
-# Save tests to JSON file
-def save_tests(tests, file_name):
-    file_path = f"tests/{file_name}"
-    with open(file_path, 'w') as f:
-        json.dump(tests, f)
+    if bank is None:
+        logger.error(f"Test file not found: {file_name}")
+        return None, "Test fayli topilmadi."
+    return bank, None
 
 async def safe_edit_message_text(update, text, reply_markup=None):
     try:
@@ -146,18 +84,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = InlineKeyboardMarkup(keyboard)
         message = f"Salom, {user.first_name}! Siz admin sifatida tizimga kirdingiz. Nima qilishni xohlaysiz?"
     else:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM students WHERE telegram_id = ?', (user.id,))
-        student = cursor.fetchone()
-        conn.close()
+        student = await student_cache.get(user.id)
 
         if student:
             keyboard = [
                 [InlineKeyboardButton("Test yechish", callback_data="solve_test")],
                 [InlineKeyboardButton("Mening natijalarim", callback_data="view_my_results")]
             ]
-            message = f"{student['first_name']} {student['last_name']}! uchun bosh menyu"
+            message = f"{student.first_name} {student.last_name}! uchun bosh menyu"
         else:
             keyboard = [[InlineKeyboardButton("Ro'yxatdan o'tish", callback_data="register")]]
             message = "Salom! Test botiga xush kelibsiz. Iltimos, ro'yxatdan o'ting."
@@ -174,7 +108,6 @@ async def create_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.answer("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    ensure_tests_directory_exists()
     await update.callback_query.edit_message_text("Yangi test file yaratish uchun file nomini kiriting:")
     context.user_data['awaiting_file_name'] = True
     return CREATING_TEST_FILE
@@ -188,28 +121,19 @@ async def process_test_file_creation(update: Update, context: ContextTypes.DEFAU
     if not file_name.endswith('.json'):
         file_name += '.json'
 
-    file_path = f"tests/{file_name}"
-    if os.path.exists(file_path):
-        await update.message.reply_text(f"'{file_name}' nomli file allaqachon mavjud. Boshqa nom tanlang.")
-        return CREATING_TEST_FILE
-
     try:
-        # Create an empty JSON file
-        with open(file_path, 'w') as f:
-            json.dump([], f)
-
-        # Animate file creation
-        message = await update.message.reply_text("File yaratilmoqda...")
-        for i in range(3):
-            await message.edit_text(f"File yaratilmoqda{'.' * (i + 1)}")
-            await asyncio.sleep(0.3)
+        async with Progress(update.message.reply_text, "File yaratilmoqda...") as progress:
+            if not await db.transaction(question_bank.create_file, file_name):
+                await progress.finish(f"'{file_name}' nomli file allaqachon mavjud. Boshqa nom tanlang.")
+                return CREATING_TEST_FILE
 
-        keyboard = [
-            [InlineKeyboardButton("Test yaratishni boshlash", callback_data=f"start_test_creation_{file_name}")],
-            [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await message.edit_text(f"'{file_name}' nomli yangi test file yaratildi.", reply_markup=reply_markup)
+            keyboard = [
+                [InlineKeyboardButton("Test yaratishni boshlash",
+                                      callback_data=f"start_test_creation_{await callback_tokens.encode(file_name)}")],
+                [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await progress.finish(f"'{file_name}' nomli yangi test file yaratildi.", reply_markup=reply_markup)
         context.user_data['awaiting_file_name'] = False
         return SELECTING_ACTION
     except Exception as e:
@@ -224,13 +148,13 @@ async def create_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    ensure_tests_directory_exists()
-    test_files = [f for f in os.listdir("tests") if f.endswith('.json')]
+    test_files = await db.run(question_bank.list_files)
     
     if not test_files:
         return await handle_test_file_error(update, context, "Hozircha test file'lari mavjud emas.")
 
-    keyboard = [[InlineKeyboardButton(file, callback_data=f"select_file_{file}")] for file in test_files]
+    tokens = await callback_tokens.encode_many([(file,) for file in test_files])
+    keyboard = [[InlineKeyboardButton(file, callback_data=f"select_file_{token}")] for file, token in zip(test_files, tokens)]
     keyboard.append([InlineKeyboardButton("Yangi test file yaratish", callback_data="create_test_file")])
     keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -242,25 +166,28 @@ async def select_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     try:
-        file_name = query.data.split('_')[-1]
-        tests, error_message = load_tests(file_name)
+        args = await callback_tokens.decode(query.data)
+        if args is None:
+            await show_expired(query)
+            return SELECTING_ACTION
+        file_name, = args
+        bank, error_message = await load_tests(file_name)
 
         if error_message:
             await query.edit_message_text(f"Xatolik: {error_message}")
             return ConversationHandler.END
 
-        if not tests:
-            tests = []
-
+        # The session holds a reference to the shared bank, a cursor and the answers
         context.user_data['current_file'] = file_name
-        context.user_data['all_tests'] = tests
+        context.user_data['bank'] = bank
         context.user_data['current_test_index'] = 0
         
         if is_admin(query.from_user.id):
             # For admin, show test creation options
+            token = await callback_tokens.encode(file_name)
             keyboard = [
-                [InlineKeyboardButton("Yangi test qo'shish", callback_data=f"add_test_{file_name}")],
-                [InlineKeyboardButton("Testlarni ko'rish", callback_data=f"view_tests_{file_name}")],
+                [InlineKeyboardButton("Yangi test qo'shish", callback_data=f"add_test_{token}")],
+                [InlineKeyboardButton("Testlarni ko'rish", callback_data=f"view_tests_{token}")],
                 [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -317,18 +244,12 @@ async def process_correct_answer(update: Update, context: ContextTypes.DEFAULT_T
     current_test = context.user_data['current_test']
     current_test['correct_answers'].append(query.data.split('_')[1])
 
-    # Animate saving process
-    message = await query.edit_message_text("To'g'ri javob saqlanmoqda...")
-    for i in range(3):
-        await message.edit_text(f"To'g'ri javob saqlanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.3)
-
     keyboard = [
         [InlineKeyboardButton("Ha", callback_data="add_question"),
          InlineKeyboardButton("Yo'q", callback_data="finish_test")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text("To'g'ri javob saqlandi. Yana savol qo'shmoqchimisiz?", reply_markup=reply_markup)
+    await query.edit_message_text("To'g'ri javob saqlandi. Yana savol qo'shmoqchimisiz?", reply_markup=reply_markup)
     return CREATING_TEST
 
 async def add_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -345,24 +266,15 @@ async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     current_test = context.user_data['current_test']
     file_name = context.user_data['current_file']
-    tests, error_message = load_tests(file_name)
-
-    if error_message:
-        await safe_edit_message_text(update, f"Xatolik: {error_message}")
-        return ConversationHandler.END
-
-    if not tests:
-        tests = []
-
-    current_test['id'] = len(tests) + 1
-    tests.append(current_test)
-    save_tests(tests, file_name)
-
-    # Animate test saving process
-    message = await query.edit_message_text("Test saqlanmoqda...")
-    for i in range(3):
-        await message.edit_text(f"Test saqlanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.3)
+    try:
+        question_bank.check_test(current_test)
+    except ValueError as e:
+        # Usually the last question is not finished yet; its step still takes input
+        await query.message.reply_text(f"Testni saqlab bo'lmadi: {e} Oxirgi savolni to'liq kiriting.")
+        return CREATING_TEST
+    async with Progress(query.edit_message_text, "Test saqlanmoqda...") as progress:
+        current_test['id'] = await db.transaction(question_bank.add_test, file_name, current_test)
+    bank_cache.invalidate(file_name)
 
     context.user_data['creating_test'] = False
     context.user_data['current_test'] = None
@@ -374,51 +286,48 @@ async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text(f"Test muvaffaqiyatli yaratildi va '{file_name}' file'ga saqlandi!", reply_markup=reply_markup)
+    await progress.finish(f"Test muvaffaqiyatli yaratildi va '{file_name}' file'ga saqlandi!", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 async def start_selected_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_tests = context.user_data.get('all_tests', [])
+    bank = context.user_data['bank']
     current_test_index = context.user_data.get('current_test_index', 0)
     
-    if current_test_index >= len(all_tests):
+    if current_test_index >= len(bank.tests):
         return await finish_all_tests(update, context)
     
-    context.user_data['current_test'] = all_tests[current_test_index]
     context.user_data['current_question'] = 0
     if 'answers' not in context.user_data:
         context.user_data['answers'] = []
+        context.user_data['response_times'] = []
     
     return await send_question(update, context)
 
 async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_tests = context.user_data.get('all_tests', [])
+    bank = context.user_data['bank']
+    all_tests = bank.tests
     current_test_index = context.user_data.get('current_test_index', 0)
-    current_test = context.user_data.get('current_test')
     question_index = context.user_data.get('current_question', 0)
     
     if current_test_index >= len(all_tests):
         return await finish_all_tests(update, context)
     
-    if question_index >= len(current_test['questions']):
+    current_test = all_tests[current_test_index]
+    if question_index >= len(current_test.questions):
         context.user_data['current_test_index'] = current_test_index + 1
         context.user_data['current_question'] = 0
         return await start_selected_test(update, context)
     
-    total_questions_before = sum(len(test['questions']) for test in all_tests[:current_test_index])
-    overall_question_number = total_questions_before + question_index + 1
-    
-    question = current_test['questions'][question_index]
-    answers = current_test['answers'][question_index]
-    
-    keyboard = [[InlineKeyboardButton(answer[2:], callback_data=f"answer_{answer[0]}")] for answer in answers]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    message = f"Savol {overall_question_number}: {question}"
+    # Pre-rendered once per bank version and shared by all students
+    position = bank.position(current_test_index, question_index)
+    message, reply_markup = render_question(bank, position)
+    if position == 0:
+        message = f"{ANSWER_KEY_HINT}\n\n{message}"
     if update.callback_query:
         await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
     else:
         await update.message.reply_text(message, reply_markup=reply_markup)
+    mark_asked(context.user_data)
     
     return ANSWERING_QUESTION
 
@@ -432,55 +341,52 @@ async def process_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if 'answers' not in context.user_data:
         context.user_data['answers'] = []
     
-    # Add the answer
+    # Add the answer and how long it took
     context.user_data['answers'].append(answer)
+    note_response_time(context.user_data)
     
     # Increment question counter
     context.user_data['current_question'] = context.user_data.get('current_question', 0) + 1
     
     return await send_question(update, context)
 
+# Every test of the file answered in one message (see answer_key.py), graded and stored at once
+async def process_answer_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        answers = parse_answer_key(update.message.text, context.user_data['bank'].questions)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{ANSWER_KEY_HINT}")
+        return ANSWERING_QUESTION
+
+    # One message for the whole file: there are no per-question response times
+    context.user_data['answers'] = answers
+    context.user_data['response_times'] = []
+    return await finish_all_tests(update, context)
+
 async def finish_all_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_tests = context.user_data['all_tests']
+    questions = context.user_data['bank'].questions
     user_answers = context.user_data.get('answers', [])
     
+    # Answers are given in bank order, so answer i belongs to questions[i]
+    total_questions = len(questions)
     total_correct = 0
-    total_questions = sum(len(test['questions']) for test in all_tests)
-    detailed_results = []
-    
-    # Track the current position in user_answers
-    answer_index = 0
+    result_lines = ["Test yakunlandi!\n\nBatafsil natijalar:\n\n"]
     
-    # Process each test's answers
-    for test in all_tests:
-        for q_idx, question in enumerate(test['questions']):
-            user_answer = user_answers[answer_index] if answer_index < len(user_answers) else None
-            correct_answer = test['correct_answers'][q_idx]
-            
-            is_correct = user_answer == correct_answer
-            if is_correct:
-                total_correct += 1
-            
-            detailed_results.append({
-                'question': question,
-                'user_answer': user_answer if user_answer is not None else "Javob berilmagan",
-                'correct_answer': correct_answer,
-                'is_correct': is_correct
-            })
-            
-            answer_index += 1
+    for i, question in enumerate(questions):
+        user_answer = user_answers[i] if i < len(user_answers) else None
+        is_correct = user_answer == question.correct_answer
+        total_correct += is_correct
+        result_lines.append(
+            f"Savol {i + 1}: {question.text}\n"
+            f"Sizning javobingiz: {user_answer if user_answer is not None else 'Javob berilmagan'}\n"
+            f"To'g'ri javob: {question.correct_answer}\n"
+            f"Natija: {'Togri' if is_correct else 'Notogri'}\n\n"
+        )
     
     total_wrong = total_questions - total_correct
     
     # Generate result text
-    result_text = f"Test yakunlandi!\n\nBatafsil natijalar:\n\n"
-    
-    for i, result in enumerate(detailed_results, 1):
-        result_text += f"Savol {i}: {result['question']}\n"
-        result_text += f"Sizning javobingiz: {result['user_answer']}\n"
-        result_text += f"To'g'ri javob: {result['correct_answer']}\n"
-        result_text += f"Natija: {'Togri' if result['is_correct'] else 'Notogri'}\n\n"
-    
+    result_text = ''.join(result_lines)
     result_text += f"Umumiy natija:\n"
     result_text += f"Jami savollar: {total_questions}\n"
     result_text += f"To'g'ri javoblar: {total_correct}\n"
@@ -488,59 +394,53 @@ async def finish_all_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     result_text += f"Foiz: {(total_correct / total_questions) * 100:.2f}%\n"
     
     # Save results to database
-    user = update.effective_user
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('SELECT id FROM students WHERE telegram_id = ?', (user.id,))
-        student = cursor.fetchone()
-        
+    student = await student_cache.get(update.effective_user.id)
+    file_name = context.user_data['current_file']
+    response_times = context.user_data.get('response_times', [])
+
+    def save_results(conn):
         if student is None:
-            await update.callback_query.message.reply_text("Xatolik: Foydalanuvchi ma'lumotlari topilmadi.")
-            return ConversationHandler.END
-        
-        student_id = student['id']
-        
-        # Save the results
-        cursor.execute('''
-        INSERT INTO students_results 
-        (student_id, test_id, correct_answers, wrong_answers, total_questions)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (student_id, context.user_data['current_file'], total_correct, total_wrong, total_questions))
-        
+            return False
+
+        cursor = conn.cursor()
+        student_id = student.id
+
+        # Save the results and the answers behind them
+        result_id = save_result(conn, student_id, file_name, total_correct, total_wrong, total_questions)
+        save_answers(conn, result_id, student_id, file_name, [question.correct_answer for question in questions],
+                     user_answers, response_times)
+
         # Mark the test as completed
         cursor.execute('''
         UPDATE available_tests
         SET completed = 1
         WHERE student_id = ? AND test_file = ?
-        ''', (student_id, context.user_data['current_file']))
-        
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Error saving test results: {e}")
-    finally:
-        conn.close()
-    
-    # Show celebration animation
-    celebration_frames = ["🎉", "🎊", "✨", "🎈", "🎇", "🎆"]
-    celebration_message = await update.callback_query.edit_message_text("Tabriklaymiz!")
-    
-    for _ in range(3):
-        for frame in celebration_frames:
-            await celebration_message.edit_text(f"{frame} Tabriklaymiz! {frame}")
-            await asyncio.sleep(0.3)
+        ''', (student_id, file_name))
+        return True
+
+    # Reached from an answer button or from a message with the whole answer key
+    message = update.effective_message
+    show = update.callback_query.edit_message_text if update.callback_query else message.reply_text
+    async with Progress(show, "Natijalar saqlanmoqda...") as progress:
+        try:
+            # Batched with other submissions into one transaction; returns once committed
+            if not await write_queue.submit(save_results):
+                await message.reply_text("Xatolik: Foydalanuvchi ma'lumotlari topilmadi.")
+                return ConversationHandler.END
+        except Exception as e:
+            logger.error(f"Error saving test results: {e}")
+        await progress.finish("🎉 Tabriklaymiz! 🎉")
     
     # Split and send result text if it's too long
     max_message_length = 4096
     result_chunks = [result_text[i:i+max_message_length] for i in range(0, len(result_text), max_message_length)]
     
     for chunk in result_chunks:
-        await update.callback_query.message.reply_text(chunk)
+        await message.reply_text(chunk)
     
     keyboard = [[InlineKeyboardButton("Bosh menyu", callback_data="main_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.message.reply_text("Test muvaffaqiyatli yakunlandi!", reply_markup=reply_markup)
+    await message.reply_text("Test muvaffaqiyatli yakunlandi!", reply_markup=reply_markup)
     
     # Clear user data
     context.user_data.clear()
@@ -554,8 +454,7 @@ async def send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.answer("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    ensure_tests_directory_exists()
-    test_files = [f for f in os.listdir("tests") if f.endswith('.json')]
+    test_files = await db.run(question_bank.list_files)
     if not test_files:
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
@@ -564,7 +463,8 @@ async def send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Hozircha test file'lari mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    keyboard = [[InlineKeyboardButton(file, callback_data=f"send_file_{file}")] for file in test_files]
+    tokens = await callback_tokens.encode_many([(file,) for file in test_files])
+    keyboard = [[InlineKeyboardButton(file, callback_data=f"send_file_{token}")] for file, token in zip(test_files, tokens)]
     keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.callback_query.edit_message_text("Qaysi file'dagi testlarni jo'natmoqchisiz?", reply_markup=reply_markup)
@@ -574,16 +474,12 @@ async def process_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    tests, error_message = load_tests(file_name)
-
-    if error_message:
-        keyboard = [
-            [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"Xatolik: {error_message}", reply_markup=reply_markup)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
         return SELECTING_ACTION
+    file_name, = args
+    tests = await db.run(question_bank.test_summaries, file_name)
 
     if not tests:
         keyboard = [
@@ -596,7 +492,7 @@ async def process_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['selected_test_file'] = file_name
 
     keyboard = [
-        [InlineKeyboardButton("Ha", callback_data=f"confirm_send_{file_name}")],
+        [InlineKeyboardButton("Ha", callback_data=f"confirm_send_{await callback_tokens.encode(file_name)}")],
         [InlineKeyboardButton("Yo'q", callback_data="cancel_send")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -607,39 +503,37 @@ async def confirm_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, telegram_id FROM students')
-    students = cursor.fetchall()
+    student_count = (await db.fetchone('SELECT COUNT(*) FROM students'))[0]
 
-    if not students:
+    if not student_count:
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("Hozircha ro'yxatdan o'tgan o'quvchilar yo'q.", reply_markup=reply_markup)
-        conn.close()
         return SELECTING_ACTION
 
-    for student in students:
-        cursor.execute('INSERT OR REPLACE INTO available_tests (student_id, test_file, completed) VALUES (?, ?, 0)', (student['id'], file_name))
-        
-        # Notify the student
-        keyboard = [[InlineKeyboardButton("Testni boshlash", callback_data="solve_test")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            await context.bot.send_message(chat_id=student['telegram_id'], text="Sizga yangi test tayinlandi!", reply_markup=reply_markup)
-        except Exception as e:
-            logger.error(f"Error sending message to student {student['id']}: {e}")
-
-    conn.commit()
-    conn.close()
-
-    keyboard = [[InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]]
+    description = f"'{file_name}' faylidagi testlar barcha o'quvchilarga tayinlandi!"
+    keyboard = [[InlineKeyboardButton("Testni boshlash", callback_data="solve_test")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(f"'{file_name}' faylidagi testlar barcha o'quvchilarga muvaffaqiyatli jo'natildi!", reply_markup=reply_markup)
+
+    def assign_and_notify(conn):
+        # The assignments and their notifications are committed together; the
+        # outbox sender delivers them and reports progress on this message
+        assign_test_to_all(conn, file_name)
+        batch_id = outbox.create_batch(conn, query.message.chat_id, query.message.message_id, description)
+        return outbox.enqueue_students(conn, "Sizga yangi test tayinlandi!", reply_markup, batch_id)
+
+    queued = await db.transaction(assign_and_notify)
+    # Shown before the sender starts, so it cannot overwrite the sender's progress
+    await query.edit_message_text(outbox.progress_text(description, 0, queued, 0))
+    outbox_sender.wake()
     return SELECTING_ACTION
 
 async def cancel_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -659,20 +553,16 @@ async def view_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.answer("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    results = await db.fetchall(f'''
     SELECT s.first_name, s.last_name,
            COALESCE(sr.total_questions, 0) AS total_questions,
            COALESCE(sr.correct_answers, 0) AS correct_answers,
            COALESCE(sr.wrong_answers, 0) AS wrong_answers,
-           COALESCE(sr.rank, 'N/A') AS rank
+           CASE WHEN sr.id IS NULL THEN 'N/A' ELSE {RANK_WINDOW_SQL} END AS rank
     FROM students s
     LEFT JOIN students_results sr ON s.id = sr.student_id
-    ORDER BY sr.rank
+    ORDER BY sr.id IS NULL, rank
     ''')
-    results = cursor.fetchall()
-    conn.close()
 
     if not results:
         keyboard = [
@@ -710,7 +600,7 @@ async def view_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    test_files = [f for f in os.listdir("tests") if f.endswith('.json')]
+    test_files = await db.run(question_bank.list_files)
     if not test_files:
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
@@ -719,7 +609,8 @@ async def view_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Hozircha test file'lari mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    keyboard = [[InlineKeyboardButton(file, callback_data=f"view_file_{file}")] for file in test_files]
+    tokens = await callback_tokens.encode_many([(file,) for file in test_files])
+    keyboard = [[InlineKeyboardButton(file, callback_data=f"view_file_{token}")] for file, token in zip(test_files, tokens)]
     keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.callback_query.edit_message_text("Qaysi file'dagi testlarni ko'rmoqchisiz?", reply_markup=reply_markup)
@@ -729,17 +620,12 @@ async def view_file_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    tests, error_message = load_tests(file_name)
-
-    if error_message:
-        keyboard = [
-            [InlineKeyboardButton("Ortga", callback_data="view_tests")],
-            [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"Xatolik: {error_message}", reply_markup=reply_markup)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
         return SELECTING_ACTION
+    file_name, = args
+    tests = await db.run(question_bank.test_summaries, file_name)
 
     if not tests:
         keyboard = [
@@ -750,12 +636,13 @@ async def view_file_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(f"'{file_name}' file'ida hozircha testlar mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    for test in tests:
+    tokens = await callback_tokens.encode_many([(file_name, test_no) for test_no, _ in tests])
+    for (test_no, question_count), token in zip(tests, tokens):
         keyboard = [
-            [InlineKeyboardButton("O'chirish", callback_data=f"delete_test_{file_name}_{test['id']}")]
+            [InlineKeyboardButton("O'chirish", callback_data=f"delete_test_{token}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(f"Test ID: {test['id']}\nSavollar soni: {len(test['questions'])}", reply_markup=reply_markup)
+        await query.message.reply_text(f"Test ID: {test_no}\nSavollar soni: {question_count}", reply_markup=reply_markup)
 
     keyboard = [
         [InlineKeyboardButton("Ortga", callback_data="view_tests")],
@@ -769,48 +656,41 @@ async def delete_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name, test_id = query.data.split('_')[-2:]
-    tests, error_message = load_tests(file_name)
-
-    if error_message:
-        await safe_edit_message_text(update, f"Xatolik: {error_message}")
-        return ConversationHandler.END
-
-    tests = [test for test in tests if str(test['id']) != test_id]
-    save_tests(tests, file_name)
-
-    # Animate deletion process
-    message = await query.edit_message_text("Test o'chirilmoqda...")
-    for i in range(3):
-        await message.edit_text(f"Test o'chirilmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.3)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, test_id = args
+    async with Progress(query.edit_message_text, "Test o'chirilmoqda...") as progress:
+        await db.transaction(question_bank.delete_test, file_name, test_id)
+        bank_cache.invalidate(file_name)
 
-    keyboard = [
-        [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text(f"Test (ID: {test_id}) o'chirildi.", reply_markup=reply_markup)
+        keyboard = [
+            [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await progress.finish(f"Test (ID: {test_id}) o'chirildi.", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 async def delete_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    file_path = f"tests/{file_name}"
-    
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        # Animate deletion process
-        message = await query.edit_message_text("Test file o'chirilmoqda...")
-        for i in range(3):
-            await message.edit_text(f"Test file o'chirilmoqda{'.' * (i + 1)}")
-            await asyncio.sleep(0.3)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+
+    async with Progress(query.edit_message_text, "Test file o'chirilmoqda...") as progress:
+        deleted = await db.transaction(question_bank.delete_file, file_name)
+    if deleted:
+        bank_cache.invalidate(file_name)
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await message.edit_text(f"'{file_name}' nomli test file o'chirildi.", reply_markup=reply_markup)
+        await progress.finish(f"'{file_name}' nomli test file o'chirildi.", reply_markup=reply_markup)
     else:
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
@@ -856,25 +736,17 @@ async def process_surname(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.clear()
         return ConversationHandler.END
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute('INSERT INTO students (first_name, last_name, telegram_id) VALUES (?, ?, ?)',
-                      (context.user_data['first_name'], surname, user.id))
-        conn.commit()
-        
-        # Animate registration process
-        message = await update.message.reply_text("Ro'yxatdan o'tkazilmoqda...")
-        for i in range(3):
-            await message.edit_text(f"Ro'yxatdan o'tkazilmoqda{'.' * (i + 1)}")
-            await asyncio.sleep(0.3)
+        async with Progress(update.message.reply_text, "Ro'yxatdan o'tkazilmoqda...") as progress:
+            await db.execute('INSERT INTO students (first_name, last_name, telegram_id) VALUES (?, ?, ?)',
+                             (context.user_data['first_name'], surname, user.id))
 
         keyboard = [
             [InlineKeyboardButton("Bosh menyu", callback_data="main_menu")],
             [InlineKeyboardButton("Mavjud testlarni ko'rish", callback_data="view_available_tests")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await message.edit_text(
+        await progress.finish(
             f"Rahmat, {context.user_data['first_name']}! Siz muvaffaqiyatli ro'yxatdan o'tdingiz.",
             reply_markup=reply_markup
         )
@@ -884,33 +756,27 @@ async def process_surname(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Registration error: {e}")
         await update.message.reply_text("Ro'yxatdan o'tishda xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.")
     finally:
-        conn.close()
+        student_cache.invalidate(user.id)
         context.user_data.clear()
     
     return ConversationHandler.END
 
 async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM students WHERE telegram_id = ?', (user.id,))
-    student = cursor.fetchone()
+    student = await student_cache.get(user.id)
 
     if not student:
         keyboard = [[InlineKeyboardButton("Ro'yxatdan o'tish", callback_data="register")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         success = await safe_edit_message_text(update, "Iltimos, avval ro'yxatdan o'ting.", reply_markup=reply_markup)
-        conn.close()
         if not success:
             return ConversationHandler.END
 
-    cursor.execute('''
-    SELECT DISTINCT test_file
+    available_tests = await db.fetchall('''
+    SELECT test_file
     FROM available_tests
     WHERE student_id = ? AND completed = 0
-    ''', (student['id'],))
-    available_tests = cursor.fetchall()
-    conn.close()
+    ''', (student.id,))
 
     if not available_tests:
         success = await safe_edit_message_text(update, "Hozircha sizga tayinlangan yangi testlar mavjud emas. Iltimos, keyinroq urinib ko'ring.")
@@ -918,20 +784,13 @@ async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return ConversationHandler.END
 
     try:
-        keyboard = [[InlineKeyboardButton(file['test_file'], callback_data=f"select_test_file_{file['test_file']}")] for file in available_tests]
+        tokens = await callback_tokens.encode_many([(file['test_file'],) for file in available_tests])
+        keyboard = [[InlineKeyboardButton(file['test_file'], callback_data=f"select_test_file_{token}"),
+                     InlineKeyboardButton("Viktorina", callback_data=f"quiz_test_{token}")]
+                    for file, token in zip(available_tests, tokens)]
         keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        success = await safe_edit_message_text(update, "Testlar yuklanmoqda...")
-        if not success:
-            return ConversationHandler.END
-        
-        for i in range(3):
-            success = await safe_edit_message_text(update, f"Testlar yuklanmoqda{'.' * (i + 1)}")
-            if not success:
-                return ConversationHandler.END
-            await asyncio.sleep(0.3)
-        
         success = await safe_edit_message_text(update, "Test Menyusi", reply_markup=reply_markup)
         if not success:
             return ConversationHandler.END
@@ -945,16 +804,12 @@ async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def view_my_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT sr.test_id, sr.correct_answers, sr.wrong_answers, sr.total_questions, sr.rank
+    results = await db.fetchall(f'''
+    SELECT sr.test_id, sr.correct_answers, sr.wrong_answers, sr.total_questions, {RANK_SQL} AS rank
     FROM students_results sr
     JOIN students s ON s.id = sr.student_id
     WHERE s.telegram_id = ?
     ''', (user.id,))
-    results = cursor.fetchall()
-    conn.close()
 
     if not results:
         keyboard = [
@@ -981,16 +836,12 @@ async def view_my_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def check_new_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    available_tests = await db.fetchall('''
     SELECT test_file
     FROM available_tests at
     JOIN students s ON s.id = at.student_id
     WHERE s.telegram_id = ? AND at.completed = 0
     ''', (user.id,))
-    available_tests = cursor.fetchall()
-    conn.close()
 
     if not available_tests:
         keyboard = [
@@ -1000,27 +851,17 @@ async def check_new_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_edit_message_text(update, "Hozircha sizga yangi testlar tayinlanmagan.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    keyboard = [[InlineKeyboardButton(file['test_file'], callback_data=f"select_test_file_{file['test_file']}")] for file in available_tests]
+    tokens = await callback_tokens.encode_many([(file['test_file'],) for file in available_tests])
+    keyboard = [[InlineKeyboardButton(file['test_file'], callback_data=f"select_test_file_{token}"),
+                 InlineKeyboardButton("Viktorina", callback_data=f"quiz_test_{token}")]
+                for file, token in zip(available_tests, tokens)]
     keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await safe_edit_message_text(update, "Sizga quyidagi yangi testlar tayinlangan:", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 async def view_class_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT s.first_name, s.last_name, 
-           SUM(sr.correct_answers) as total_correct,
-           SUM(sr.total_questions) as total_questions,
-           CAST(SUM(sr.correct_answers) AS FLOAT) / SUM(sr.total_questions) * 100 as percentage
-    FROM students s
-    LEFT JOIN students_results sr ON s.id = sr.student_id
-    GROUP BY s.id
-    ORDER BY percentage DESC
-    ''')
-    rankings = cursor.fetchall()
-    conn.close()
+    rankings = await db.run(top_by_percentage)
 
     if not rankings:
         keyboard = [
@@ -1034,7 +875,10 @@ async def view_class_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE)
     for i, ranking in enumerate(rankings, 1):
         ranking_text += f"{i}. {ranking['first_name']} {ranking['last_name']}\n"
         ranking_text += f"   To'g'ri javoblar: {ranking['total_correct']}/{ranking['total_questions']}\n"
-        ranking_text += f"   Foiz: {ranking['percentage']:.2f}%\n\n"
+        if ranking['percentage'] is None:
+            ranking_text += "   Foiz: -\n\n"
+        else:
+            ranking_text += f"   Foiz: {ranking['percentage']:.2f}%\n\n"
 
     keyboard = [
         [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
@@ -1045,16 +889,12 @@ async def view_class_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def view_available_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    available_tests = await db.fetchall('''
     SELECT test_file
     FROM available_tests at
     JOIN students s ON s.id = at.student_id
     WHERE s.telegram_id = ? AND at.completed = 0
     ''', (user.id,))
-    available_tests = cursor.fetchall()
-    conn.close()
 
     if not available_tests:
         keyboard = [
@@ -1064,12 +904,84 @@ async def view_available_tests(update: Update, context: ContextTypes.DEFAULT_TYP
         await safe_edit_message_text(update, "Hozircha sizga tayinlangan testlar mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    keyboard = [[InlineKeyboardButton(file['test_file'], callback_data=f"select_test_file_{file['test_file']}")] for file in available_tests]
+    tokens = await callback_tokens.encode_many([(file['test_file'],) for file in available_tests])
+    keyboard = [[InlineKeyboardButton(file['test_file'], callback_data=f"select_test_file_{token}"),
+                 InlineKeyboardButton("Viktorina", callback_data=f"quiz_test_{token}")]
+                for file, token in zip(available_tests, tokens)]
     keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await safe_edit_message_text(update, "Sizga tayinlangan testlar:", reply_markup=reply_markup)
     return SELECTING_ACTION
 
+# Every test of a file sent as quiz polls (see quiz_polls.py); graded as the answers come in
+async def start_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+
+    student = await student_cache.get(update.effective_user.id)
+    if not student:
+        keyboard = [[InlineKeyboardButton("Ro'yxatdan o'tish", callback_data="register")]]
+        await safe_edit_message_text(update, "Iltimos, avval ro'yxatdan o'ting.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return SELECTING_ACTION
+
+    keyboard = [[InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    bank, error_message = await load_tests(file_name)
+    if error_message:
+        await safe_edit_message_text(update, f"Xatolik: {error_message}", reply_markup=reply_markup)
+        return SELECTING_ACTION
+
+    try:
+        polls = quiz_questions(bank.questions)
+    except ValueError as e:
+        await safe_edit_message_text(update, f"Bu testni viktorina sifatida yuborib bo'lmaydi. {e}", reply_markup=reply_markup)
+        return SELECTING_ACTION
+
+    await quiz_sender.start(context.application, update.effective_chat.id, student.id, file_name, file_name, polls)
+    await safe_edit_message_text(
+        update,
+        f"'{file_name}': {len(polls)} ta savol viktorina sifatida yuborilmoqda. "
+        "Javoblarni istalgan tartibda belgilang, natija oxirgi javobdan keyin chiqadi.",
+        reply_markup=reply_markup)
+    return SELECTING_ACTION
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /stats command: runtime counters for admins"""
+    if not is_admin(update.effective_user.id):
+        return
+    bank_stats = bank_cache.stats()
+    message = "Test fayllari keshi:\n"
+    message += f"Keshdan olindi: {bank_stats['hits']}\n"
+    message += f"Fayldan o'qildi: {bank_stats['misses']}\n"
+    message += f"Keshdagi fayllar: {bank_stats['files']}\n"
+    view_stats = question_views.stats()
+    message += f"Tayyor savollar: {view_stats['questions']} ({view_stats['banks']} ta fayl)\n"
+    queue_stats = await db.run(outbox_stats)
+    message += f"Navbatdagi xabarlar: {queue_stats['pending'] + queue_stats['sending']}, "
+    message += f"yetkazilmagan: {queue_stats['dead']}\n"
+    token_stats = callback_tokens.stats()
+    message += f"Tugma tokenlari: keshda {token_stats['cached']}, bazadan o'qildi: {token_stats['misses']}\n"
+    persistence_stats = context.application.persistence.stats()
+    message += f"Saqlangan sessiyalar: yuklandi {persistence_stats['loads']}, yozildi {persistence_stats['writes']}, "
+    message += f"test o'zgargani uchun bekor qilindi {persistence_stats['expired']}\n"
+    student_stats = student_cache.stats()
+    message += f"Talabalar keshi: {student_stats['hit_rate']:.0%} keshdan ({student_stats['hits']}/"
+    message += f"{student_stats['hits'] + student_stats['misses']}), keshda {student_stats['cached']}\n"
+    quiz_stats = quiz_sender.stats()
+    message += f"Viktorinalar: {quiz_stats['polls_sent']} ta savol yuborildi, {quiz_stats['answers']} ta javob, "
+    message += f"yakunlandi: {quiz_stats['finished']}, yuborib bo'lmadi: {quiz_stats['failed']}\n"
+    processor_stats = context.application.update_processor.stats()
+    message += f"Bir vaqtda ishlanayotgan so'rovlar: {processor_stats['running']} "
+    message += f"(eng ko'pi: {processor_stats['peak_running']}/{processor_stats['max_running']})"
+    routes = callback_router.report()
+    if routes:
+        message += f"\n\nTugmalar:\n{routes}"
+    await update.message.reply_text(message)
+
 async def handle_test_file_error(update: Update, context: ContextTypes.DEFAULT_TYPE, error_message: str):
     keyboard = [
         [InlineKeyboardButton("Yangi test file yaratish", callback_data="create_test_file")],
@@ -1083,7 +995,11 @@ async def add_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
     context.user_data['current_file'] = file_name
     await query.edit_message_text("Yangi savolni kiriting:")
     context.user_data['creating_test'] = True
@@ -1091,79 +1007,85 @@ async def add_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['current_step'] = 'question'
     return CREATING_TEST
 
+async def start_test_creation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+    context.user_data['current_test_file'] = file_name
+    await query.edit_message_text("Yangi savolni kiriting:")
+    context.user_data['creating_test'] = True
+    context.user_data['current_test'] = {"questions": [], "answers": [], "correct_answers": []}
+    context.user_data['current_step'] = 'question'
+    return CREATING_TEST
+
+async def unknown_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    logger.warning(f"Unexpected callback data: {query.data}")
+    await safe_edit_message_text(update, f"Kutilmagan xatolik yuz berdi: Noma'lum callback data '{query.data}'. Iltimos, qaytadan urinib ko'ring.")
+    return SELECTING_ACTION
+
+# Inline buttons handled in SELECTING_ACTION; a trailing '*' matches by prefix
+callback_router = CallbackRouter({
+    "create_test": create_test,
+    "create_test_file": create_test_file,
+    "add_test_*": add_test,
+    "view_tests_*": view_file_tests,
+    "start_test_creation_*": start_test_creation,
+    "select_file_*": select_test_file,
+    "select_test_file_*": select_test_file,
+    "quiz_test_*": start_quiz,
+    "view_tests": view_tests,
+    "view_file_*": view_file_tests,
+    "view_results": view_results,
+    "send_test": send_test,
+    "send_file_*": process_send_test,
+    "confirm_send_*": confirm_send_test,
+    "cancel_send": cancel_send_test,
+    "register": register_student,
+    "solve_test": start_test,
+    "view_my_results": view_my_results,
+    "check_new_tests": check_new_tests,
+    "view_class_ranking": view_class_ranking,
+    "main_menu": start,
+    "delete_test_*": delete_test,
+    "delete_file_*": delete_test_file,
+    "next_test": start_selected_test,
+    "view_available_tests": view_available_tests,
+    "answer_*": process_answer,
+})
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     try:
-        if query.data == "create_test":
-            return await create_test(update, context)
-        elif query.data == "create_test_file":
-            return await create_test_file(update, context)
-        elif query.data.startswith("add_test_"):
-            return await add_test(update, context)
-        elif query.data.startswith("view_tests_"):
-            return await view_file_tests(update, context)
-        elif query.data.startswith("start_test_creation_"):
-            file_name = query.data.split('_')[-1]
-            context.user_data['current_test_file'] = file_name
-            await query.edit_message_text("Yangi savolni kiriting:")
-            context.user_data['creating_test'] = True
-            context.user_data['current_test'] = {"questions": [], "answers": [], "correct_answers": []}
-            context.user_data['current_step'] = 'question'
-            return CREATING_TEST
-        elif query.data.startswith("select_file_"):
-            return await select_test_file(update, context)
-        elif query.data == "view_tests":
-            return await view_tests(update, context)
-        elif query.data.startswith("view_file_"):
-            return await view_file_tests(update, context)
-        elif query.data == "view_results":
-            return await view_results(update, context)
-        elif query.data == "send_test":
-            return await send_test(update, context)
-        elif query.data.startswith("send_file_"):
-            return await process_send_test(update, context)
-        elif query.data.startswith("confirm_send_"):
-            return await confirm_send_test(update, context)
-        elif query.data == "cancel_send":
-            return await cancel_send_test(update, context)
-        elif query.data == "register":
-            return await register_student(update, context)
-        elif query.data == "solve_test":
-            return await start_test(update, context)
-        elif query.data == "view_my_results":
-            return await view_my_results(update, context)
-        elif query.data == "check_new_tests":
-            return await check_new_tests(update, context)
-        elif query.data == "view_class_ranking":
-            return await view_class_ranking(update, context)
-        elif query.data == "main_menu":
-            return await start(update, context)
-        elif query.data.startswith("delete_test_"):
-            return await delete_test(update, context)
-        elif query.data.startswith("delete_file_"):
-            return await delete_test_file(update, context)
-        elif query.data.startswith("select_test_file_"):
-            return await select_test_file(update, context)
-        elif query.data == "next_test":
-            return await start_selected_test(update, context)
-        elif query.data == "view_available_tests":
-            return await view_available_tests(update, context)
-        elif query.data.startswith("answer_"):
-            return await process_answer(update, context)
-        else:
-            logger.warning(f"Unexpected callback data: {query.data}")
-            await safe_edit_message_text(update, f"Kutilmagan xatolik yuz berdi: Noma'lum callback data '{query.data}'. Iltimos, qaytadan urinib ko'ring.")
-            return SELECTING_ACTION
+        return await callback_router.dispatch(update, context, default=unknown_callback)
     except Exception as e:
         logger.error(f"Xatolik yuz berdi: {e}")
         error_message = f"Xatolik yuz berdi: {str(e)}. Iltimos, qaytadan urinib ko'ring."
         await safe_edit_message_text(update, error_message)
         return SELECTING_ACTION
 
-def main() -> None:
-    application = Application.builder().token(TOKEN).build()
+async def startup(application: Application) -> None:
+    """Drop expired button tokens and start delivering queued notifications, including any left over from the last run"""
+    await callback_tokens.prune()
+    await outbox_sender.start(application.bot)
+
+async def close_database(application: Application) -> None:
+    """Commit queued results and release the pooled database connections once the bot has stopped"""
+    await outbox_sender.stop()
+    await write_queue.close()
+    db.close()
+
+def build_application() -> Application:
+    # Updates from different users run concurrently, each user's in order.
+    # The schema is migrated when initialize() first loads persisted conversations.
+    application = (apply_api_url(Application.builder().token(config.token)).concurrent_updates(build_update_processor())
+                   .persistence(build_persistence(prepare=ensure_schema))
+                   .post_init(startup).post_shutdown(close_database).build())
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -1176,12 +1098,13 @@ def main() -> None:
             ],
             CREATING_TEST: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_test_creation),
-                CallbackQueryHandler(process_correct_answer, pattern=r'^correct_'),
-                CallbackQueryHandler(add_question, pattern=r'^add_question$'),
-                CallbackQueryHandler(finish_test, pattern=r'^finish_test$'),
+                CallbackQueryHandler(callback_router.track("correct_*", process_correct_answer), pattern=r'^correct_'),
+                CallbackQueryHandler(callback_router.track("add_question", add_question), pattern=r'^add_question$'),
+                CallbackQueryHandler(callback_router.track("finish_test", finish_test), pattern=r'^finish_test$'),
             ],
             ANSWERING_QUESTION: [
-                CallbackQueryHandler(process_answer, pattern=r'^answer_')
+                CallbackQueryHandler(callback_router.track("answer_*", requires_session(process_answer)), pattern=r'^answer_'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, requires_session(process_answer_key)),
             ],
             ENTERING_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_name),
@@ -1191,12 +1114,21 @@ def main() -> None:
             ],
         },
         fallbacks=[CommandHandler("start", start)],
+        # State survives restarts through the SQLite persistence
+        name="main",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(PollAnswerHandler(quiz_sender.answer))
+    application.add_handler(CommandHandler("stats", stats))
+    return application
+
+def main() -> None:
+    application = build_application()
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Run the bot: polling, or a webhook with BOT_MODE=webhook; both stop gracefully on SIGINT/SIGTERM
+    run(application)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,57 @@
+# A whole test answered in one message, for classes that take tests on paper.
+#
+# A key is either one letter per question in order ("abcdab", spaces and
+# commas allowed) or numbered answers in any order ("1a2c3b", "1-a, 2-c").
+# It must answer every question exactly once and each letter must be one of
+# that question's options, so a typo is reported back instead of graded.
+import re
+
+ANSWER_KEY_HINT = ("Javoblarni bitta xabarda ham yuborishingiz mumkin, masalan: abcdab... "
+                   "yoki 1a 2c 3b ...")
+
+_NUMBERED = re.compile(r'(\d+)\s*[).:=-]?\s*([^\W\d_])')
+_SEPARATORS = ' ,;\t\n'
+
+
+def _letters(question):
+    return {letter for letter, _ in question.choices()}
+
+
+def _numbered(key, count):
+    answers = [None] * count
+    position = 0
+    for match in _NUMBERED.finditer(key):
+        unread = key[position:match.start()].strip(_SEPARATORS)
+        if unread:
+            raise ValueError(f"Kalitni o'qib bo'lmadi: \"{unread}\".")
+        number = int(match[1])
+        if not 1 <= number <= count:
+            raise ValueError(f"Testda {count} ta savol bor, {number}-savol yo'q.")
+        if answers[number - 1] is not None:
+            raise ValueError(f"{number}-savolga ikki marta javob berilgan.")
+        answers[number - 1] = match[2]
+        position = match.end()
+    unread = key[position:].strip(_SEPARATORS)
+    if unread:
+        raise ValueError(f"Kalitni o'qib bo'lmadi: \"{unread}\".")
+    missing = [str(number) for number, answer in enumerate(answers, 1) if answer is None]
+    if missing:
+        raise ValueError(f"Javob berilmagan savollar: {', '.join(missing)}.")
+    return answers
+
+
+def parse_answer_key(text, questions):
+    """One answer letter per question, in order, or ValueError with a message for the student"""
+    key = text.strip().lower()
+    if any(char.isdigit() for char in key):
+        answers = _numbered(key, len(questions))
+    else:
+        answers = [char for char in key if char not in _SEPARATORS]
+        if len(answers) != len(questions):
+            raise ValueError(f"Testda {len(questions)} ta savol bor, kalitda esa {len(answers)} ta javob.")
+
+    for number, (answer, question) in enumerate(zip(answers, questions), 1):
+        letters = _letters(question)
+        if letters and answer not in letters:
+            raise ValueError(f"{number}-savolda \"{answer}\" varianti yo'q.")
+    return answers
@@ -0,0 +1,26 @@
+# Test assignments (available_tests) are unique per (student_id, test_file).
+# Re-sending a file to a student re-opens the existing assignment instead of
+# adding another row, so the table only grows with real assignments.
+
+ASSIGN_SQL = '''
+INSERT INTO available_tests (student_id, test_file, completed)
+VALUES (?, ?, 0)
+ON CONFLICT(student_id, test_file) DO UPDATE SET completed = 0
+'''
+
+# WHERE true keeps SQLite from reading ON CONFLICT as part of the SELECT's join
+ASSIGN_ALL_SQL = '''
+INSERT INTO available_tests (student_id, test_file, completed)
+SELECT id, ?, 0 FROM students WHERE true
+ON CONFLICT(student_id, test_file) DO UPDATE SET completed = 0
+'''
+
+
+def assign_test(conn, student_id, test_file):
+    """Assign a test file to one student (or re-open it if already assigned)"""
+    conn.execute(ASSIGN_SQL, (student_id, test_file))
+
+
+def assign_test_to_all(conn, test_file):
+    """Assign a test file to every registered student in a single statement"""
+    return conn.execute(ASSIGN_ALL_SQL, (test_file,)).rowcount
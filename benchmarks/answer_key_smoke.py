@@ -0,0 +1,104 @@
+"""A whole test answered in one message vs one button press per question.
+
+Runs main.py's application against a fresh database in a temporary directory
+and a fake Bot API. Two students take the same --questions question test:
+one presses an answer button per question, the other sends the answer key
+in one message (first a mistyped key, which must be rejected, then a valid
+one with two wrong answers). Both results must be stored, each with one
+attempt_answers row per question (response times only for the buttons);
+reported are the updates and Bot API calls each needed.
+
+    python benchmarks/answer_key_smoke.py [--questions 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main as bot  # noqa: E402
+from callback_tokens import callback_tokens  # noqa: E402
+from database import db, write_queue  # noqa: E402
+from migrations import ensure_schema  # noqa: E402
+from smoke_fixtures import FILE_NAME, LETTERS, STUDENT as BUTTONS, answer, callback, message, seed  # noqa: E402
+from webhook_smoke import FakeBotApi  # noqa: E402
+
+KEY = {'id': 1002, 'is_bot': False, 'first_name': 'Vali'}
+
+
+def results(conn):
+    return {row[0]: (row[1], row[2]) for row in conn.execute('''
+    SELECT s.telegram_id, sr.correct_answers, sr.total_questions
+    FROM students_results sr JOIN students s ON s.id = sr.student_id
+    ''')}
+
+
+def answers(conn):
+    # telegram id -> (rows, correct rows, rows with a response time)
+    return {row[0]: tuple(row[1:]) for row in conn.execute('''
+    SELECT s.telegram_id, COUNT(*), SUM(aa.is_correct), COUNT(aa.response_ms)
+    FROM attempt_answers aa JOIN students s ON s.id = aa.student_id
+    GROUP BY s.telegram_id
+    ''')}
+
+
+async def main(questions):
+    api = FakeBotApi()
+    os.environ.update(TELEGRAM_API_URL=f"http://127.0.0.1:{await api.start()}/bot",
+                      TELEGRAM_BOT_TOKEN='123456:TEST', ADMIN_TELEGRAM_ID='1', PROGRESS_INDICATOR='0')
+    # test_bot.db is opened in the current directory on first use
+    os.chdir(tempfile.mkdtemp())
+    await ensure_schema()
+    await db.transaction(seed, questions, (BUTTONS, KEY))
+
+    application = bot.build_application()
+    await application.initialize()
+    update_ids = iter(range(1, 10 ** 6))
+    start = f"start_test_{await callback_tokens.encode(FILE_NAME)}"
+    key = [answer(n) for n in range(questions)]
+    for wrong in (0, -1):
+        key[wrong] = LETTERS[(LETTERS.index(key[wrong]) + 1) % 4]
+
+    async def session(user, updates):
+        calls = len(api.calls)
+        begin = time.perf_counter()
+        await application.process_update(callback(application, next(update_ids), start, user))
+        for kind, data in updates:
+            update = (callback if kind == 'press' else message)(application, next(update_ids), data, user)
+            await application.process_update(update)
+        return len(updates) + 1, len(api.calls) - calls, time.perf_counter() - begin
+
+    pressed = await session(BUTTONS, [('press', f"answer_{answer(n)}") for n in range(questions)])
+    typo = ''.join(key[:-1]) + 'e'
+    keyed = await session(KEY, [('text', typo), ('text', ' '.join(f"{n}{letter}" for n, letter in enumerate(key, 1)))])
+    # The reply rejecting the mistyped key and the result are the only new messages
+    replies = api.calls.count('sendMessage')
+
+    await application.shutdown()
+    await write_queue.close()
+    stored = await db.run(results)
+    answered = await db.run(answers)
+    db.close()
+    await api.stop()
+
+    for name, (updates, calls, elapsed) in (('buttons', pressed), ('answer key', keyed)):
+        print(f"{name:>10}: {updates:3d} updates, {calls:3d} Bot API calls, {elapsed * 1000:7.1f} ms")
+    print(f"stored: buttons {stored.get(BUTTONS['id'])}, answer key {stored.get(KEY['id'])}")
+    print(f"answers (rows, correct, timed): buttons {answered.get(BUTTONS['id'])}, answer key {answered.get(KEY['id'])}")
+    ok = (stored.get(BUTTONS['id']) == (questions, questions) and stored.get(KEY['id']) == (questions - 2, questions)
+          and answered.get(BUTTONS['id']) == (questions, questions, questions)
+          and answered.get(KEY['id']) == (questions, questions - 2, 0)
+          and replies == 2)
+    print("ok" if ok else "FAIL")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=50)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(main(args.questions)) else 1)
@@ -0,0 +1,89 @@
+"""Storing the answers of finished attempts: one executemany vs one INSERT per answer.
+
+Writes --attempts attempts of a --questions question test into a fresh
+attempt_answers table in a temporary database, each attempt in its own
+transaction as the write queue would, first with an INSERT per answer and
+then with results.save_answers (a single executemany). Then runs a
+per-question and a per-student query and prints their plans, which must use
+the table's indexes rather than scan it.
+
+    python benchmarks/bench_attempt_answers.py [--attempts 2000] [--questions 30]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results import ATTEMPT_ANSWERS_SCHEMA, save_answers  # noqa: E402
+
+TEST_ID = 'algebra_9_sinf.json'
+LETTERS = 'abcd'
+
+
+def one_by_one(conn, result_id, student_id, test_id, correct_answers, answers, response_times):
+    for index, (correct_answer, answer) in enumerate(zip(correct_answers, answers)):
+        conn.execute('''
+        INSERT INTO attempt_answers (result_id, question_index, student_id, test_id, chosen_option, is_correct,
+                                     response_ms)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (result_id, index, student_id, test_id, answer, answer == correct_answer,
+              response_times[index]))
+
+
+def write_attempts(path, store, attempts, questions):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript('PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;')
+    conn.executescript(ATTEMPT_ANSWERS_SCHEMA)
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for result_id in range(1, attempts + 1):
+        answers = [rng.choice(LETTERS) for _ in questions]
+        response_times = [rng.randint(2000, 60000) for _ in questions]
+        conn.execute('BEGIN')
+        store(conn, result_id, result_id % 300, TEST_ID, questions, answers, response_times)
+        conn.execute('COMMIT')
+    elapsed = time.perf_counter() - start
+    return conn, elapsed
+
+
+def plan(conn, sql, params):
+    return '; '.join(row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params))
+
+
+def main(attempts, questions):
+    questions = [LETTERS[n % 4] for n in range(questions)]
+    directory = tempfile.mkdtemp()
+    for name, store in (('INSERT per answer', one_by_one), ('executemany', save_answers)):
+        conn, elapsed = write_attempts(os.path.join(directory, f"{store.__name__}.db"), store, attempts, questions)
+        print(f"{name:>17}: {elapsed / attempts * 1e6:7.1f} µs per attempt, "
+              f"{elapsed / (attempts * len(questions)) * 1e6:5.2f} µs per answer")
+
+    queries = {
+        'per question': ('''
+        SELECT chosen_option, COUNT(*) FROM attempt_answers
+        WHERE test_id = ? AND question_index = ? GROUP BY chosen_option
+        ''', (TEST_ID, 3)),
+        'per student': ('''
+        SELECT question_index, AVG(is_correct), AVG(response_ms) FROM attempt_answers
+        WHERE student_id = ? AND test_id = ? GROUP BY question_index
+        ''', (7, TEST_ID)),
+    }
+    for name, (sql, params) in queries.items():
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>17}: {len(rows)} rows in {elapsed * 1000:.2f} ms | {plan(conn, sql, params)}")
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--attempts', type=int, default=2000)
+    parser.add_argument('--questions', type=int, default=30)
+    args = parser.parse_args()
+    main(args.attempts, args.questions)
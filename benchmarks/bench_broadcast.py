@@ -0,0 +1,88 @@
+"""Notifying a whole class: sequential sends vs unthrottled gather vs the Broadcaster.
+
+The Broadcaster is driven the way the outbox drives it: one claimed chunk
+of OUTBOX_CLAIM_SIZE messages at a time, each chunk sent concurrently
+through Broadcaster.send.
+
+A fake bot stands in for the Bot API: every call takes --latency seconds
+and, like Telegram, answers 429 (RetryAfter) once more than 30 messages
+were sent within the last second. Reported are the wall time, how many
+messages were delivered and how many 429s each strategy provoked.
+
+    python benchmarks/bench_broadcast.py [--students 500] [--latency 0.1]
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import RetryAfter  # noqa: E402
+
+from broadcast import Broadcaster  # noqa: E402
+from outbox import OUTBOX_CLAIM_SIZE  # noqa: E402
+
+TELEGRAM_RATE = 30
+
+
+class FakeBot:
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+        self.flood_errors = 0
+        self._window = collections.deque()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        while self._window and now - self._window[0] > 1:
+            self._window.popleft()
+        if len(self._window) >= TELEGRAM_RATE:
+            self.flood_errors += 1
+            raise RetryAfter(1)
+        self._window.append(now)
+        self.sent += 1
+
+
+async def sequential(bot, chat_ids):
+    for chat_id in chat_ids:
+        try:
+            await bot.send_message(chat_id=chat_id, text="Sizga yangi test tayinlandi!")
+        except RetryAfter:
+            pass
+
+
+async def unthrottled(bot, chat_ids):
+    await asyncio.gather(*(bot.send_message(chat_id=chat_id, text="Sizga yangi test tayinlandi!")
+                           for chat_id in chat_ids), return_exceptions=True)
+
+
+async def broadcaster(bot, chat_ids):
+    sender = Broadcaster()
+    for start in range(0, len(chat_ids), OUTBOX_CLAIM_SIZE):
+        chunk = chat_ids[start:start + OUTBOX_CLAIM_SIZE]
+        await asyncio.gather(*(sender.send(bot, chat_id, "Sizga yangi test tayinlandi!") for chat_id in chunk),
+                             return_exceptions=True)
+
+
+async def main(students, latency):
+    chat_ids = list(range(students))
+    print(f"{students} students, {latency * 1000:.0f} ms per API call")
+    print(f"{'strategy':>12} | {'time (s)':>8} | {'delivered':>9} | {'429s':>5}")
+    for name, strategy in (('sequential', sequential), ('gather', unthrottled), ('broadcaster', broadcaster)):
+        bot = FakeBot(latency)
+        start = time.perf_counter()
+        await strategy(bot, chat_ids)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>12} | {elapsed:>8.1f} | {bot.sent:>9} | {bot.flood_errors:>5}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.1)
+    args = parser.parse_args()
+    asyncio.run(main(args.students, args.latency))
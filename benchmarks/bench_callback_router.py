@@ -0,0 +1,82 @@
+"""Callback dispatch: the old if/elif chain vs the compiled CallbackRouter.
+
+Both resolve the same mix of callback data (mostly answer presses and menu
+navigation, as in a class taking a test) to a handler name. Reported is the
+time per lookup, plus the router's per-route stats text from a simulated run.
+
+    python benchmarks/bench_callback_router.py [--presses 200000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callback_router import CallbackRouter  # noqa: E402
+
+ROUTES = [
+    ("create_test", False), ("create_test_file", False), ("add_test_", True), ("view_tests_", True),
+    ("start_test_creation_", True), ("select_file_", True), ("view_tests", False), ("view_file_", True),
+    ("view_results", False), ("send_test", False), ("send_file_", True), ("confirm_send_", True),
+    ("cancel_send", False), ("register", False), ("solve_test", False), ("view_my_results", False),
+    ("check_new_tests", False), ("view_class_ranking", False), ("main_menu", False), ("delete_test_", True),
+    ("delete_file_", True), ("select_test_file_", True), ("next_test", False), ("view_available_tests", False),
+    ("answer_", True),
+]
+
+
+def if_chain(data):
+    # Same order as the old button_callback in BotBitdi.py
+    for key, prefix in ROUTES:
+        if data.startswith(key) if prefix else data == key:
+            return key
+    return None
+
+
+def press_mix(presses, seed=1):
+    rng = random.Random(seed)
+    data = [f"answer_{letter}" for letter in 'abcd'] * 15
+    data += ["main_menu"] * 10 + ["view_available_tests"] * 5 + ["view_my_results"] * 3
+    data += ["delete_test_algebra.json_3", "select_test_file_geometriya.json", "check_new_tests", "nope"]
+    return [rng.choice(data) for _ in range(presses)]
+
+
+async def simulated_run(router, presses):
+    class Query:
+        def __init__(self, data):
+            self.data = data
+
+    class FakeUpdate:
+        def __init__(self, data):
+            self.callback_query = Query(data)
+
+    for data in presses:
+        await router.dispatch(FakeUpdate(data), None)
+
+
+def main(presses):
+    async def handler(update, context):
+        pass
+
+    router = CallbackRouter({key + ('*' if prefix else ''): handler for key, prefix in ROUTES})
+    mix = press_mix(presses)
+    for name, lookup in (('if/elif', if_chain), ('router', router.resolve)):
+        start = time.perf_counter()
+        for data in mix:
+            lookup(data)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: {elapsed / presses * 1e9:7.0f} ns per press")
+
+    asyncio.run(simulated_run(router, mix[:10000]))
+    print()
+    print(router.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--presses', type=int, default=200000)
+    args = parser.parse_args()
+    main(args.presses)
@@ -0,0 +1,83 @@
+"""Cold start: how long a fresh process takes until the bot can answer.
+
+Each run is a new Python process in an empty directory (no test_bot.db yet)
+talking to a fake Bot API. It imports the bot module, builds the
+Application and initializes it, which migrates the new database. Reported
+are the medians of each step over --runs runs, whether the import alone
+created test_bot.db, and the cost of one admin check.
+
+    python benchmarks/bench_cold_start.py [--app main] [--runs 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from webhook_smoke import FakeBotApi  # noqa: E402
+
+CHILD = '''
+import asyncio, importlib, json, os, time
+
+start = time.perf_counter()
+bot = importlib.import_module({app!r})
+imported = time.perf_counter()
+created_on_import = os.path.exists('test_bot.db')
+
+from config import is_admin
+checks = 100000
+check_start = time.perf_counter()
+for user_id in range(checks):
+    is_admin(user_id)
+check_time = (time.perf_counter() - check_start) / checks
+
+async def ready():
+    building = time.perf_counter()
+    application = bot.build_application()
+    built = time.perf_counter()
+    await application.initialize()
+    initialized = time.perf_counter()
+    await application.shutdown()
+    return built - building, initialized - built
+
+build, initialize = asyncio.run(ready())
+print(json.dumps({{'import': imported - start, 'build': build, 'initialize': initialize,
+                  'created_on_import': created_on_import, 'is_admin': check_time}}))
+'''
+
+
+async def one_run(app, port):
+    env = dict(os.environ, PYTHONPATH=ROOT, TELEGRAM_BOT_TOKEN='123456:TEST', ADMIN_TELEGRAM_ID='1',
+               TELEGRAM_API_URL=f"http://127.0.0.1:{port}/bot")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', CHILD.format(app=app), cwd=tempfile.mkdtemp(), env=env,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+async def main(app, runs):
+    api = FakeBotApi()
+    port = await api.start()
+    results = [await one_run(app, port) for _ in range(runs)]
+    await api.stop()
+
+    for step in ('import', 'build', 'initialize'):
+        print(f"{step:>10}: {statistics.median(r[step] for r in results) * 1000:7.1f} ms")
+    total = statistics.median(r['import'] + r['build'] + r['initialize'] for r in results)
+    print(f"{'total':>10}: {total * 1000:7.1f} ms")
+    print(f"test_bot.db created by the import: {any(r['created_on_import'] for r in results)}")
+    print(f"admin check: {statistics.median(r['is_admin'] for r in results) * 1e9:.0f} ns")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--app', choices=['main', 'BotBitdi'], default='main')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.app, args.runs))
@@ -0,0 +1,106 @@
+"""Update processing: sequential vs plain concurrent vs per-user ordered concurrent.
+
+Every simulated user sends --per-user updates. The handler reads a counter
+from user_data, waits a random time (a slow DB write or API call) and
+writes the counter back, recording the order the user's updates ran in.
+Updates are handed to the processor exactly as PTB's update fetcher does;
+getMe is answered by the fake Bot API from webhook_smoke.py.
+Reported are the wall time, how many of a user's updates ran out of order
+and how many counter increments were lost to interleaving.
+
+    python benchmarks/bench_concurrent_updates.py [--users 10] [--per-user 20] [--delay 0.02] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, MessageHandler, SimpleUpdateProcessor, filters  # noqa: E402
+
+from update_processor import PerUserUpdateProcessor  # noqa: E402
+from webhook import apply_api_url  # noqa: E402
+from webhook_smoke import FakeBotApi  # noqa: E402
+
+
+def make_updates(application, users, per_user):
+    updates = []
+    update_id = 0
+    for seq in range(per_user):
+        for user_id in range(1, users + 1):
+            update_id += 1
+            updates.append(Update.de_json({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': 0, 'text': str(seq),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Ali'}}}, application.bot))
+    return updates
+
+
+async def run(processor, users, per_user, delay, seed):
+    application = apply_api_url(Application.builder().token('123456:TEST')).concurrent_updates(processor).build()
+    seen = {}
+    rng = random.Random(seed)
+
+    async def handle(update, context):
+        count = context.user_data.get('count', 0)
+        await asyncio.sleep(rng.uniform(0, 2 * delay))
+        context.user_data['count'] = count + 1
+        seen.setdefault(update.effective_user.id, []).append(int(update.message.text))
+
+    application.add_handler(MessageHandler(filters.TEXT, handle))
+    # Initializes the processor as well
+    await application.initialize()
+
+    start = time.perf_counter()
+    tasks = []
+    for update in make_updates(application, users, per_user):
+        coroutine = processor.process_update(update, application.process_update(update))
+        if processor.max_concurrent_updates > 1:
+            tasks.append(asyncio.create_task(coroutine))
+        else:
+            await coroutine
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await application.shutdown()
+
+    reordered = sum(order != sorted(order) for order in seen.values())
+    lost = sum(per_user - application.user_data[user_id].get('count', 0) for user_id in range(1, users + 1))
+    return elapsed, reordered, lost
+
+
+async def main(users, per_user, delay, concurrency, seed):
+    strategies = [
+        ('sequential', SimpleUpdateProcessor(1)),
+        ('concurrent', SimpleUpdateProcessor(concurrency)),
+        ('per-user', PerUserUpdateProcessor(concurrency)),
+    ]
+    # Application.initialize() calls getMe, answered by a local fake Bot API
+    api = FakeBotApi()
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{await api.start()}/bot"
+    print(f"{users} users x {per_user} updates, handler ~{delay * 1000:.0f} ms, concurrency {concurrency}")
+    print(f"{'processor':>12} | {'time, s':>8} | {'users reordered':>15} | {'lost writes':>11}")
+    results = {}
+    for name, processor in strategies:
+        elapsed, reordered, lost = await run(processor, users, per_user, delay, seed)
+        results[name] = (reordered, lost)
+        print(f"{name:>12} | {elapsed:>8.2f} | {reordered:>15} | {lost:>11}")
+    await api.stop()
+    if processor.peak_running > concurrency:
+        print(f"FAIL: {processor.peak_running} handlers ran at once, limit {concurrency}")
+        return False
+    return results['per-user'] == (0, 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--per-user', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.02)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(main(args.users, args.per_user, args.delay, args.concurrency, args.seed)) else 1)
@@ -0,0 +1,86 @@
+"""Walking a whole multi-test file: per-question prefix sums vs precomputed offsets.
+
+Simulates one student answering every question of a file and then grading
+it. The legacy path summed the lengths of all earlier tests for every
+question sent and built a dict per question when grading; the new path
+looks numbers up in TestBank.offsets and grades against the flat
+TestBank.questions sequence.
+
+    python benchmarks/bench_question_numbering.py [--sizes 1000 5000 20000] [--per-test 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from question_bank import Question, Test, TestBank  # noqa: E402
+
+
+def make_bank(question_count, per_test):
+    tests = []
+    for test_no in range(1, question_count // per_test + 1):
+        tests.append(Test(test_no, tuple(
+            Question(f"Savol {test_no}.{i}", ('a) 1', 'b) 2', 'c) 3', 'd) 4'), 'a') for i in range(per_test)
+        )))
+    return TestBank('bench.json', 1, tests)
+
+
+def legacy_walk(bank, answers):
+    all_tests = bank.tests
+    numbers = []
+    for test_index, test in enumerate(all_tests):
+        for question_index in range(len(test.questions)):
+            total_questions_before = sum(len(t.questions) for t in all_tests[:test_index])
+            numbers.append(total_questions_before + question_index + 1)
+
+    detailed_results = []
+    answer_index = 0
+    for test in all_tests:
+        for question in test.questions:
+            user_answer = answers[answer_index] if answer_index < len(answers) else None
+            detailed_results.append({
+                'question': question.text,
+                'user_answer': user_answer,
+                'correct_answer': question.correct_answer,
+                'is_correct': user_answer == question.correct_answer,
+            })
+            answer_index += 1
+    return numbers, sum(result['is_correct'] for result in detailed_results)
+
+
+def indexed_walk(bank, answers):
+    numbers = []
+    for test_index, test in enumerate(bank.tests):
+        for question_index in range(len(test.questions)):
+            numbers.append(bank.position(test_index, question_index) + 1)
+
+    correct = sum(answer == question.correct_answer for answer, question in zip(answers, bank.questions))
+    return numbers, correct
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(sizes, per_test):
+    print(f"{per_test} questions per test")
+    print(f"{'questions':>9} | {'legacy (ms)':>11} | {'offsets (ms)':>12}")
+    for size in sizes:
+        bank = make_bank(size, per_test)
+        answers = ['a' if i % 3 else 'b' for i in range(len(bank.questions))]
+        legacy_time, legacy = timed(legacy_walk, bank, answers)
+        indexed_time, indexed = timed(indexed_walk, bank, answers)
+        assert legacy == indexed
+        print(f"{size:>9} | {legacy_time * 1000:>11.1f} | {indexed_time * 1000:>12.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--per-test', type=int, default=20)
+    args = parser.parse_args()
+    main(args.sizes, args.per_test)
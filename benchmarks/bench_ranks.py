@@ -0,0 +1,110 @@
+"""Cost per submission of rank maintenance for a single test.
+
+Submits N results to one test against a scratch database, first with the old
+"insert then rewrite every rank of the test" strategy and then with the
+current single-insert strategy (ranks computed on read), and prints the
+average cost per submission for each block of submissions.
+
+    python benchmarks/bench_ranks.py [--results 10000] [--block 1000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results import RANK_SQL, save_result  # noqa: E402
+
+TEST_ID = 1
+QUESTIONS = 50
+
+
+def create_schema(conn):
+    conn.executescript('''
+    CREATE TABLE students_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        test_id INTEGER,
+        correct_answers INTEGER,
+        wrong_answers INTEGER,
+        total_questions INTEGER,
+        rank INTEGER
+    );
+    CREATE INDEX idx_students_results_test_score ON students_results (test_id, correct_answers);
+    ''')
+
+
+def submit_legacy(conn, student_id, correct):
+    # What finish_test used to do: one insert, then one UPDATE per result of the test
+    cursor = conn.cursor()
+    cursor.execute('''
+    INSERT INTO students_results (student_id, test_id, correct_answers, wrong_answers, total_questions)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (student_id, TEST_ID, correct, QUESTIONS - correct, QUESTIONS))
+    cursor.execute('''
+    SELECT id, correct_answers FROM students_results
+    WHERE test_id = ?
+    ORDER BY correct_answers DESC
+    ''', (TEST_ID,))
+    for rank, (result_id, _) in enumerate(cursor.fetchall(), start=1):
+        cursor.execute('UPDATE students_results SET rank = ? WHERE id = ?', (rank, result_id))
+    conn.commit()
+
+
+def submit_current(conn, student_id, correct):
+    save_result(conn, student_id, TEST_ID, correct, QUESTIONS - correct, QUESTIONS)
+    conn.commit()
+
+
+def read_rank(conn, result_id):
+    return conn.execute(f'SELECT {RANK_SQL} FROM students_results sr WHERE sr.id = ?', (result_id,)).fetchone()[0]
+
+
+def run(name, submit, scores, block):
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        create_schema(conn)
+
+        print(f"\n{name}")
+        print(f"{'submissions':>14} | {'avg per submission':>18}")
+        total_start = time.perf_counter()
+        block_start = total_start
+        for student_id, correct in enumerate(scores, start=1):
+            submit(conn, student_id, correct)
+            if student_id % block == 0:
+                elapsed = time.perf_counter() - block_start
+                print(f"{student_id - block + 1:>6}-{student_id:<7} | {elapsed / block * 1e6:>15.1f} us")
+                block_start = time.perf_counter()
+        total = time.perf_counter() - total_start
+        print(f"total: {total:.2f} s ({total / len(scores) * 1e6:.1f} us per submission)")
+
+        if submit is submit_current:
+            lookups = min(1000, len(scores))
+            start = time.perf_counter()
+            for result_id in random.sample(range(1, len(scores) + 1), lookups):
+                read_rank(conn, result_id)
+            elapsed = time.perf_counter() - start
+            print(f"rank lookup on read: {elapsed / lookups * 1e6:.1f} us")
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--results', type=int, default=10000)
+    parser.add_argument('--block', type=int, default=1000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    scores = [random.randint(0, QUESTIONS) for _ in range(args.results)]
+    run("before: insert + rewrite all ranks", submit_legacy, scores, args.block)
+    run("after: single insert, rank on read", submit_current, scores, args.block)
+
+
+if __name__ == '__main__':
+    main()
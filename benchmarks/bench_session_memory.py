@@ -0,0 +1,84 @@
+"""Memory held by N concurrent test sessions: per-student copies vs one shared bank.
+
+The legacy layout parsed the JSON file for every student and kept the whole
+list of test dicts in each student's user_data. Sessions now keep a
+reference to one shared TestBank, a cursor and their answers. Both layouts
+are built for N students on the same file and measured with tracemalloc.
+
+    python benchmarks/bench_session_memory.py [--questions 200] [--sessions 10 100 1000]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from question_bank import Question, Test, TestBank  # noqa: E402
+
+
+def make_file(question_count, tests=4):
+    per_test = question_count // tests
+    return json.dumps([
+        {
+            'id': test_no,
+            'questions': [f"Savol {test_no}.{i}: {'matn ' * 12}" for i in range(per_test)],
+            'answers': [[f"{letter}) javob {i} {letter}" for letter in 'abcd'] for i in range(per_test)],
+            'correct_answers': ['a' for _ in range(per_test)],
+        }
+        for test_no in range(1, tests + 1)
+    ])
+
+
+def bank_from_json(content):
+    return TestBank('bench.json', 1, (
+        Test(test['id'], tuple(
+            Question(text, tuple(options), correct)
+            for text, options, correct in zip(test['questions'], test['answers'], test['correct_answers'])
+        ))
+        for test in json.loads(content)
+    ))
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del sessions
+    return used
+
+
+def legacy_sessions(content, count):
+    # Every student got their own parsed copy of the file
+    return [{'all_tests': json.loads(content), 'current_test_index': 0, 'current_question': 0, 'answers': []}
+            for _ in range(count)]
+
+
+def shared_sessions(content, count):
+    bank = bank_from_json(content)
+    return [{'bank': bank, 'current_test_index': 0, 'current_question': 0, 'answers': []}
+            for _ in range(count)]
+
+
+def main(questions, levels):
+    content = make_file(questions)
+    print(f"{questions} questions per file")
+    print(f"{'sessions':>8} | {'per-student copies (MiB)':>24} | {'shared bank (MiB)':>17}")
+    for count in levels:
+        legacy = measure(lambda: legacy_sessions(content, count))
+        shared = measure(lambda: shared_sessions(content, count))
+        print(f"{count:>8} | {legacy / 2 ** 20:>24.2f} | {shared / 2 ** 20:>17.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=200)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args()
+    main(args.questions, args.sessions)
@@ -0,0 +1,73 @@
+"""Student lookups: a database query per menu press vs the student cache.
+
+A class of --students students (half of them registered) presses --presses
+menu buttons, each needing to know who pressed it. Reported are the database
+round trips and the time per lookup, without a cache (ttl 0) and with the
+cache, and the cache's hit rate.
+
+    python benchmarks/bench_student_cache.py [--students 300] [--presses 20000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+from migrations import migrate  # noqa: E402
+from students import StudentCache  # noqa: E402
+
+
+class CountingDatabase(Database):
+    def __init__(self, path):
+        super().__init__(path)
+        self.queries = 0
+
+    async def run(self, func, *args):
+        self.queries += 1
+        return await super().run(func, *args)
+
+
+def seed(conn, students):
+    with conn:
+        conn.executemany('INSERT INTO students (first_name, last_name, telegram_id) VALUES (?, ?, ?)',
+                         [(f"Ism{n}", f"Familiya{n}", 1000 + n) for n in range(0, students, 2)])
+
+
+async def run(cache, presses):
+    start = time.perf_counter()
+    for telegram_id in presses:
+        await cache.get(telegram_id)
+    return time.perf_counter() - start
+
+
+async def main(students, presses):
+    path = os.path.join(tempfile.mkdtemp(), 'test_bot.db')
+    database = CountingDatabase(path)
+    conn = database.connect()
+    migrate(conn)
+    seed(conn, students)
+    conn.close()
+
+    rng = random.Random(1)
+    mix = [1000 + rng.randrange(students) for _ in range(presses)]
+    for name, ttl in (('no cache', 0), ('cache', 600)):
+        database.queries = 0
+        cache = StudentCache(database, ttl=ttl)
+        elapsed = await run(cache, mix)
+        stats = cache.stats()
+        print(f"{name:>8}: {database.queries:6d} queries, {elapsed / presses * 1e6:6.1f} us per lookup, "
+              f"hit rate {stats['hit_rate']:.1%}")
+    database.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=300)
+    parser.add_argument('--presses', type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main(args.students, args.presses))
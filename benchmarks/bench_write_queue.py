@@ -0,0 +1,71 @@
+"""Submission latency under concurrency: one transaction per result vs group commit.
+
+For each concurrency level, that many students "finish" a test at the same
+moment. Each submission looks up the student and inserts the result, either
+in its own transaction (db.transaction) or through WriteQueue, and the
+p50/p99 latency of the awaiting handler is reported.
+
+    python benchmarks/bench_write_queue.py [--levels 10 100 500 1000]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database, WriteQueue  # noqa: E402
+from migrations import migrate  # noqa: E402
+from results import save_result  # noqa: E402
+
+
+def store_result(conn, telegram_id):
+    student_id = conn.execute('SELECT id FROM students WHERE telegram_id = ?', (telegram_id,)).fetchone()[0]
+    save_result(conn, student_id, 'bench.json', 40, 10, 50)
+
+
+async def timed(submit, telegram_id):
+    start = time.perf_counter()
+    await submit(store_result, telegram_id)
+    return time.perf_counter() - start
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_level(submit, concurrency):
+    latencies = await asyncio.gather(*(timed(submit, telegram_id) for telegram_id in range(concurrency)))
+    return statistics.median(latencies), percentile(latencies, 0.99)
+
+
+async def main(levels):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, 'bench.db'))
+        conn = database.connect()
+        migrate(conn)
+        conn.executemany('INSERT INTO students (first_name, last_name, telegram_id) VALUES (?, ?, ?)',
+                         [('Ism', 'Familiya', telegram_id) for telegram_id in range(max(levels))])
+        conn.commit()
+        conn.close()
+
+        queue = WriteQueue(database)
+        print(f"{'students':>8} | {'per-transaction p50/p99 (ms)':>28} | {'group commit p50/p99 (ms)':>26}")
+        for concurrency in levels:
+            direct = await run_level(database.transaction, concurrency)
+            queued = await run_level(queue.submit, concurrency)
+            print(f"{concurrency:>8} | {direct[0] * 1000:>12.1f} / {direct[1] * 1000:<13.1f} | "
+                  f"{queued[0] * 1000:>11.1f} / {queued[1] * 1000:<12.1f}")
+        await queue.close()
+        database.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--levels', type=int, nargs='+', default=[10, 100, 500, 1000])
+    args = parser.parse_args()
+    asyncio.run(main(args.levels))
@@ -0,0 +1,151 @@
+"""Restart in the middle of an exam: the student carries on where they were.
+
+Runs main.py's application against a fresh database in a temporary
+directory and a fake Bot API. A student starts a test with --questions
+questions and answers some of them. Then the application is saved and
+thrown away, a new one is built (new persistence, nothing in memory) and
+the student answers the rest. The saved result must count every answer,
+and each save must write only the session keys that changed.
+
+Then the student starts the test again, and the test file is edited while
+the bot is down. After the restart their next answer must not be graded:
+the session is dropped, the conversation ends, and a fresh start of the
+test must be graded against the edited questions.
+
+    python benchmarks/persistence_smoke.py [--questions 20] [--before-restart 10]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main as bot  # noqa: E402
+from callback_tokens import callback_tokens  # noqa: E402
+from database import db, write_queue  # noqa: E402
+from migrations import ensure_schema  # noqa: E402
+from question_bank import bank_cache  # noqa: E402
+from smoke_fixtures import FILE_NAME, STUDENT, answer, callback, seed  # noqa: E402
+from webhook_smoke import FakeBotApi  # noqa: E402
+
+
+def saved(conn):
+    return conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM persisted_user_data').fetchone()
+
+
+def result(conn):
+    return conn.execute('SELECT correct_answers, total_questions FROM students_results').fetchone()
+
+
+def results(conn):
+    return conn.execute('SELECT correct_answers, total_questions FROM students_results ORDER BY id').fetchall()
+
+
+def edit_test(conn):
+    import question_bank
+
+    # One more test in the file: a new version of the bank
+    question_bank.add_test(conn, FILE_NAME, {'questions': ['1 + 1 = ?'], 'answers': [['a) 2', 'b) 3']],
+                                             'correct_answers': ['a']})
+
+
+def session_rows(conn):
+    return conn.execute('SELECT (SELECT COUNT(*) FROM persisted_user_data), '
+                        '(SELECT COUNT(*) FROM persisted_conversations)').fetchone()
+
+
+async def main(questions, before_restart):
+    api = FakeBotApi()
+    os.environ.update(TELEGRAM_API_URL=f"http://127.0.0.1:{await api.start()}/bot",
+                      TELEGRAM_BOT_TOKEN='123456:TEST', ADMIN_TELEGRAM_ID='1', PROGRESS_INDICATOR='0')
+    os.chdir(tempfile.mkdtemp())
+
+    # test_bot.db is opened in the current directory on first use
+    await ensure_schema()
+    await db.transaction(seed, questions)
+    update_ids = iter(range(1, 10 ** 6))
+    sizes = []
+
+    async def press(application, data):
+        await application.process_update(callback(application, next(update_ids), data))
+
+    async def save(application):
+        # What the application does every PERSISTENCE_INTERVAL seconds
+        await application.update_persistence()
+        sizes.append(tuple(await db.run(saved)))
+
+    application = bot.build_application()
+    await application.initialize()
+    await press(application, f"start_test_{await callback_tokens.encode(FILE_NAME)}")
+    await save(application)
+    for n in range(before_restart):
+        await press(application, f"answer_{answer(n)}")
+        await save(application)
+    stats = application.persistence.stats()
+    await application.shutdown()
+
+    # "Restart": a new application whose persistence has loaded nothing yet
+    application = bot.build_application()
+    await application.initialize()
+    await press(application, f"answer_{answer(before_restart)}")
+    resumed_at = application.user_data[STUDENT['id']].get('current_question')
+    await save(application)
+    for n in range(before_restart + 1, questions):
+        await press(application, f"answer_{answer(n)}")
+        await save(application)
+    loads = application.persistence.stats()['loads']
+    correct, total = await db.run(result) or (None, None)
+
+    # The student starts again and answers two questions before the bot goes down
+    await press(application, f"start_test_{await callback_tokens.encode(FILE_NAME)}")
+    for n in range(2):
+        await press(application, f"answer_{answer(n)}")
+    await save(application)
+    await application.shutdown()
+
+    # Edited while the bot was down: the saved session refers to the old version
+    await write_queue.submit(edit_test)
+    bank_cache.invalidate(FILE_NAME)
+    application = bot.build_application()
+    await application.initialize()
+    messages = api.calls.count('editMessageText')
+    await press(application, f"answer_{answer(2)}")
+    told = api.calls.count('editMessageText') - messages
+    expired = application.persistence.stats()['expired']
+    await save(application)
+    after_expiry = await db.run(session_rows)
+    # A fresh start grades the edited file (its first test is unchanged)
+    await press(application, f"start_test_{await callback_tokens.encode(FILE_NAME)}")
+    for n in range(questions):
+        await press(application, f"answer_{answer(n)}")
+    await save(application)
+    await application.shutdown()
+    await write_queue.close()
+    stored = await db.run(results)
+    db.close()
+    await api.stop()
+
+    rows, size = max(sizes)
+    print(f"resumed at question {resumed_at} after {before_restart} answers, session loads after restart: {loads}")
+    print(f"result: {correct}/{total} correct")
+    print(f"session in the database: {rows} rows, {size} bytes at most")
+    print(f"before restart: {stats['writes']} saves wrote {stats['rows_written']} rows "
+          f"({stats['rows_written'] / max(stats['writes'], 1):.1f} per save)")
+    print(f"test edited mid-exam: sessions dropped {expired}, student told {told} time(s), "
+          f"session and conversation rows left {tuple(after_expiry)}, results stored {len(stored)}")
+    ok = (resumed_at == before_restart + 1 and loads == 1 and (correct, total) == (questions, questions)
+          and expired == 1 and told == 1 and tuple(after_expiry) == (0, 0)
+          and [tuple(row) for row in stored] == [(questions, questions)] * 2)
+    print("ok" if ok else "FAIL")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--before-restart', type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(main(args.questions, args.before_restart)) else 1)
@@ -0,0 +1,164 @@
+"""A test sent as quiz polls, answered out of order across a restart.
+
+Runs main.py's application against a fresh database in a temporary directory
+and a fake Bot API. A student asks for a --questions question test as a quiz
+and gets one poll per question (sent within the usual per-chat limit of one
+message a second). They answer the polls in reverse order, one of them
+wrongly and one of them twice; halfway through the bot is restarted. The
+stored result must count each answer once, with one attempt_answers row per
+question, and the student must get one result message.
+
+Then the student starts the quiz, and starts it again as soon as the first
+poll arrives: the replaced attempt must stop sending. Finally the student
+starts it once more but only two of its polls can be
+delivered: the attempt must be marked failed, the student told once, and
+answers to the delivered polls must not store a result.
+
+    python benchmarks/quiz_smoke.py [--questions 10]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main as bot  # noqa: E402
+from callback_tokens import callback_tokens  # noqa: E402
+from database import db, write_queue  # noqa: E402
+from migrations import ensure_schema  # noqa: E402
+from smoke_fixtures import FILE_NAME, LETTERS, callback, poll_answer, seed  # noqa: E402
+from webhook_smoke import FakeBotApi  # noqa: E402
+
+
+def sent_polls(conn):
+    return conn.execute('SELECT poll_id, correct_option FROM quiz_polls ORDER BY position').fetchall()
+
+
+def result(conn):
+    return conn.execute('SELECT correct_answers, total_questions FROM students_results').fetchone()
+
+
+def answer_rows(conn):
+    # (rows, correct rows, rows answered with the seeded correct letter)
+    return tuple(conn.execute('''
+    SELECT COUNT(*), SUM(is_correct), SUM(chosen_option = substr(?, question_index % 4 + 1, 1))
+    FROM attempt_answers
+    ''', (LETTERS,)).fetchone())
+
+
+def last_attempt(conn):
+    return conn.execute('SELECT id, status FROM quiz_attempts ORDER BY id DESC LIMIT 1').fetchone()
+
+
+def attempt_polls(conn, attempt_id):
+    return conn.execute('SELECT poll_id, correct_option FROM quiz_polls WHERE attempt_id = ?', (attempt_id,)).fetchall()
+
+
+def result_count(conn):
+    return conn.execute('SELECT COUNT(*) FROM students_results').fetchone()[0]
+
+
+async def main(questions):
+    api = FakeBotApi()
+    os.environ.update(TELEGRAM_API_URL=f"http://127.0.0.1:{await api.start()}/bot",
+                      TELEGRAM_BOT_TOKEN='123456:TEST', ADMIN_TELEGRAM_ID='1', PROGRESS_INDICATOR='0')
+    # test_bot.db is opened in the current directory on first use
+    os.chdir(tempfile.mkdtemp())
+    await ensure_schema()
+    await db.transaction(seed, questions)
+    update_ids = iter(range(1, 10 ** 6))
+
+    def press(application, data):
+        return callback(application, next(update_ids), data)
+
+    def vote(application, poll_id, option):
+        return poll_answer(application, next(update_ids), poll_id, option)
+
+    application = bot.build_application()
+    await application.initialize()
+    # Running, so the background poll sends are awaited on stop
+    await application.start()
+    start = time.perf_counter()
+    await application.process_update(press(application, f"quiz_test_{await callback_tokens.encode(FILE_NAME)}"))
+    handler_time = time.perf_counter() - start
+    while len(await db.run(sent_polls)) < questions and time.perf_counter() - start < questions * 2 + 10:
+        await asyncio.sleep(0.05)
+    send_time = time.perf_counter() - start
+    polls_sent = api.calls.count('sendPoll')
+
+    polls = list(reversed(await db.run(sent_polls)))
+    answers = [(poll_id, correct) for poll_id, correct in polls]
+    answers[0] = (answers[0][0], (answers[0][1] + 1) % 4)   # one wrong answer
+    answers.insert(1, answers[0])                            # and the same poll answered twice
+    half = len(answers) // 2
+    for poll_id, option in answers[:half]:
+        await application.process_update(vote(application, poll_id, option))
+    await application.stop()
+    await application.shutdown()
+
+    # "Restart": the remaining answers reach a new application
+    application = bot.build_application()
+    await application.initialize()
+    for poll_id, option in answers[half:]:
+        await application.process_update(vote(application, poll_id, option))
+    correct, total = await db.run(result) or (None, None)
+    answered = await db.run(answer_rows)
+    result_messages = api.calls.count('sendMessage')
+
+    # Started again once the first poll arrived: the rest of that attempt is not sent
+    await application.start()
+    restart_calls = api.calls.count('sendPoll')
+    await application.process_update(press(application, f"quiz_test_{await callback_tokens.encode(FILE_NAME)}"))
+    first_id, _ = await db.run(last_attempt)
+    deadline = time.perf_counter() + 30
+    while not await db.run(attempt_polls, first_id) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.02)
+    await application.process_update(press(application, f"quiz_test_{await callback_tokens.encode(FILE_NAME)}"))
+    second_id, _ = await db.run(last_attempt)
+    deadline = time.perf_counter() + questions * 2 + 10
+    while len(await db.run(attempt_polls, second_id)) < questions and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    replaced_polls = len(await db.run(attempt_polls, first_id))
+    restart_polls = api.calls.count('sendPoll') - restart_calls
+
+    # Delivery breaks after two polls
+    api.fail('sendPoll', after=2)
+    await application.process_update(press(application, f"quiz_test_{await callback_tokens.encode(FILE_NAME)}"))
+    deadline = time.perf_counter() + 30
+    while (await db.run(last_attempt))['status'] == 'open' and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    attempt_id, status = await db.run(last_attempt)
+    for poll_id, option in await db.run(attempt_polls, attempt_id):
+        await application.process_update(vote(application, poll_id, option))
+    # Waits for the quiz task, which tells the student after marking the attempt
+    await application.stop()
+    told = api.calls.count('sendMessage') - result_messages
+    await application.shutdown()
+    await write_queue.close()
+    results_stored = await db.run(result_count)
+    db.close()
+    await api.stop()
+
+    print(f"quiz button handled in {handler_time * 1000:.1f} ms, {polls_sent} polls "
+          f"sent in {send_time:.1f} s")
+    print(f"result: {correct}/{total} correct, answers stored (rows, correct, letters as seeded): {answered}, "
+          f"result messages: {result_messages}")
+    print(f"restarted quiz: {replaced_polls} poll(s) of the replaced attempt sent, {restart_polls} in all")
+    print(f"failed delivery: attempt {status}, student told {told} time(s), results stored {results_stored}")
+    ok = ((correct, total) == (questions - 1, questions) and result_messages == 1
+          and answered == (questions, questions - 1, questions - 1)
+          and replaced_polls <= 2 and restart_polls <= questions + 2
+          and status == 'failed' and told == 1 and results_stored == 1)
+    print("ok" if ok else "FAIL")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(main(args.questions)) else 1)
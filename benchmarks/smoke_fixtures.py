@@ -0,0 +1,52 @@
+"""Students, a seeded test and Telegram updates shared by the smoke scripts.
+
+The test has one question per number n ("n + n = ?") with options a-d and
+LETTERS[n % 4] as the correct answer, so answer(n) is always right.
+"""
+from telegram import Update
+
+STUDENT = {'id': 1001, 'is_bot': False, 'first_name': 'Ali'}
+FILE_NAME = 'algebra_9_sinf.json'
+LETTERS = 'abcd'
+
+
+def answer(number):
+    """The correct letter of question number (from 0) of the seeded test"""
+    return LETTERS[number % 4]
+
+
+def seed(conn, questions, students=(STUDENT,)):
+    """Add a --questions question test as FILE_NAME and assign it to each student"""
+    import question_bank
+    from assignments import assign_test
+
+    question_bank.add_test(conn, FILE_NAME, {
+        'questions': [f"{n} + {n} = ?" for n in range(questions)],
+        'answers': [[f"{letter}) {n + i}" for i, letter in enumerate(LETTERS)] for n in range(questions)],
+        'correct_answers': [answer(n) for n in range(questions)],
+    })
+    for number, user in enumerate(students):
+        student_id = conn.execute('INSERT INTO students (first_name, last_name, telegram_id) VALUES (?, ?, ?)',
+                                  (user['first_name'], f"Familiya{number}", user['id'])).lastrowid
+        assign_test(conn, student_id, FILE_NAME)
+
+
+def chat(user):
+    return {'id': user['id'], 'type': 'private'}
+
+
+def callback(application, update_id, data, user=STUDENT):
+    return Update.de_json({'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': 'smoke', 'data': data,
+        'message': {'message_id': 1, 'date': 0, 'text': '...', 'chat': chat(user)}}}, application.bot)
+
+
+def message(application, update_id, text, user=STUDENT):
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text, 'from': user, 'chat': chat(user)}}, application.bot)
+
+
+def poll_answer(application, update_id, poll_id, option, user=STUDENT):
+    return Update.de_json({'update_id': update_id, 'poll_answer': {
+        'poll_id': poll_id, 'user': user, 'option_ids': [option],
+        'option_persistent_ids': [LETTERS[option]]}}, application.bot)
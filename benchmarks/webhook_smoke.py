@@ -0,0 +1,230 @@
+"""Webhook mode end to end against a fake Bot API: secret check, back-pressure and draining.
+
+The bot runs serve_webhook() with TELEGRAM_API_URL pointing at a local fake
+Bot API and the bot's own update processor (build_update_processor, with
+MAX_PENDING_UPDATES set to --max-pending). Updates are POSTed with the right,
+a wrong and no secret token, then --updates updates from ten users arrive
+at once: no more than --max-pending may be in flight, the rest back up into
+the queue, which answers 503 once full. The bot is stopped while updates
+are still queued; every accepted update must have been handled by the time
+serve_webhook() returns. Finally a drain that times out must cancel and
+report the updates still running, without leaving handlers unawaited.
+
+    python benchmarks/webhook_smoke.py [--updates 100] [--queue-size 20] [--max-pending 32] [--handler-delay 0.2]
+"""
+import argparse
+import asyncio
+import json
+import gc
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import Application, MessageHandler, filters  # noqa: E402
+
+from update_processor import build_update_processor  # noqa: E402
+from webhook import WebhookServer, apply_api_url, serve_webhook  # noqa: E402
+
+TOKEN = '123456:TEST'
+SECRET = 'smoke-secret'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Smoke', 'username': 'smoke_bot'}
+
+
+class FakeBotApi:
+    """Answers Bot API calls with canned results and remembers which methods were called"""
+
+    def __init__(self):
+        self.calls = []
+        self._failing = {}  # method -> calls still answered before it fails
+
+    def fail(self, method, after=0):
+        """Answer ``method`` with a Bad Request once it has succeeded ``after`` more times"""
+        self._failing[method] = after
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method = line.decode().split()[1].rsplit('/', 1)[-1]
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get('content-length', 0)))
+                self.calls.append(method)
+                if self._failing.get(method, 1) == 0:
+                    body = json.dumps({'ok': False, 'error_code': 400,
+                                       'description': 'Bad Request: chat not found'}).encode()
+                    writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Type: application/json\r\n'
+                                 b'Content-Length: %d\r\n\r\n' % len(body) + body)
+                    await writer.drain()
+                    continue
+                if method in self._failing:
+                    self._failing[method] -= 1
+                if method == 'getMe':
+                    result = BOT_USER
+                elif method == 'sendMessage':
+                    result = {'message_id': len(self.calls), 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+                elif method == 'sendPoll':
+                    result = {'message_id': len(self.calls), 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                              'poll': {'id': f"poll{len(self.calls)}", 'question': '?', 'type': 'quiz',
+                                       'options': [{'text': text, 'voter_count': 0, 'persistent_id': text}
+                                                   for text in 'ab'],
+                                       'total_voter_count': 0, 'is_closed': False, 'is_anonymous': False,
+                                       'allows_multiple_answers': False, 'allows_revoting': False,
+                                       'members_only': False}}
+                else:
+                    result = True
+                body = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(body) + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def post(port, path, body, secret=None):
+    """POST one update on a fresh connection and return the HTTP status"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    headers = f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+    if secret is not None:
+        headers += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+    writer.write(headers.encode() + b'\r\n' + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+
+def update(update_id):
+    # From ten users, so the per-user processor runs them concurrently
+    user_id = 1 + update_id % 10
+    return json.dumps({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': f'salom {update_id}',
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Ali'}}}).encode()
+
+
+def build(handler_delay, handled):
+    application = (apply_api_url(Application.builder().token(TOKEN))
+                   .concurrent_updates(build_update_processor()).build())
+
+    async def echo(update, context):
+        await asyncio.sleep(handler_delay)
+        handled.append(update.update_id)
+
+    application.add_handler(MessageHandler(filters.TEXT, echo))
+    return application
+
+
+async def drain_timeout(queue_size):
+    """Updates that cannot finish in time are cancelled and counted, not silently dropped"""
+    handled = []
+    application = build(60, handled)
+    await application.initialize()
+    server = WebhookServer(application, SECRET, port=0, queue_size=queue_size)
+    await server.start()
+    statuses = await asyncio.gather(*(post(server.port, server.path, update(i), SECRET) for i in range(1, 11)))
+    while server.stats()['running'] < statuses.count(200):
+        await asyncio.sleep(0.01)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        given_up = await server.drain(timeout=0.2)
+        gc.collect()
+    await application.shutdown()
+    unawaited = [w for w in caught if 'never awaited' in str(w.message)]
+    return statuses.count(200), given_up, len(handled), len(unawaited)
+
+
+async def main(updates, queue_size, max_pending, handler_delay):
+    api = FakeBotApi()
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{await api.start()}/bot"
+    os.environ['MAX_PENDING_UPDATES'] = str(max_pending)
+    handled = []
+    application = build(handler_delay, handled)
+
+    # Capture the server serve_webhook creates, to find its port and read its stats
+    servers = []
+    original_start = WebhookServer.start
+
+    async def start(self):
+        await original_start(self)
+        servers.append(self)
+
+    WebhookServer.start = start
+    stop = asyncio.Event()
+    serving = asyncio.create_task(serve_webhook(application, 'https://example.com/telegram', SECRET, port=0,
+                                                queue_size=queue_size, stop_event=stop))
+    while not servers or not application.running:
+        await asyncio.sleep(0.01)
+    server = servers[0]
+    path = server.path
+
+    checks = {
+        'wrong path -> 404': await post(server.port, '/other', update(1), SECRET) == 404,
+        'no secret -> 403': await post(server.port, path, update(1)) == 403,
+        'wrong secret -> 403': await post(server.port, path, update(1), 'guess') == 403,
+        'bad json -> 400': await post(server.port, path, b'{not json', SECRET) == 400,
+    }
+
+    peak = {'running': 0, 'queued': 0}
+
+    async def watch():
+        while True:
+            stats = server.stats()
+            for key in peak:
+                peak[key] = max(peak[key], stats[key])
+            await asyncio.sleep(0.005)
+
+    watcher = asyncio.create_task(watch())
+    statuses = []
+    # In waves, so the consumer runs in between while the handlers are still busy
+    for first in range(1, updates + 1, 10):
+        wave = range(first, min(first + 10, updates + 1))
+        statuses += await asyncio.gather(*(post(server.port, path, update(i), SECRET) for i in wave))
+        await asyncio.sleep(0.01)
+    watcher.cancel()
+    accepted = sorted(i for i, status in zip(range(1, updates + 1), statuses) if status == 200)
+    checks['in flight capped by the update processor'] = 0 < peak['running'] <= max_pending
+    checks['full queue -> 503'] = 503 in statuses
+    checks['only 200 or 503'] = set(statuses) <= {200, 503}
+
+    stop.set()
+    await serving
+    checks['setWebhook called'] = 'setWebhook' in api.calls
+    checks['every accepted update handled after drain'] = sorted(handled) == accepted
+    timed_out, given_up, finished, unawaited = await drain_timeout(queue_size)
+    checks['timed-out drain reports every unfinished update'] = given_up == timed_out and finished == 0
+    checks['no handler left unawaited'] = unawaited == 0
+    await api.stop()
+
+    print(f"posted {updates}, accepted {len(accepted)}, rejected with 503: {statuses.count(503)}, "
+          f"handled {len(handled)}, at most {peak['running']} in flight and {peak['queued']} queued")
+    print(f"drain timeout: {timed_out} accepted, {given_up} cancelled and reported")
+    for name, ok in checks.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    return all(checks.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=100)
+    parser.add_argument('--queue-size', type=int, default=20)
+    parser.add_argument('--max-pending', type=int, default=32)
+    parser.add_argument('--handler-delay', type=float, default=0.2)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(main(args.updates, args.queue_size, args.max_pending, args.handler_delay)) else 1)
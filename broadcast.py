@@ -0,0 +1,127 @@
+# Sending one message to many chats without tripping Telegram's flood limits.
+#
+# Telegram allows roughly 30 messages per second per bot and about one per
+# second to the same chat; beyond that it answers 429 with retry_after. Sends
+# go through a global token bucket and a per-chat spacing check, so callers
+# may run them concurrently (the outbox sends a claimed chunk at once), and a
+# RetryAfter pauses the whole bot for the requested time before the message
+# is retried.
+import asyncio
+import datetime
+import logging
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 25          # messages per second, a little under Telegram's ~30
+GLOBAL_BURST = 5          # rate + burst stays within 30 in any one second
+PER_CHAT_INTERVAL = 1.0   # seconds between two messages to the same chat
+MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``capacity`` saved up"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Hand out no tokens for ``seconds`` (used when Telegram asks us to back off)"""
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+        self._tokens = 0
+
+
+class ChatLimiter:
+    """Keeps messages to the same chat at least ``interval`` seconds apart"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_send = {}
+
+    async def wait(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # Forget chats that are free again, so the dict stays small
+        if len(self._next_send) > 10000:
+            self._next_send = {chat: t for chat, t in self._next_send.items() if t > now}
+        send_at = max(now, self._next_send.get(chat_id, 0.0))
+        self._next_send[chat_id] = send_at + self.interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+
+def _seconds(retry_after):
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Broadcaster:
+    """Rate-limited sender shared by everything that messages students in bulk"""
+
+    def __init__(self, rate=GLOBAL_RATE, burst=GLOBAL_BURST, per_chat_interval=PER_CHAT_INTERVAL,
+                 max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.bucket = TokenBucket(rate, burst)
+        self.chats = ChatLimiter(per_chat_interval)
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        """Send one message within the limits, retrying flood waits and network errors.
+
+        Returns True if it was delivered. Errors that retrying cannot fix
+        (blocked bot, unknown chat) are raised to the caller.
+        """
+        delivered, _ = await self._deliver(bot.send_message, chat_id, text=text, **kwargs)
+        return delivered
+
+    async def send_poll(self, bot, chat_id, question, options, **kwargs):
+        """Send one poll the same way as ``send``. Returns the sent Message, or None if it was not delivered."""
+        _, message = await self._deliver(bot.send_poll, chat_id, question=question, options=options, **kwargs)
+        return message
+
+    async def _deliver(self, method, chat_id, **kwargs):
+        """(True, what ``method`` returned) once it succeeds, (False, None) after max_attempts"""
+        for attempt in range(1, self.max_attempts + 1):
+            await self.chats.wait(chat_id)
+            await self.bucket.acquire()
+            try:
+                return True, await method(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                delay = _seconds(e.retry_after)
+                logger.warning(f"Flood limit hit sending to {chat_id}, pausing {delay:.0f}s")
+                self.bucket.pause(delay)
+            except BadRequest:
+                raise
+            except NetworkError:
+                # Timeouts and connection errors; BadRequest is a NetworkError too, hence above
+                if attempt == self.max_attempts:
+                    raise
+                await asyncio.sleep(2 ** (attempt - 1))
+        return False, None
+
+
+# Shared sender, so concurrent broadcasts share one rate limit
+broadcaster = Broadcaster()
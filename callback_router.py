@@ -0,0 +1,148 @@
+# Dispatching inline-button presses by their callback data.
+#
+# Routes are given as a table: plain keys match the callback data exactly,
+# keys ending in '*' match every callback data starting with the rest of the
+# key. The table is compiled once into a dict (exact keys) and a prefix trie,
+# so a press costs one dict lookup plus a walk over at most the length of the
+# data, however many routes there are. Tables where one route could shadow
+# another (a prefix of another prefix, an exact key under a prefix, the same
+# key twice) are rejected when the router is built.
+#
+# Every route counts its presses and keeps a latency histogram, shown by /stats.
+import bisect
+import time
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_END = object()  # trie key marking the end of a prefix route
+
+
+class RouteStats:
+    """Press count and latency histogram of one route"""
+
+    __slots__ = ('count', 'errors', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds, failed=False):
+        ms = seconds * 1000
+        self.count += 1
+        self.errors += failed
+        self.total += ms
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of presses (None: above the last bucket)"""
+        threshold = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), self.buckets):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return None
+
+
+class CallbackRouter:
+    """Maps callback data to handlers through a compiled route table"""
+
+    def __init__(self, routes):
+        self._exact = {}
+        self._trie = {}
+        self.stats = {}
+        self.unknown = 0
+        prefixes = []
+        for key, handler in routes.items():
+            if key.endswith('*'):
+                prefixes.append((key[:-1], key, handler))
+            else:
+                self._exact[key] = (key, handler)
+            self.stats[key] = RouteStats()
+
+        for prefix, key, handler in sorted(prefixes):
+            if not prefix:
+                raise ValueError(f"Callback route {key!r} matches everything")
+            node = self._trie
+            for char in prefix:
+                if _END in node:
+                    raise ValueError(f"Callback route {key!r} is shadowed by {node[_END][0]!r}")
+                node = node.setdefault(char, {})
+            # Sorted order puts a prefix before the longer prefixes it would shadow
+            node[_END] = (key, handler)
+
+        for data in self._exact:
+            match = self._match_prefix(data)
+            if match is not None:
+                raise ValueError(f"Callback route {data!r} is also matched by {match[0]!r}")
+
+    def _match_prefix(self, data):
+        node = self._trie
+        for char in data:
+            if _END in node:
+                return node[_END]
+            node = node.get(char)
+            if node is None:
+                return None
+        return node.get(_END)
+
+    def resolve(self, data):
+        """Return (route key, handler) for the callback data, or None if no route matches"""
+        route = self._exact.get(data)
+        if route is None:
+            route = self._match_prefix(data)
+        return route
+
+    async def dispatch(self, update, context, default=None):
+        """Run the handler of the pressed button and return its result.
+
+        Unknown callback data goes to ``default`` if given, else returns None.
+        """
+        route = self.resolve(update.callback_query.data)
+        if route is None:
+            self.unknown += 1
+            return await default(update, context) if default is not None else None
+        key, handler = route
+        return await self._timed(self.stats[key], handler, update, context)
+
+    def track(self, key, handler):
+        """Wrap a handler registered elsewhere (a conversation state) so its presses are measured too"""
+        stats = self.stats.setdefault(key, RouteStats())
+
+        async def tracked(update, context):
+            return await self._timed(stats, handler, update, context)
+
+        return tracked
+
+    @staticmethod
+    async def _timed(stats, handler, update, context):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(update, context)
+            failed = False
+            return result
+        finally:
+            stats.record(time.perf_counter() - start, failed)
+
+    def report(self, limit=10):
+        """Busiest routes first, as stats text for admins"""
+        used = sorted(((key, stats) for key, stats in self.stats.items() if stats.count),
+                      key=lambda item: item[1].count, reverse=True)
+        lines = []
+        for key, stats in used[:limit]:
+            p95 = stats.percentile(0.95)
+            p95 = f"≤{p95} ms" if p95 is not None else f">{LATENCY_BUCKETS[-1]} ms"
+            line = f"{key}: {stats.count} marta, o'rtacha {stats.mean():.0f} ms, p95 {p95}"
+            if stats.errors:
+                line += f", xatolar: {stats.errors}"
+            lines.append(line)
+        if self.unknown:
+            lines.append(f"Noma'lum tugmalar: {self.unknown}")
+        return "\n".join(lines)
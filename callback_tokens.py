@@ -0,0 +1,153 @@
+# Compact callback data for buttons that refer to a test file or a test.
+#
+# Buttons used to embed the file name (select_file_{file}) and handlers got
+# it back with split('_')[-1], which broke on names containing '_', and long
+# names ran into Telegram's 64-byte callback data limit. Now the button
+# carries a short token instead: callback_data=f"select_file_{token}".
+#
+# A token is the base-36 row id of the arguments in callback_tokens, so the
+# same arguments always get the same token and tokens survive restarts.
+# Lookups are answered from memory after the first one. Tokens not handed out
+# for CALLBACK_TOKEN_TTL_DAYS are deleted at startup; such an old button then
+# reports that the menu expired. Row ids are never reused (AUTOINCREMENT), so
+# an old token can never decode to different arguments.
+import json
+import time
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import db
+
+CALLBACK_TOKEN_TTL_DAYS = 30
+CALLBACK_TOKEN_CACHE_SIZE = 10000
+TOUCH_INTERVAL = 3600  # seconds before a token handed out again is re-dated in the table
+
+CALLBACK_TOKENS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS callback_tokens (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL UNIQUE,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_callback_tokens_last_used ON callback_tokens (last_used);
+'''
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _base36(number):
+    token = ''
+    while True:
+        number, digit = divmod(number, 36)
+        token = DIGITS[digit] + token
+        if not number:
+            return token
+
+
+def _payload(args):
+    return json.dumps(list(args), ensure_ascii=False, separators=(',', ':'))
+
+
+def _register(conn, payloads, now):
+    ids = []
+    for payload in payloads:
+        ids.append(conn.execute('''
+        INSERT INTO callback_tokens (payload, last_used) VALUES (?, ?)
+        ON CONFLICT(payload) DO UPDATE SET last_used = excluded.last_used
+        RETURNING id
+        ''', (payload, now)).fetchone()[0])
+    return ids
+
+
+def _lookup(conn, row_id):
+    row = conn.execute('SELECT payload FROM callback_tokens WHERE id = ?', (row_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _prune(conn, cutoff):
+    return conn.execute('DELETE FROM callback_tokens WHERE last_used < ?', (cutoff,)).rowcount
+
+
+class CallbackTokens:
+    """Two-way map between argument tuples and short tokens"""
+
+    def __init__(self, database=db, max_size=CALLBACK_TOKEN_CACHE_SIZE):
+        self.database = database
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._tokens = OrderedDict()    # payload -> (token, time it was last dated in the table)
+        self._arguments = OrderedDict()  # token -> argument tuple
+
+    async def encode(self, *args):
+        """Token for one button's arguments"""
+        return (await self.encode_many([args]))[0]
+
+    async def encode_many(self, arguments):
+        """Tokens for a list of argument tuples (one per button), in the same order"""
+        now = time.time()
+        payloads = [_payload(args) for args in arguments]
+        tokens = {}
+        missing = []
+        for payload in dict.fromkeys(payloads):
+            cached = self._tokens.get(payload)
+            if cached is not None and now - cached[1] < TOUCH_INTERVAL:
+                self._tokens.move_to_end(payload)
+                tokens[payload] = cached[0]
+            else:
+                missing.append(payload)
+
+        if missing:
+            ids = await self.database.transaction(_register, missing, now)
+            for payload, row_id in zip(missing, ids):
+                token = tokens[payload] = _base36(row_id)
+                self._remember(self._tokens, payload, (token, now))
+                self._remember(self._arguments, token, tuple(json.loads(payload)))
+        return [tokens[payload] for payload in payloads]
+
+    async def decode(self, data):
+        """Arguments of the token at the end of ``data`` (after the last '_'), or None if unknown or expired"""
+        token = data.rsplit('_', 1)[-1]
+        args = self._arguments.get(token)
+        if args is not None:
+            self._arguments.move_to_end(token)
+            self.hits += 1
+            return args
+
+        self.misses += 1
+        try:
+            row_id = int(token, 36)
+        except ValueError:
+            return None
+        payload = await self.database.run(_lookup, row_id)
+        if payload is None:
+            return None
+        args = tuple(json.loads(payload))
+        self._remember(self._arguments, token, args)
+        return args
+
+    async def prune(self):
+        """Delete tokens not handed out for CALLBACK_TOKEN_TTL_DAYS. Returns how many were deleted."""
+        self._tokens.clear()
+        self._arguments.clear()
+        return await self.database.transaction(_prune, time.time() - CALLBACK_TOKEN_TTL_DAYS * 86400)
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._arguments)}
+
+
+async def show_expired(query):
+    """Answer a button whose token is no longer known"""
+    keyboard = [[InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]]
+    await query.edit_message_text("Bu tugma eskirgan. Iltimos, menyuni qaytadan oching.",
+                                  reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+# Shared by every handler that builds or reads such buttons
+callback_tokens = CallbackTokens()
@@ -0,0 +1,48 @@
+# Bot settings from the environment (and a .env file in the working directory).
+#
+# Nothing is read when this module is imported. The first use of a setting
+# loads .env once and keeps the values for the life of the process, so
+# importing a handler module has no side effects and an admin check is a set
+# lookup. ADMIN_TELEGRAM_ID may list several ids separated by commas.
+import os
+
+from dotenv import load_dotenv
+
+
+class Config:
+    """Settings loaded on first use"""
+
+    def __init__(self):
+        self._token = None
+        self._admin_ids = None
+
+    def load(self):
+        """Read .env and the environment, once"""
+        if self._admin_ids is not None:
+            return
+        load_dotenv()
+        admins = os.getenv('ADMIN_TELEGRAM_ID')
+        if not admins:
+            raise ValueError("No admin provided. Set ADMIN_TELEGRAM_ID in .env file.")
+        self._token = os.getenv('TELEGRAM_BOT_TOKEN')
+        self._admin_ids = frozenset(int(admin) for admin in admins.split(',') if admin.strip())
+
+    @property
+    def token(self):
+        self.load()
+        if not self._token:
+            raise ValueError("No token provided. Set TELEGRAM_BOT_TOKEN in .env file.")
+        return self._token
+
+    @property
+    def admin_ids(self):
+        self.load()
+        return self._admin_ids
+
+
+# Shared by both bots and every handler module
+config = Config()
+
+
+def is_admin(user_id):
+    return user_id in config.admin_ids
@@ -0,0 +1,217 @@
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DB_PATH = 'test_bot.db'
+DEFAULT_POOL_SIZE = 4
+WRITE_BATCH_SIZE = 256
+WRITE_BATCH_DELAY = 0.005
+
+
+class Database:
+    """Async access to SQLite through a bounded pool of long-lived connections.
+
+    Every query runs on one of ``pool_size`` worker threads, each of which owns
+    a single connection for its whole life, so handlers never block the event
+    loop and never pay for opening a connection per query.
+    """
+
+    def __init__(self, path=DB_PATH, pool_size=DEFAULT_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._executor = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.schema_ready = False  # set by migrations.ensure_schema
+
+    def connect(self):
+        """Open a new raw connection (used by the pool and by synchronous setup code)."""
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # WAL itself is switched on by migrations.migrate; these are per connection.
+        # NORMAL may lose the last commits on power loss (never corrupts); WriteQueue
+        # batches, which callers are told are saved, are committed with FULL.
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, func, args):
+        conn = self._connection()
+        try:
+            return func(conn, *args)
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+    async def run(self, func, *args):
+        """Run ``func(conn, *args)`` on a pooled connection in a worker thread."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='db')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Execute a single write statement and commit it. Returns the last row id."""
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).lastrowid
+        return await self.run(_execute)
+
+    async def executemany(self, sql, seq_of_params):
+        def _executemany(conn):
+            with conn:
+                return conn.executemany(sql, seq_of_params).rowcount
+        return await self.run(_executemany)
+
+    async def transaction(self, func, *args):
+        """Run ``func(conn, *args)`` inside a single transaction and commit it."""
+        def _transaction(conn):
+            with conn:
+                return func(conn, *args)
+        return await self.run(_transaction)
+
+    def close(self):
+        """Wait for queued queries to finish, then close every pooled connection."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class WriteQueue:
+    """Group commit for writes that arrive in bursts, e.g. a whole class finishing a test.
+
+    Handlers ``await submit(func, *args)``; a single writer task collects
+    everything submitted within ``max_delay`` seconds (up to ``max_batch``
+    jobs) and runs the batch as one transaction. Each job gets its own
+    savepoint, so a failing job is rolled back and reported to its caller
+    without affecting the rest of the batch. ``submit`` only returns once the
+    transaction holding the job has been committed and synced to disk
+    (synchronous = FULL), so it survives a power loss; group commit spreads
+    that fsync over the whole batch.
+    """
+
+    def __init__(self, database, max_batch=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY):
+        self.database = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self._task = None
+        self._closed = False
+
+    async def submit(self, func, *args):
+        """Queue ``func(conn, *args)`` for the next batch and return its result once committed"""
+        if self._closed:
+            raise RuntimeError("Write queue is closed")
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((func, args, future))
+        return await future
+
+    async def close(self):
+        """Stop accepting writes and wait until everything already queued is committed"""
+        self._closed = True
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        first = await self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._next_batch()
+            if batch:
+                await self._commit(batch)
+
+    async def _commit(self, batch):
+        try:
+            outcomes = await self.database.run(self._apply, batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), (ok, value) in zip(batch, outcomes):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    @staticmethod
+    def _apply(conn, batch):
+        outcomes = []
+        # Batches may run on any pooled connection; the other writes there keep NORMAL
+        conn.execute('PRAGMA synchronous = FULL')
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            with conn:
+                for func, args, _ in batch:
+                    conn.execute('SAVEPOINT job')
+                    try:
+                        value = func(conn, *args)
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO job')
+                        conn.execute('RELEASE job')
+                        outcomes.append((False, e))
+                    else:
+                        conn.execute('RELEASE job')
+                        outcomes.append((True, value))
+        finally:
+            conn.execute('PRAGMA synchronous = NORMAL')
+        return outcomes
+
+
+# Shared database used by all handlers
+db = Database()
+
+# Shared group-commit queue for result submissions
+write_queue = WriteQueue(db)
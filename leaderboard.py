@@ -0,0 +1,99 @@
+# Materialized class leaderboard.
+#
+# class_leaderboard keeps one row of running totals per student. Triggers on
+# students and students_results keep it current on every insert, so the ranking
+# pages read a handful of index entries instead of aggregating all results.
+
+LEADERBOARD_SIZE = 10
+
+# Must match the indexed expression below for SQLite to use the index
+PERCENTAGE_SQL = 'CAST(total_correct AS FLOAT) / total_questions * 100'
+
+LEADERBOARD_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS class_leaderboard (
+    student_id INTEGER PRIMARY KEY,
+    tests_completed INTEGER NOT NULL DEFAULT 0,
+    total_correct INTEGER NOT NULL DEFAULT 0,
+    total_questions INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY(student_id) REFERENCES students(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_class_leaderboard_tests
+ON class_leaderboard (tests_completed DESC);
+
+CREATE INDEX IF NOT EXISTS idx_class_leaderboard_percentage
+ON class_leaderboard (({PERCENTAGE_SQL}) DESC);
+
+-- Backfill students and results recorded before the table existed
+INSERT OR IGNORE INTO class_leaderboard (student_id, tests_completed, total_correct, total_questions)
+SELECT s.id, COUNT(sr.id), COALESCE(SUM(sr.correct_answers), 0), COALESCE(SUM(sr.total_questions), 0)
+FROM students s
+LEFT JOIN students_results sr ON s.id = sr.student_id
+GROUP BY s.id;
+
+CREATE TRIGGER IF NOT EXISTS trg_class_leaderboard_student
+AFTER INSERT ON students
+BEGIN
+    INSERT OR IGNORE INTO class_leaderboard (student_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_class_leaderboard_result_insert
+AFTER INSERT ON students_results
+BEGIN
+    INSERT INTO class_leaderboard (student_id, tests_completed, total_correct, total_questions)
+    VALUES (NEW.student_id, 1, COALESCE(NEW.correct_answers, 0), COALESCE(NEW.total_questions, 0))
+    ON CONFLICT(student_id) DO UPDATE SET
+        tests_completed = tests_completed + 1,
+        total_correct = total_correct + excluded.total_correct,
+        total_questions = total_questions + excluded.total_questions;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_class_leaderboard_result_delete
+AFTER DELETE ON students_results
+BEGIN
+    UPDATE class_leaderboard SET
+        tests_completed = tests_completed - 1,
+        total_correct = total_correct - COALESCE(OLD.correct_answers, 0),
+        total_questions = total_questions - COALESCE(OLD.total_questions, 0)
+    WHERE student_id = OLD.student_id;
+END;
+'''
+
+
+def top_by_tests_completed(conn, limit=LEADERBOARD_SIZE):
+    return conn.execute('''
+    SELECT s.first_name, s.last_name, lb.tests_completed
+    FROM class_leaderboard lb
+    JOIN students s ON s.id = lb.student_id
+    ORDER BY lb.tests_completed DESC
+    LIMIT ?
+    ''', (limit,)).fetchall()
+
+
+def tests_completed_rank(conn, telegram_id):
+    """Return (tests_completed, rank) for a student, ranking by tests completed
+
+    The rank counts idx_class_leaderboard_tests entries above the student's
+    value, so it costs O(log n + rank) index reads (no table rows), not O(log n).
+    """
+    row = conn.execute('''
+    SELECT lb.tests_completed
+    FROM class_leaderboard lb
+    JOIN students s ON s.id = lb.student_id
+    WHERE s.telegram_id = ?
+    ''', (telegram_id,)).fetchone()
+    tests_completed = row[0] if row else 0
+    rank = conn.execute('SELECT COUNT(*) + 1 FROM class_leaderboard WHERE tests_completed > ?',
+                        (tests_completed,)).fetchone()[0]
+    return tests_completed, rank
+
+
+def top_by_percentage(conn, limit=LEADERBOARD_SIZE):
+    return conn.execute(f'''
+    SELECT s.first_name, s.last_name, lb.total_correct, lb.total_questions,
+           {PERCENTAGE_SQL} AS percentage
+    FROM class_leaderboard lb
+    JOIN students s ON s.id = lb.student_id
+    ORDER BY {PERCENTAGE_SQL} DESC
+    LIMIT ?
+    ''', (limit,)).fetchall()
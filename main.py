@@ -1,11 +1,19 @@
 import json
-import sqlite3
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ConversationHandler
-import os
-from dotenv import load_dotenv
-import asyncio
-import signal
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, PollAnswerHandler, ContextTypes, filters, ConversationHandler
+from database import db, write_queue
+from migrations import ensure_schema
+from config import config, is_admin
+from question_bank import bank_cache
+import question_views
+from outbox import outbox_sender, outbox_stats
+from update_processor import build_update_processor
+from persistence import build_persistence, requires_session
+from webhook import apply_api_url, run
+from callback_router import CallbackRouter
+from callback_tokens import callback_tokens
+from students import student_cache
+from quiz_polls import quiz_sender
 
 # Import functions from other files
 from test_functions import (
@@ -16,72 +24,50 @@ from test_functions import (
 )
 from student_functions import (
     start_test, process_answer, register_student, process_name, process_surname,
-    select_test_file as student_select_test_file,
-    start_selected_test, ENTERING_NAME, ENTERING_SURNAME, view_available_tests, view_my_results, check_new_tests, view_class_ranking
+    start_selected_test, process_answer_key, start_quiz, ENTERING_NAME, ENTERING_SURNAME, view_available_tests, view_my_results, check_new_tests, view_class_ranking
 )
 
-# Load environment variables
-load_dotenv()
-
-# Get bot token and admin ID from environment variables
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-ADMIN_ID = int(os.getenv('ADMIN_TELEGRAM_ID'))
-
-# Update ADMIN_IDs list
-ADMIN_IDS = [ADMIN_ID]  # You can add more admin IDs here if needed
-
 # Define conversation states
 SELECTING_ACTION, CREATING_TEST_FILE, CREATING_TEST, ANSWERING_QUESTION = range(4)
 
-# Connect to SQLite database
-conn = sqlite3.connect('test_bot.db')
-cursor = conn.cursor()
-
-# Create tables if they don't exist
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS students (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    first_name TEXT,
-    last_name TEXT,
-    telegram_id INTEGER UNIQUE,
-    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS students_results (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    student_id INTEGER,
-    test_id INTEGER,
-    correct_answers INTEGER,
-    wrong_answers INTEGER,
-    total_questions INTEGER,
-    rank INTEGER,
-    FOREIGN KEY(student_id) REFERENCES students(id)
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS available_tests (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    student_id INTEGER,
-    test_file TEXT,
-    FOREIGN KEY(student_id) REFERENCES students(id)
-)
-''')
-
-conn.commit()
-conn.close()
-
-# Function to check if user is admin
-def is_admin(user_id):
-    return user_id in ADMIN_IDS
-
 # Command handlers
 async def testlarni_korish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /testlarni_korish command"""
     return await view_tests(update, context)
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /stats command: runtime counters for admins"""
+    if not is_admin(update.effective_user.id):
+        return
+    bank_stats = bank_cache.stats()
+    message = "Test fayllari keshi:\n"
+    message += f"Keshdan olindi: {bank_stats['hits']}\n"
+    message += f"Fayldan o'qildi: {bank_stats['misses']}\n"
+    message += f"Keshdagi fayllar: {bank_stats['files']}\n"
+    view_stats = question_views.stats()
+    message += f"Tayyor savollar: {view_stats['questions']} ({view_stats['banks']} ta fayl)\n"
+    queue_stats = await db.run(outbox_stats)
+    message += f"Navbatdagi xabarlar: {queue_stats['pending'] + queue_stats['sending']}, "
+    message += f"yetkazilmagan: {queue_stats['dead']}\n"
+    token_stats = callback_tokens.stats()
+    message += f"Tugma tokenlari: keshda {token_stats['cached']}, bazadan o'qildi: {token_stats['misses']}\n"
+    persistence_stats = context.application.persistence.stats()
+    message += f"Saqlangan sessiyalar: yuklandi {persistence_stats['loads']}, yozildi {persistence_stats['writes']}, "
+    message += f"test o'zgargani uchun bekor qilindi {persistence_stats['expired']}\n"
+    student_stats = student_cache.stats()
+    message += f"Talabalar keshi: {student_stats['hit_rate']:.0%} keshdan ({student_stats['hits']}/"
+    message += f"{student_stats['hits'] + student_stats['misses']}), keshda {student_stats['cached']}\n"
+    quiz_stats = quiz_sender.stats()
+    message += f"Viktorinalar: {quiz_stats['polls_sent']} ta savol yuborildi, {quiz_stats['answers']} ta javob, "
+    message += f"yakunlandi: {quiz_stats['finished']}, yuborib bo'lmadi: {quiz_stats['failed']}\n"
+    processor_stats = context.application.update_processor.stats()
+    message += f"Bir vaqtda ishlanayotgan so'rovlar: {processor_stats['running']} "
+    message += f"(eng ko'pi: {processor_stats['peak_running']}/{processor_stats['max_running']})"
+    routes = callback_router.report()
+    if routes:
+        message += f"\n\nTugmalar:\n{routes}"
+    await update.message.reply_text(message)
+
 # Start command handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -96,11 +82,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = InlineKeyboardMarkup(keyboard)
         message = f"Salom, {user.first_name}! Siz admin sifatida tizimga kirdingiz. Nima qilishni xohlaysiz?"
     else:
-        conn = sqlite3.connect('test_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM students WHERE telegram_id = ?', (user.id,))
-        student = cursor.fetchone()
-        conn.close()
+        student = await student_cache.get(user.id)
 
         if student:
             keyboard = [
@@ -109,7 +91,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton("Yangi testlar bormi?", callback_data="check_new_tests")],
                 [InlineKeyboardButton("Sinf reytingi", callback_data="view_class_ranking")]
             ]
-            message = f"Salom, {student[1]} {student[2]}! Nima qilishni xohlaysiz?"
+            message = f"Salom, {student.first_name} {student.last_name}! Nima qilishni xohlaysiz?"
         else:
             keyboard = [[InlineKeyboardButton("Ro'yxatdan o'tish", callback_data="register")]]
             message = "Salom! Test botiga xush kelibsiz. Iltimos, ro'yxatdan o'ting."
@@ -123,60 +105,57 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return SELECTING_ACTION
 
+# Inline buttons of the main menu flows; a trailing '*' matches by prefix
+callback_router = CallbackRouter({
+    "create_test": create_test,
+    "create_test_file": create_test_file,
+    "select_file_*": select_test_file,
+    "add_new_test": add_new_test,
+    "view_tests": view_tests,
+    "view_file_*": view_file_tests,
+    "delete_test_*": delete_test,
+    "delete_file_*": delete_test_file,
+    "view_results": view_results,
+    "send_test": send_test,
+    "send_file_*": process_send_test,
+    "send_to_*": confirm_send_test,
+    "cancel_send": cancel_send_test,
+    "register": register_student,
+    "solve_test": start_test,
+    "start_test": start_test,
+    "start_test_*": start_selected_test,
+    "quiz_test_*": start_quiz,
+    "view_available_tests": view_available_tests,
+    "view_my_results": view_my_results,
+    "check_new_tests": check_new_tests,
+    "view_class_ranking": view_class_ranking,
+    "main_menu": start,
+})
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    return await callback_router.dispatch(update, context)
 
-    if query.data == "create_test":
-        return await create_test(update, context)
-    elif query.data == "create_test_file":
-        return await create_test_file(update, context)
-    elif query.data == "view_tests":
-        return await view_tests(update, context)
-    elif query.data.startswith("view_file_"):
-        return await view_file_tests(update, context)
-    elif query.data == "view_results":
-        return await view_results(update, context)
-    elif query.data == "send_test":
-        return await send_test(update, context)
-    elif query.data == "register":
-        return await register_student(update, context)
-    elif query.data == "solve_test":
-        return await start_test(update, context)
-    elif query.data == "main_menu":
-        return await start(update, context)
-    elif query.data.startswith("delete_test_"):
-        return await delete_test(update, context)
-    elif query.data.startswith("delete_file_"):
-        return await delete_test_file(update, context)
-    elif query.data.startswith("select_file_"):
-        return await student_select_test_file(update, context)
-    elif query.data.startswith("start_test_"):
-        return await start_selected_test(update, context)
-    elif query.data == "view_available_tests":
-        return await view_available_tests(update, context)
-    elif query.data == "add_new_test":
-        return await add_new_test(update, context)
-    elif query.data == "view_my_results":
-        return await view_my_results(update, context)
-    elif query.data == "check_new_tests":
-        return await check_new_tests(update, context)
-    elif query.data == "view_class_ranking":
-        return await view_class_ranking(update, context)
-
-
-async def shutdown(application: Application):
-    """Cleanup function to be called before shutdown"""
-    await application.stop()
-    await application.shutdown()
 
-# Main function to run the bot
-def main():
-    if not TOKEN:
-        raise ValueError("No token provided. Set TELEGRAM_BOT_TOKEN in .env file.")
-    
-    # Create the Application
-    application = Application.builder().token(TOKEN).build()
+async def startup(application: Application):
+    """Drop expired button tokens and start delivering queued notifications, including any left over from the last run"""
+    await callback_tokens.prune()
+    await outbox_sender.start(application.bot)
+
+async def close_database(application: Application):
+    """Commit queued results and release the pooled database connections once the bot has stopped"""
+    await outbox_sender.stop()
+    await write_queue.close()
+    db.close()
+
+# Build the Application with all handlers
+def build_application():
+    # Create the Application; updates from different users run concurrently, each user's in order.
+    # The schema is migrated when initialize() first loads persisted conversations.
+    application = (apply_api_url(Application.builder().token(config.token)).concurrent_updates(build_update_processor())
+                   .persistence(build_persistence(prepare=ensure_schema))
+                   .post_init(startup).post_shutdown(close_database).build())
 
     # Add handlers
     conv_handler = ConversationHandler(
@@ -194,12 +173,13 @@ def main():
             ],
             CREATING_TEST: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_test_creation),
-                CallbackQueryHandler(process_correct_answer, pattern="^correct_"),
-                CallbackQueryHandler(add_question, pattern="^add_question"),
-                CallbackQueryHandler(finish_test, pattern="^finish_test"),
+                CallbackQueryHandler(callback_router.track("correct_*", process_correct_answer), pattern="^correct_"),
+                CallbackQueryHandler(callback_router.track("add_question", add_question), pattern="^add_question$"),
+                CallbackQueryHandler(callback_router.track("finish_test", finish_test), pattern="^finish_test$"),
             ],
             ANSWERING_QUESTION: [
-                CallbackQueryHandler(process_answer, pattern="^answer_"),
+                CallbackQueryHandler(callback_router.track("answer_*", requires_session(process_answer)), pattern="^answer_"),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, requires_session(process_answer_key)),
             ],
             ENTERING_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_name),
@@ -213,31 +193,24 @@ def main():
             CommandHandler("testlarni_korish", testlarni_korish),
             CallbackQueryHandler(button_callback)
         ],
-        per_message=False
+        per_message=False,
+        # State survives restarts through the SQLite persistence
+        name="main",
+        persistent=True
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(PollAnswerHandler(quiz_sender.answer))
+    application.add_handler(CommandHandler("stats", stats))
+    return application
+
+# Main function to run the bot
+def main():
+    application = build_application()
 
-    # Add these handlers outside of the ConversationHandler
-    application.add_handler(CallbackQueryHandler(delete_test, pattern="^delete_test_"))
-    application.add_handler(CallbackQueryHandler(delete_test_file, pattern="^delete_file_"))
-    application.add_handler(CallbackQueryHandler(select_test_file, pattern="^select_file_"))
-    application.add_handler(CallbackQueryHandler(process_send_test, pattern="^send_file_"))
-    application.add_handler(CallbackQueryHandler(confirm_send_test, pattern="^confirm_send_"))
-    application.add_handler(CallbackQueryHandler(cancel_send_test, pattern="^cancel_send$"))
-
-    # Set up proper signal handling
-    loop = asyncio.get_event_loop()
-    for sig in (signal.SIGINT, signal.SIGTERM):
-        try:
-            loop.add_signal_handler(sig, lambda s=sig: asyncio.create_task(shutdown(application)))
-        except NotImplementedError:
-            # Signal handlers are not supported on Windows
-            pass
-
-    # Run the bot
+    # Run the bot (polling, or a webhook with BOT_MODE=webhook); both stop gracefully on SIGINT/SIGTERM
     print("Bot started successfully!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run(application)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,194 @@
+# Versioned schema migrations for test_bot.db.
+#
+# The applied version is stored in PRAGMA user_version. Each migration is a
+# function that inspects the database and returns the SQL script to run (or
+# runs its statements itself); the migration and the version bump are applied
+# in one transaction, so a failed migration leaves the database at the
+# previous version.
+import logging
+import sqlite3
+
+from leaderboard import LEADERBOARD_SCHEMA
+from question_bank import BANK_SCHEMA, import_json_files
+from outbox import OUTBOX_SCHEMA
+from callback_tokens import CALLBACK_TOKENS_SCHEMA
+from persistence import PERSISTENCE_SCHEMA
+from quiz_polls import QUIZ_SCHEMA
+from results import ATTEMPT_ANSWERS_SCHEMA
+from database import db
+
+logger = logging.getLogger(__name__)
+
+STUDENTS_RESULTS_TABLE = '''
+CREATE TABLE IF NOT EXISTS students_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    student_id INTEGER,
+    test_id TEXT,
+    correct_answers INTEGER,
+    wrong_answers INTEGER,
+    total_questions INTEGER,
+    rank INTEGER,
+    FOREIGN KEY(student_id) REFERENCES students(id)
+);
+'''
+
+BASE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS students (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    first_name TEXT,
+    last_name TEXT,
+    telegram_id INTEGER UNIQUE,
+    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+''' + STUDENTS_RESULTS_TABLE + '''
+CREATE TABLE IF NOT EXISTS available_tests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    student_id INTEGER,
+    test_file TEXT,
+    completed INTEGER DEFAULT 0,
+    FOREIGN KEY(student_id) REFERENCES students(id)
+);
+'''
+
+
+def _column_types(conn, table):
+    return {row[1]: row[2].upper() for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _base_schema(conn):
+    """Create the canonical tables and bring older layouts in line with them"""
+    script = BASE_SCHEMA
+
+    # main.py used to create available_tests without the completed flag
+    available_tests = _column_types(conn, 'available_tests')
+    if available_tests and 'completed' not in available_tests:
+        script += 'ALTER TABLE available_tests ADD COLUMN completed INTEGER DEFAULT 0;\n'
+
+    # main.py used to declare students_results.test_id as INTEGER, BotBitdi.py as TEXT
+    students_results = _column_types(conn, 'students_results')
+    if students_results and students_results.get('test_id') != 'TEXT':
+        script += STUDENTS_RESULTS_TABLE.replace('students_results', 'students_results_new') + '''
+        INSERT INTO students_results_new (id, student_id, test_id, correct_answers, wrong_answers, total_questions, rank)
+        SELECT id, student_id, CAST(test_id AS TEXT), correct_answers, wrong_answers, total_questions, rank
+        FROM students_results;
+        DROP TABLE students_results;
+        ALTER TABLE students_results_new RENAME TO students_results;
+        '''
+    return script
+
+
+def _hot_path_indexes(conn):
+    return '''
+    CREATE INDEX IF NOT EXISTS idx_students_results_test_score ON students_results (test_id, correct_answers);
+    CREATE INDEX IF NOT EXISTS idx_students_results_student ON students_results (student_id);
+    CREATE INDEX IF NOT EXISTS idx_available_tests_student_file ON available_tests (student_id, test_file);
+    '''
+
+
+def _class_leaderboard(conn):
+    return LEADERBOARD_SCHEMA
+
+
+def _unique_assignments(conn):
+    """Compact repeated assignments and key available_tests on (student_id, test_file)"""
+    # The newest row carries the current completed flag, so that is the one kept
+    return '''
+    DELETE FROM available_tests
+    WHERE id NOT IN (SELECT MAX(id) FROM available_tests GROUP BY student_id, test_file);
+    DROP INDEX IF EXISTS idx_available_tests_student_file;
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_available_tests_student_file ON available_tests (student_id, test_file);
+    '''
+
+
+def _question_bank(conn):
+    """Move test banks from tests/*.json into the bank tables"""
+    run_script(conn, BANK_SCHEMA)
+    imported = import_json_files(conn)
+    logger.info(f"Imported {len(imported)} test file(s) into the database")
+
+
+def _outbox(conn):
+    return OUTBOX_SCHEMA
+
+
+def _callback_tokens(conn):
+    return CALLBACK_TOKENS_SCHEMA
+
+
+def _persistence(conn):
+    return PERSISTENCE_SCHEMA
+
+
+def _quiz_polls(conn):
+    return QUIZ_SCHEMA
+
+
+def _attempt_answers(conn):
+    return ATTEMPT_ANSWERS_SCHEMA
+
+
+def _quiz_poll_letters(conn):
+    """Keep the answer letters of quiz poll options, so quiz answers can be stored as letters"""
+    # Databases created after QUIZ_SCHEMA gained the column already have it
+    if 'option_letters' not in _column_types(conn, 'quiz_polls'):
+        return 'ALTER TABLE quiz_polls ADD COLUMN option_letters TEXT;'
+    return None
+
+
+# Append only: the position in this list is the schema version
+MIGRATIONS = [
+    _base_schema,
+    _hot_path_indexes,
+    _class_leaderboard,
+    _unique_assignments,
+    _question_bank,
+    _outbox,
+    _callback_tokens,
+    _persistence,
+    _quiz_polls,
+    _attempt_answers,
+    _quiz_poll_letters,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def run_script(conn, script):
+    """Execute a multi-statement script inside the current transaction"""
+    # Unlike executescript, this does not commit whatever transaction is open
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ''
+    if statement.strip():
+        conn.execute(statement)
+
+
+def migrate(conn):
+    """Bring the database to SCHEMA_VERSION and switch it to WAL mode"""
+    # WAL lets readers proceed while a writer is committing; the setting is persistent
+    conn.execute('PRAGMA journal_mode = WAL')
+
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Applying database migration {number}: {migration.__name__}")
+        conn.execute('BEGIN')
+        try:
+            script = migration(conn)
+            if script:
+                run_script(conn, script)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+async def ensure_schema(database=db):
+    """Migrate ``database`` on a pooled connection, the first time this is called for it"""
+    if not database.schema_ready:
+        await database.run(migrate)
+        database.schema_ready = True
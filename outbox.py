@@ -0,0 +1,277 @@
+# Durable queue of outgoing notifications.
+#
+# Handlers insert rows into the outbox table (in the same transaction as the
+# change they announce) and return. OutboxSender delivers them in the
+# background through the shared Broadcaster, so throughput stays within
+# Telegram's limits. Failed sends are retried with exponential backoff, and
+# after OUTBOX_MAX_ATTEMPTS, or on an error retrying cannot fix, the row is
+# dead-lettered. Rows claimed by a sender that crashed are picked up again
+# on the next start, so a restart mid-broadcast resumes instead of losing
+# the remaining messages.
+import asyncio
+import json
+import logging
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+
+from broadcast import broadcaster
+from database import db
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_BACKOFF = 5          # seconds before the first retry, doubled every attempt
+OUTBOX_MAX_BACKOFF = 3600
+OUTBOX_CLAIM_SIZE = 100
+OUTBOX_POLL_INTERVAL = 5    # seconds between checks for retries that became due
+OUTBOX_KEEP_SENT_DAYS = 7
+PROGRESS_INTERVAL = 2.0     # seconds between progress reports of a batch
+
+OUTBOX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox_batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_chat_id INTEGER,
+    admin_message_id INTEGER,
+    description TEXT,
+    finished INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    reply_markup TEXT,
+    batch_id INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP,
+    FOREIGN KEY(batch_id) REFERENCES outbox_batches(id)
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_outbox_batch ON outbox (batch_id, status);
+'''
+
+
+def _markup_json(reply_markup):
+    return reply_markup.to_json() if reply_markup is not None else None
+
+
+def enqueue(conn, chat_id, text, reply_markup=None, batch_id=None):
+    """Queue one message. Returns the outbox row id."""
+    return conn.execute('''
+    INSERT INTO outbox (chat_id, text, reply_markup, batch_id) VALUES (?, ?, ?, ?)
+    ''', (chat_id, text, _markup_json(reply_markup), batch_id)).lastrowid
+
+
+def enqueue_students(conn, text, reply_markup=None, batch_id=None):
+    """Queue the same message for every registered student. Returns how many were queued."""
+    return conn.execute('''
+    INSERT INTO outbox (chat_id, text, reply_markup, batch_id)
+    SELECT telegram_id, ?, ?, ? FROM students WHERE telegram_id IS NOT NULL
+    ''', (text, _markup_json(reply_markup), batch_id)).rowcount
+
+
+def create_batch(conn, admin_chat_id, admin_message_id, description):
+    """Group messages whose delivery progress is shown on an admin's message"""
+    return conn.execute('''
+    INSERT INTO outbox_batches (admin_chat_id, admin_message_id, description) VALUES (?, ?, ?)
+    ''', (admin_chat_id, admin_message_id, description)).lastrowid
+
+
+def _recover(conn):
+    # Rows a crashed sender had claimed are sent again (at-least-once delivery)
+    recovered = conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'").rowcount
+    conn.execute('''
+    DELETE FROM outbox WHERE status = 'sent' AND sent_at < datetime('now', ?)
+    ''', (f'-{OUTBOX_KEEP_SENT_DAYS} days',))
+    conn.execute('''
+    DELETE FROM outbox_batches WHERE finished = 1 AND id NOT IN (SELECT batch_id FROM outbox WHERE batch_id IS NOT NULL)
+    ''')
+    return recovered
+
+
+def _claim(conn, now, limit):
+    return conn.execute('''
+    UPDATE outbox SET status = 'sending'
+    WHERE id IN (
+        SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY next_attempt_at, id LIMIT ?
+    )
+    RETURNING id, chat_id, text, reply_markup, batch_id, attempts
+    ''', (now, limit)).fetchall()
+
+
+def _record(conn, sent, retries, dead):
+    conn.executemany('''
+    UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = CURRENT_TIMESTAMP WHERE id = ?
+    ''', [(row_id,) for row_id in sent])
+    conn.executemany('''
+    UPDATE outbox SET status = 'pending', attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?
+    ''', retries)
+    conn.executemany('''
+    UPDATE outbox SET status = 'dead', attempts = attempts + 1, last_error = ? WHERE id = ?
+    ''', dead)
+
+
+def _batch_progress(conn, batch_ids):
+    placeholders = ','.join('?' * len(batch_ids))
+    return conn.execute(f'''
+    SELECT b.id, b.admin_chat_id, b.admin_message_id, b.description,
+           COUNT(o.id) AS total,
+           SUM(o.status = 'sent') AS sent,
+           SUM(o.status = 'dead') AS failed
+    FROM outbox_batches b
+    LEFT JOIN outbox o ON o.batch_id = b.id
+    WHERE b.id IN ({placeholders})
+    GROUP BY b.id
+    ''', tuple(batch_ids)).fetchall()
+
+
+def _finish_batch(conn, batch_id):
+    conn.execute('UPDATE outbox_batches SET finished = 1 WHERE id = ?', (batch_id,))
+
+
+def _unfinished_batches(conn):
+    return [row[0] for row in conn.execute('SELECT id FROM outbox_batches WHERE finished = 0')]
+
+
+def outbox_stats(conn):
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+    return {status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'dead')}
+
+
+def progress_text(description, done, total, failed):
+    return f"{description}\nXabar jo'natilmoqda: {done}/{total} (xatolar: {failed})"
+
+
+def finished_text(description, total, failed):
+    message = f"{description}\nXabarlar jo'natildi: {total - failed}/{total}."
+    if failed:
+        message += f"\nXabar yetkazilmadi: {failed} ta o'quvchi."
+    return message
+
+
+class OutboxSender:
+    """Background task delivering the outbox"""
+
+    def __init__(self, database=db, sender=broadcaster):
+        self.database = database
+        self.sender = sender
+        self._wakeup = None
+        self._task = None
+        self._reported = {}
+
+    def wake(self):
+        """Tell the sender new rows were committed"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self, bot):
+        recovered = await self.database.transaction(_recover)
+        if recovered:
+            logger.info(f"Resuming {recovered} notification(s) interrupted by a restart")
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        """Stop sending. Unsent messages, including ones cut off mid-send, stay queued for the next start"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while await self._deliver_due(bot):
+                    pass
+                await self._report_batches(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox sender error: {e}")
+
+    async def _deliver_due(self, bot):
+        """Send one claimed chunk of due messages. Returns False when nothing was due."""
+        rows = await self.database.transaction(_claim, time.time(), OUTBOX_CLAIM_SIZE)
+        if not rows:
+            return False
+
+        outcomes = await asyncio.gather(*(self._send(bot, row) for row in rows))
+        sent, retries, dead = [], [], []
+        now = time.time()
+        for row, error in zip(rows, outcomes):
+            if error is None:
+                sent.append(row['id'])
+            elif isinstance(error, (BadRequest, Forbidden)) or row['attempts'] + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Giving up on notification {row['id']} to chat {row['chat_id']}: {error}")
+                dead.append((str(error), row['id']))
+            else:
+                delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BACKOFF * 2 ** row['attempts'])
+                retries.append((now + delay, str(error), row['id']))
+        await self.database.transaction(_record, sent, retries, dead)
+        await self._report_batches(bot, throttle=True)
+        return True
+
+    async def _send(self, bot, row):
+        reply_markup = None
+        if row['reply_markup']:
+            reply_markup = InlineKeyboardMarkup.de_json(json.loads(row['reply_markup']), bot)
+        try:
+            if not await self.sender.send(bot, row['chat_id'], row['text'], reply_markup=reply_markup):
+                return RuntimeError("Flood limit retries exhausted")
+        except Exception as e:
+            return e
+        return None
+
+    async def _report_batches(self, bot, throttle=False):
+        """Edit each admin's progress message; finish batches with nothing left to send"""
+        loop = asyncio.get_running_loop()
+        batch_ids = await self.database.run(_unfinished_batches)
+        if not batch_ids:
+            return
+        for batch in await self.database.run(_batch_progress, batch_ids):
+            failed = batch['failed'] or 0
+            done = (batch['sent'] or 0) + failed
+            finished = done == batch['total']
+            last_time, last_done = self._reported.get(batch['id'], (None, None))
+            if not finished:
+                if done == last_done:
+                    continue
+                if throttle and last_time is not None and loop.time() - last_time < PROGRESS_INTERVAL:
+                    continue
+            self._reported[batch['id']] = (loop.time(), done)
+
+            if finished:
+                text = finished_text(batch['description'], batch['total'], failed)
+                reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]])
+            else:
+                text = progress_text(batch['description'], done, batch['total'], failed)
+                reply_markup = None
+            if batch['admin_chat_id'] is not None:
+                try:
+                    await bot.edit_message_text(text, chat_id=batch['admin_chat_id'],
+                                                message_id=batch['admin_message_id'], reply_markup=reply_markup)
+                except Exception as e:
+                    logger.warning(f"Could not update broadcast progress: {e}")
+            if finished:
+                await self.database.transaction(_finish_batch, batch['id'])
+                self._reported.pop(batch['id'], None)
+
+
+# Shared sender started with the bot
+outbox_sender = OutboxSender()
@@ -0,0 +1,279 @@
+# Conversation state and user_data kept in test_bot.db across restarts.
+#
+# Each user_data key is its own row, so saving a session writes only the keys
+# whose pickled value changed since the last save (usually the cursor and the
+# answers), never the whole session, and nothing at all for users whose data
+# did not change. Sessions are not loaded at startup: a user's rows are read
+# on their next update. Conversation states are one small row per active
+# conversation and are loaded when the bot starts, as ConversationHandler
+# needs them all up front.
+#
+# The persistence is the first thing to read the database when the bot
+# starts (Application.initialize loads conversations before post_init runs),
+# so it awaits ``prepare`` (migrations.ensure_schema) before its first read.
+#
+# A TestBank in user_data is stored as a reference (file name and version)
+# and resolved through bank_cache when the session is loaded, so a session
+# row stays a few hundred bytes however large the test file is. If that file
+# was deleted or edited since, the session's cursor and answers no longer fit
+# its questions: the whole session is dropped on load, and the answering
+# handlers (wrapped with requires_session) end the conversation and ask the
+# student to start the test again.
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+from database import db, write_queue
+from question_bank import TestBank, bank_cache
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_INTERVAL = 5  # seconds between saves of changed sessions
+
+_STALE = object()  # what a bank reference resolves to once its file was changed or deleted
+
+PERSISTENCE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS persisted_user_data (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS persisted_conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+'''
+
+
+class _BankRef:
+    """Placeholder for a stored TestBank until bank_cache hands out the real one"""
+
+    __slots__ = ('name', 'version')
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+
+
+class _Pickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        if isinstance(obj, TestBank):
+            return ('bank', obj.name, obj.version)
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        kind, name, version = pid
+        if kind != 'bank':
+            raise pickle.UnpicklingError(f"Unknown persistent id {kind!r}")
+        return _BankRef(name, version)
+
+
+def _dumps(value):
+    buffer = io.BytesIO()
+    _Pickler(buffer, pickle.HIGHEST_PROTOCOL).dump(value)
+    return buffer.getvalue()
+
+
+def _loads(data):
+    return _Unpickler(io.BytesIO(data)).load()
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _load_user(conn, user_id):
+    return conn.execute('SELECT key, value FROM persisted_user_data WHERE user_id = ?', (user_id,)).fetchall()
+
+
+def _save_user(conn, user_id, changed, removed):
+    conn.executemany('''
+    INSERT INTO persisted_user_data (user_id, key, value) VALUES (?, ?, ?)
+    ON CONFLICT(user_id, key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+    ''', [(user_id, key, value) for key, value in changed])
+    conn.executemany('DELETE FROM persisted_user_data WHERE user_id = ? AND key = ?',
+                     [(user_id, key) for key in removed])
+
+
+def _drop_user(conn, user_id):
+    conn.execute('DELETE FROM persisted_user_data WHERE user_id = ?', (user_id,))
+
+
+def _load_conversations(conn, name):
+    return conn.execute('SELECT key, state FROM persisted_conversations WHERE name = ?', (name,)).fetchall()
+
+
+def _save_conversation(conn, name, key, state):
+    if state is None:
+        conn.execute('DELETE FROM persisted_conversations WHERE name = ? AND key = ?', (name, key))
+    else:
+        conn.execute('''
+        INSERT INTO persisted_conversations (name, key, state) VALUES (?, ?, ?)
+        ON CONFLICT(name, key) DO UPDATE SET state = excluded.state
+        ''', (name, key, state))
+
+
+class SQLitePersistence(BasePersistence):
+    """PTB persistence storing user_data and conversations as rows, written through the write queue"""
+
+    def __init__(self, database=db, writer=write_queue, update_interval=PERSISTENCE_INTERVAL, prepare=None):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.database = database
+        self.writer = writer
+        self.prepare = prepare
+        self.loads = 0
+        self.expired = 0
+        self.writes = 0
+        self.rows_written = 0
+        self._loaded = set()
+        self._digests = {}  # user_id -> {key: digest of the stored value}
+
+    async def get_user_data(self):
+        # Loaded per user in refresh_user_data instead
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        """Fill a user's data from the database on their first update since startup"""
+        if user_id in self._loaded:
+            return
+        rows = await self.database.run(_load_user, user_id)
+        if user_id in self._loaded:
+            # Another handler loaded it while this one waited
+            return
+        self._loaded.add(user_id)
+        self.loads += 1
+        digests = self._digests[user_id] = {}
+        restored = {}
+        for key, value in rows:
+            try:
+                value, pickled = await self._resolve(_loads(value)), value
+            except Exception as e:
+                logger.warning(f"Dropping unreadable session key {key!r} of user {user_id}: {e}")
+                continue
+            if value is _STALE:
+                # The test was changed or deleted mid-exam: nothing of the session is restored
+                logger.info(f"Dropping the session of user {user_id}: its test file changed since it was saved")
+                self.expired += 1
+                await self.writer.submit(_drop_user, user_id)
+                return
+            restored[key] = value
+            digests[key] = _digest(pickled)
+        user_data.update(restored)
+
+    async def _resolve(self, value):
+        if not isinstance(value, _BankRef):
+            return value
+        bank = await bank_cache.get(value.name)
+        if bank is None or bank.version != value.version:
+            return _STALE
+        return bank
+
+    async def update_user_data(self, user_id, data):
+        """Save the keys whose value changed since the last save"""
+        digests = self._digests.setdefault(user_id, {})
+        changed = []
+        current = {}
+        for key, value in data.items():
+            if not isinstance(key, str):
+                continue
+            try:
+                pickled = _dumps(value)
+            except Exception as e:
+                logger.warning(f"Session key {key!r} of user {user_id} cannot be saved: {e}")
+                continue
+            current[key] = _digest(pickled)
+            if digests.get(key) != current[key]:
+                changed.append((key, pickled))
+        removed = [key for key in digests if key not in current]
+        if not changed and not removed:
+            return
+        await self.writer.submit(_save_user, user_id, changed, removed)
+        self._digests[user_id] = current
+        self.writes += 1
+        self.rows_written += len(changed) + len(removed)
+
+    async def drop_user_data(self, user_id):
+        await self.writer.submit(_drop_user, user_id)
+        self._digests.pop(user_id, None)
+
+    async def get_conversations(self, name):
+        if self.prepare is not None:
+            await self.prepare()
+        rows = await self.database.run(_load_conversations, name)
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        state = pickle.dumps(new_state) if new_state is not None else None
+        await self.writer.submit(_save_conversation, name, json.dumps(list(key)), state)
+
+    async def flush(self):
+        # Every save has been committed by the time update_* returned
+        pass
+
+    def stats(self):
+        return {'loaded_users': len(self._loaded), 'loads': self.loads, 'expired': self.expired,
+                'writes': self.writes, 'rows_written': self.rows_written}
+
+    # Only user_data and conversations are stored
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+def requires_session(handler):
+    """Wrap an answering-state handler so a session dropped on load ends the conversation instead of failing"""
+    async def wrapper(update, context):
+        if 'bank' in context.user_data:
+            return await handler(update, context)
+        text = "Test o'zgartirilgan yoki o'chirilgan, boshlangan test bekor qilindi. Iltimos, testni qaytadan boshlang."
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Bosh menyu", callback_data="main_menu")]])
+        if update.callback_query:
+            await update.callback_query.answer()
+            await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+        else:
+            await update.effective_message.reply_text(text, reply_markup=reply_markup)
+        return ConversationHandler.END
+    return wrapper
+
+
+def build_persistence(prepare=None):
+    """Persistence saving changed sessions every PERSISTENCE_INTERVAL seconds"""
+    return SQLitePersistence(update_interval=float(os.getenv('PERSISTENCE_INTERVAL', PERSISTENCE_INTERVAL)),
+                             prepare=prepare)
@@ -0,0 +1,96 @@
+# "Please wait" messages that only appear when the work is actually slow.
+#
+# Progress wraps a piece of work. If the work finishes within the threshold
+# nothing is shown and the handler goes straight to its result; otherwise the
+# progress text appears and later update() calls are coalesced to at most one
+# edit per min_interval. Set PROGRESS_INDICATOR=0 to never show progress.
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_THRESHOLD = 0.5     # seconds of work before progress is shown
+PROGRESS_MIN_INTERVAL = 1.0  # seconds between two progress edits
+
+
+def progress_enabled():
+    return os.getenv('PROGRESS_INDICATOR', '1') != '0'
+
+
+def _setting(name, default):
+    return float(os.getenv(name, default))
+
+
+class Progress:
+    """Async context manager around slow work.
+
+    ``show(text, **kwargs)`` puts the first progress text on screen and returns
+    the message (``query.edit_message_text`` or ``message.reply_text``); later
+    updates edit that message. ``finish`` replaces it with the result, or sends
+    the result through ``show`` if progress was never displayed.
+    """
+
+    def __init__(self, show, text, threshold=None, min_interval=None):
+        self._show = show
+        self._text = text
+        self.threshold = threshold if threshold is not None else _setting('PROGRESS_THRESHOLD', PROGRESS_THRESHOLD)
+        self.min_interval = (min_interval if min_interval is not None
+                             else _setting('PROGRESS_MIN_INTERVAL', PROGRESS_MIN_INTERVAL))
+        self.message = None
+        self._shown_text = None
+        self._changed = asyncio.Event()
+        self._worker = None
+        self._display = None
+
+    async def __aenter__(self):
+        if progress_enabled():
+            self._worker = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._stop()
+
+    def update(self, text):
+        """Change the progress text; shown on the next allowed edit"""
+        self._text = text
+        self._changed.set()
+
+    async def finish(self, text, **kwargs):
+        """Show the final result in place of the progress message"""
+        await self._stop()
+        if self.message is None:
+            return await self._show(text, **kwargs)
+        return await self.message.edit_text(text, **kwargs)
+
+    async def _run(self):
+        await asyncio.sleep(self.threshold)
+        while True:
+            self._changed.clear()
+            if self._text != self._shown_text:
+                # Shielded, so stopping never cuts off an edit that is already on its way
+                self._display = asyncio.ensure_future(self._put(self._text))
+                await asyncio.shield(self._display)
+                await asyncio.sleep(self.min_interval)
+            await self._changed.wait()
+
+    async def _put(self, text):
+        try:
+            if self.message is None:
+                self.message = await self._show(text)
+            else:
+                await self.message.edit_text(text)
+            self._shown_text = text
+        except Exception as e:
+            logger.warning(f"Could not show progress: {e}")
+
+    async def _stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._display is not None and not self._display.done():
+            await self._display
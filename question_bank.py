@@ -0,0 +1,372 @@
+# Test banks stored as rows: file -> test -> question -> options, plus the key.
+#
+# Every edit touches only the rows it changes, inside a transaction. Reads
+# build an immutable TestBank that is loaded once and shared by all sessions.
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+from collections import OrderedDict
+from typing import NamedTuple
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+TESTS_DIR = "tests"
+CACHE_SIZE = 32
+
+BANK_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS test_files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    version INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS bank_tests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_id INTEGER NOT NULL,
+    test_no INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY(file_id) REFERENCES test_files(id)
+);
+CREATE INDEX IF NOT EXISTS idx_bank_tests_file ON bank_tests (file_id, position);
+CREATE TABLE IF NOT EXISTS bank_questions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    test_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    question TEXT NOT NULL,
+    correct_answer TEXT,
+    FOREIGN KEY(test_id) REFERENCES bank_tests(id)
+);
+CREATE INDEX IF NOT EXISTS idx_bank_questions_test ON bank_questions (test_id, position);
+CREATE TABLE IF NOT EXISTS bank_options (
+    question_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    answer TEXT NOT NULL,
+    PRIMARY KEY (question_id, position),
+    FOREIGN KEY(question_id) REFERENCES bank_questions(id)
+) WITHOUT ROWID;
+'''
+
+
+def _file_id(conn, file_name):
+    row = conn.execute('SELECT id FROM test_files WHERE name = ?', (file_name,)).fetchone()
+    return row[0] if row else None
+
+
+def _bump_version(conn, file_id):
+    conn.execute('UPDATE test_files SET version = version + 1 WHERE id = ?', (file_id,))
+
+
+def list_files(conn):
+    return [row[0] for row in conn.execute('SELECT name FROM test_files ORDER BY name')]
+
+
+def create_file(conn, file_name):
+    """Create an empty test file. Returns False if the name is taken."""
+    cursor = conn.execute('INSERT OR IGNORE INTO test_files (name) VALUES (?)', (file_name,))
+    return cursor.rowcount == 1
+
+
+def delete_file(conn, file_name):
+    """Delete a test file with all its tests. Returns False if it did not exist."""
+    file_id = _file_id(conn, file_name)
+    if file_id is None:
+        return False
+    conn.execute('''
+    DELETE FROM bank_options WHERE question_id IN (
+        SELECT q.id FROM bank_questions q JOIN bank_tests t ON t.id = q.test_id WHERE t.file_id = ?
+    )''', (file_id,))
+    conn.execute('DELETE FROM bank_questions WHERE test_id IN (SELECT id FROM bank_tests WHERE file_id = ?)', (file_id,))
+    conn.execute('DELETE FROM bank_tests WHERE file_id = ?', (file_id,))
+    conn.execute('DELETE FROM test_files WHERE id = ?', (file_id,))
+    return True
+
+
+def _insert_question(conn, bank_test_id, question, answers, correct_answer):
+    position = conn.execute('SELECT COALESCE(MAX(position), 0) + 1 FROM bank_questions WHERE test_id = ?',
+                            (bank_test_id,)).fetchone()[0]
+    question_id = conn.execute('''
+    INSERT INTO bank_questions (test_id, position, question, correct_answer) VALUES (?, ?, ?, ?)
+    ''', (bank_test_id, position, question, correct_answer)).lastrowid
+    conn.executemany('INSERT INTO bank_options (question_id, position, answer) VALUES (?, ?, ?)',
+                     [(question_id, i, answer) for i, answer in enumerate(answers)])
+    return question_id
+
+
+def check_test(test):
+    """ValueError unless every question of a test has its options and its key"""
+    questions, answers, correct_answers = test['questions'], test['answers'], test['correct_answers']
+    if not len(questions) == len(answers) == len(correct_answers):
+        raise ValueError(f"Testda {len(questions)} ta savol, {len(answers)} ta variantlar to'plami va "
+                         f"{len(correct_answers)} ta to'g'ri javob bor, ular teng bo'lishi kerak.")
+
+
+def add_test(conn, file_name, test, test_no=None):
+    """Append a test ({'questions', 'answers', 'correct_answers'}) to a file, creating the file if needed.
+
+    Returns the new test number. Raises ValueError (see check_test) instead of storing a partial test.
+    """
+    check_test(test)
+    create_file(conn, file_name)
+    file_id = _file_id(conn, file_name)
+    next_no, position = conn.execute('''
+    SELECT COALESCE(MAX(test_no), 0) + 1, COALESCE(MAX(position), 0) + 1 FROM bank_tests WHERE file_id = ?
+    ''', (file_id,)).fetchone()
+    if test_no is None:
+        test_no = next_no
+    bank_test_id = conn.execute('INSERT INTO bank_tests (file_id, test_no, position) VALUES (?, ?, ?)',
+                                (file_id, test_no, position)).lastrowid
+    for question, answers, correct_answer in zip(test['questions'], test['answers'], test['correct_answers']):
+        _insert_question(conn, bank_test_id, question, answers, correct_answer)
+    _bump_version(conn, file_id)
+    return test_no
+
+
+def delete_test(conn, file_name, test_no):
+    """Delete the test(s) numbered test_no from a file"""
+    file_id = _file_id(conn, file_name)
+    if file_id is None:
+        return
+    conn.execute('''
+    DELETE FROM bank_options WHERE question_id IN (
+        SELECT q.id FROM bank_questions q JOIN bank_tests t ON t.id = q.test_id
+        WHERE t.file_id = ? AND t.test_no = ?
+    )''', (file_id, test_no))
+    conn.execute('''
+    DELETE FROM bank_questions WHERE test_id IN (SELECT id FROM bank_tests WHERE file_id = ? AND test_no = ?)
+    ''', (file_id, test_no))
+    conn.execute('DELETE FROM bank_tests WHERE file_id = ? AND test_no = ?', (file_id, test_no))
+    _bump_version(conn, file_id)
+
+
+def test_summaries(conn, file_name):
+    """(test number, question count) for each test of a file, without loading the questions"""
+    return conn.execute('''
+    SELECT t.test_no, COUNT(q.id)
+    FROM bank_tests t
+    JOIN test_files f ON f.id = t.file_id
+    LEFT JOIN bank_questions q ON q.test_id = t.id
+    WHERE f.name = ?
+    GROUP BY t.id
+    ORDER BY t.position
+    ''', (file_name,)).fetchall()
+
+
+class Question(NamedTuple):
+    text: str
+    options: tuple  # option labels as stored, e.g. "a) 4"
+    correct_answer: str
+
+    def choices(self):
+        """(letter, label) per option; "a) 4" and "a)4" both give ('a', '4')"""
+        choices = []
+        for option in self.options:
+            letter, _, label = option.partition(')')
+            choices.append((letter.strip(), label.strip() or option))
+        return choices
+
+
+class Test(NamedTuple):
+    id: int
+    questions: tuple
+
+
+class TestBank:
+    """One loaded test file, immutable and shared by every session taking it.
+
+    Sessions keep a reference to the bank plus their own cursor and answers,
+    never a copy of the questions. ``questions`` is every question of the
+    file in order and ``offsets[i]`` is the position of the first question of
+    test i in it, so numbering and grading are index lookups.
+    """
+
+    __slots__ = ('name', 'version', 'tests', 'questions', 'offsets', '__weakref__')
+
+    def __init__(self, name, version, tests):
+        tests = tuple(tests)
+        offsets = []
+        questions = []
+        for test in tests:
+            offsets.append(len(questions))
+            questions.extend(test.questions)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'tests', tests)
+        object.__setattr__(self, 'questions', tuple(questions))
+        object.__setattr__(self, 'offsets', tuple(offsets))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TestBank is read-only")
+
+    def __reduce__(self):
+        return TestBank, (self.name, self.version, self.tests)
+
+    # Immutable, so copies (PTB deep-copies user_data before saving it) share the bank
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __len__(self):
+        return len(self.tests)
+
+    def position(self, test_index, question_index):
+        """Index in ``questions`` of a question of one test"""
+        return self.offsets[test_index] + question_index
+
+    def __bool__(self):
+        return bool(self.tests)
+
+    def __repr__(self):
+        return f"TestBank({self.name!r}, version={self.version}, tests={len(self.tests)})"
+
+
+def fetch_bank(conn, file_name):
+    """Load a test file as a TestBank, or None if it does not exist"""
+    row = conn.execute('SELECT id, version FROM test_files WHERE name = ?', (file_name,)).fetchone()
+    if row is None:
+        return None
+    file_id, version = row[0], row[1]
+
+    options = {}
+    for question_id, answer in conn.execute('''
+    SELECT o.question_id, o.answer
+    FROM bank_options o
+    JOIN bank_questions q ON q.id = o.question_id
+    JOIN bank_tests t ON t.id = q.test_id
+    WHERE t.file_id = ?
+    ORDER BY o.question_id, o.position
+    ''', (file_id,)):
+        options.setdefault(question_id, []).append(answer)
+
+    tests = OrderedDict()
+    for bank_test_id, test_no, question_id, question, correct_answer in conn.execute('''
+    SELECT t.id, t.test_no, q.id, q.question, q.correct_answer
+    FROM bank_tests t
+    LEFT JOIN bank_questions q ON q.test_id = t.id
+    WHERE t.file_id = ?
+    ORDER BY t.position, q.position
+    ''', (file_id,)):
+        _, questions = tests.setdefault(bank_test_id, (test_no, []))
+        if question_id is not None:
+            questions.append(Question(question, tuple(options.get(question_id, ())), correct_answer))
+
+    return TestBank(file_name, version, (Test(test_no, tuple(questions)) for test_no, questions in tests.values()))
+
+
+def import_json_file(conn, file_path, file_name=None):
+    """Import one tests/<file>.json bank. Returns False if a file with that name already exists."""
+    file_name = file_name or os.path.basename(file_path)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    tests = json.loads(content) if content else []
+    if not create_file(conn, file_name):
+        return False
+    for test in tests:
+        add_test(conn, file_name, test, test_no=test.get('id'))
+    return True
+
+
+def import_json_files(conn, directory=TESTS_DIR):
+    """Import every JSON bank in ``directory`` that is not in the database yet"""
+    imported = []
+    if not os.path.isdir(directory):
+        return imported
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.json'):
+            continue
+        # One savepoint per file, so a broken file is skipped without leaving partial rows
+        conn.execute('SAVEPOINT import_file')
+        try:
+            if import_json_file(conn, os.path.join(directory, file_name)):
+                imported.append(file_name)
+        # ValueError covers bad JSON, non-UTF-8 bytes and check_test; OSError an unreadable file
+        except (OSError, ValueError, sqlite3.Error, KeyError, TypeError, AttributeError) as e:
+            conn.execute('ROLLBACK TO import_file')
+            logger.error(f"Skipping test file {file_name}, it could not be imported: {e}")
+        conn.execute('RELEASE import_file')
+    return imported
+
+
+class TestBankCache:
+    """Loaded test files shared by every handler.
+
+    Entries are keyed by file name and dropped by ``invalidate`` whenever the
+    bot edits a file. Concurrent misses for the same file share one load, and
+    at most ``max_size`` files are kept, least recently used first out.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._generation = 0
+
+    async def get(self, file_name):
+        """Return the TestBank of a file, or None if it does not exist"""
+        if file_name in self._entries:
+            self._entries.move_to_end(file_name)
+            self.hits += 1
+            return self._entries[file_name]
+
+        loading = self._loading.get(file_name)
+        if loading is not None:
+            self.hits += 1
+            return await asyncio.shield(loading)
+
+        self.misses += 1
+        generation = self._generation
+        loading = asyncio.ensure_future(db.run(fetch_bank, file_name))
+        self._loading[file_name] = loading
+        try:
+            tests = await asyncio.shield(loading)
+        finally:
+            if self._loading.get(file_name) is loading:
+                del self._loading[file_name]
+
+        # Don't store a load that raced with an edit
+        if tests is not None and generation == self._generation:
+            self._entries[file_name] = tests
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return tests
+
+    def invalidate(self, file_name=None):
+        """Drop one file (or everything) from the cache"""
+        self._generation += 1
+        if file_name is None:
+            self._entries.clear()
+            self._loading.clear()
+        else:
+            self._entries.pop(file_name, None)
+            self._loading.pop(file_name, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'files': len(self._entries)}
+
+
+# Shared cache used by all handlers
+bank_cache = TestBankCache()
+
+
+if __name__ == '__main__':
+    # python question_bank.py import [file.json ...]
+    # Imports JSON banks added to tests/ after the initial migration
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] != ['import']:
+        sys.exit("Usage: python question_bank.py import [file.json ...]")
+    conn = db.connect()
+    with conn:
+        if sys.argv[2:]:
+            imported = [path for path in sys.argv[2:] if import_json_file(conn, path)]
+        else:
+            imported = import_json_files(conn)
+    conn.close()
+    print(f"Imported {len(imported)} test file(s): {', '.join(imported) or '-'}")
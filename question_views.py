@@ -0,0 +1,32 @@
+# Question messages rendered once per TestBank and shared by every session.
+#
+# A bank is immutable and editing a file replaces it with a new version, so
+# renderings are keyed on the bank object itself: a new version starts with
+# an empty entry and the old one goes away with the last session using it.
+import weakref
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+_rendered = weakref.WeakKeyDictionary()
+
+
+def _render(question, number):
+    keyboard = []
+    for letter, label in question.choices():
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"answer_{letter}")])
+    return f"Savol {number}: {question.text}", InlineKeyboardMarkup(keyboard)
+
+
+def render_question(bank, position):
+    """Message text and reply markup for bank.questions[position]"""
+    rendered = _rendered.get(bank)
+    if rendered is None:
+        rendered = _rendered[bank] = [None] * len(bank.questions)
+    view = rendered[position]
+    if view is None:
+        view = rendered[position] = _render(bank.questions[position], position + 1)
+    return view
+
+
+def stats():
+    return {'banks': len(_rendered), 'questions': sum(len(v) - v.count(None) for v in _rendered.values())}
@@ -0,0 +1,221 @@
+# Tests delivered as native Telegram quiz polls.
+#
+# Instead of one edited message per question, a quiz sends every question as
+# its own non-anonymous quiz poll. The student answers them in any order and
+# Telegram shows right or wrong at once, so no answer waits for the bot. Each
+# PollAnswer update is recorded against its poll; the answer that completes
+# the attempt stores the result in students_results and its answers in
+# attempt_answers (see results.py), in the same write as the answer itself.
+# A poll answer is an option index, so each poll keeps its options' letters
+# to store answers the way the other ways of taking a test do. Polls go out
+# in the background through the shared Broadcaster, one poll per question,
+# within Telegram's flood limits.
+#
+# Attempts and polls are rows, so answers given after a restart still count.
+# Starting a quiz again replaces the student's unfinished attempt at that
+# file; answers to the replaced polls are ignored. If the polls cannot all be
+# delivered, the attempt is marked failed (it could never finish) and the
+# student is asked to start the quiz again.
+import logging
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Poll
+
+from broadcast import broadcaster
+from database import write_queue
+from results import save_answers, save_result
+
+logger = logging.getLogger(__name__)
+
+QUIZ_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS quiz_attempts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    student_id INTEGER NOT NULL,
+    test_file TEXT NOT NULL,
+    test_id TEXT NOT NULL,
+    total_questions INTEGER NOT NULL,
+    answered INTEGER NOT NULL DEFAULT 0,
+    correct INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'open',  -- open, finished, replaced or failed
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY(student_id) REFERENCES students(id)
+);
+CREATE INDEX IF NOT EXISTS idx_quiz_attempts_student ON quiz_attempts (student_id, test_file, status);
+CREATE TABLE IF NOT EXISTS quiz_polls (
+    poll_id TEXT PRIMARY KEY,
+    attempt_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    correct_option INTEGER NOT NULL,
+    chosen_option INTEGER,
+    option_letters TEXT,  -- answer letter of each option, comma separated
+    FOREIGN KEY(attempt_id) REFERENCES quiz_attempts(id)
+) WITHOUT ROWID;
+'''
+
+
+def _clip(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def quiz_questions(questions):
+    """(question, option labels, correct option index, option letters) per question; ValueError if one can't be a quiz"""
+    if not questions:
+        raise ValueError("Testda savollar yo'q.")
+    polls = []
+    for number, question in enumerate(questions, 1):
+        letters = []
+        labels = []
+        for letter, label in question.choices():
+            letters.append(letter)
+            labels.append(_clip(label, Poll.MAX_OPTION_LENGTH))
+        if not Poll.MIN_OPTION_NUMBER <= len(labels) <= Poll.MAX_OPTION_NUMBER:
+            raise ValueError(f"{number}-savolda {len(labels)} ta variant bor, viktorina uchun "
+                             f"{Poll.MIN_OPTION_NUMBER}-{Poll.MAX_OPTION_NUMBER} ta kerak.")
+        if question.correct_answer not in letters:
+            raise ValueError(f"{number}-savolning to'g'ri javobi variantlar orasida yo'q.")
+        polls.append((_clip(f"{number}. {question.text}", Poll.MAX_QUESTION_LENGTH), labels,
+                      letters.index(question.correct_answer), letters))
+    return polls
+
+
+def _open_attempt(conn, student_id, test_file, test_id, total_questions):
+    conn.execute('''
+    UPDATE quiz_attempts SET status = 'replaced' WHERE student_id = ? AND test_file = ? AND status = 'open'
+    ''', (student_id, test_file))
+    return conn.execute('''
+    INSERT INTO quiz_attempts (student_id, test_file, test_id, total_questions) VALUES (?, ?, ?, ?)
+    ''', (student_id, test_file, test_id, total_questions)).lastrowid
+
+
+def _add_poll(conn, poll_id, attempt_id, position, correct_option, letters):
+    conn.execute('''
+    INSERT INTO quiz_polls (poll_id, attempt_id, position, correct_option, option_letters) VALUES (?, ?, ?, ?, ?)
+    ''', (poll_id, attempt_id, position, correct_option, ','.join(letters)))
+
+
+def _letter(option_letters, option):
+    # Polls sent before their letters were kept store the option index instead
+    letters = option_letters.split(',') if option_letters else ()
+    return letters[option] if option < len(letters) else str(option)
+
+
+def _fail_attempt(conn, attempt_id):
+    conn.execute("UPDATE quiz_attempts SET status = 'failed' WHERE id = ? AND status = 'open'", (attempt_id,))
+
+
+def _record_answer(conn, poll_id, chosen_option):
+    """Record one answer. Returns (correct, total) when it completes the attempt, else None."""
+    poll = conn.execute('''
+    UPDATE quiz_polls SET chosen_option = ? WHERE poll_id = ? AND chosen_option IS NULL
+    RETURNING attempt_id, correct_option
+    ''', (chosen_option, poll_id)).fetchone()
+    if poll is None:
+        # Not one of ours, or answered already
+        return None
+    attempt = conn.execute('''
+    UPDATE quiz_attempts SET answered = answered + 1, correct = correct + ?
+    WHERE id = ? AND status = 'open'
+    RETURNING student_id, test_file, test_id, total_questions, answered, correct
+    ''', (chosen_option == poll['correct_option'], poll['attempt_id'])).fetchone()
+    if attempt is None or attempt['answered'] < attempt['total_questions']:
+        return None
+
+    conn.execute("UPDATE quiz_attempts SET status = 'finished' WHERE id = ?", (poll['attempt_id'],))
+    correct, total = attempt['correct'], attempt['total_questions']
+    result_id = save_result(conn, attempt['student_id'], attempt['test_id'], correct, total - correct, total)
+    polls = conn.execute('''
+    SELECT correct_option, chosen_option, option_letters FROM quiz_polls WHERE attempt_id = ? ORDER BY position
+    ''', (poll['attempt_id'],)).fetchall()
+    # Answered in any order with no question shown first, so there are no response times
+    save_answers(conn, result_id, attempt['student_id'], attempt['test_id'],
+                 [_letter(row['option_letters'], row['correct_option']) for row in polls],
+                 [_letter(row['option_letters'], row['chosen_option']) for row in polls])
+    conn.execute('UPDATE available_tests SET completed = 1 WHERE student_id = ? AND test_file = ?',
+                 (attempt['student_id'], attempt['test_file']))
+    return correct, total
+
+
+class QuizSender:
+    """Starts quiz attempts, sends their polls and grades the answers"""
+
+    def __init__(self, writer=write_queue, sender=broadcaster):
+        self.writer = writer
+        self.sender = sender
+        self.polls_sent = 0
+        self.answers = 0
+        self.finished = 0
+        self.failed = 0
+        self._sending = {}  # (student_id, test_file) -> task sending that attempt's polls
+
+    async def start(self, application, chat_id, student_id, test_file, test_id, polls):
+        """Open an attempt and send its polls in the background, replacing the student's unfinished one"""
+        key = (student_id, test_file)
+        previous = self._sending.pop(key, None)
+        if previous is not None:
+            # Its polls would only be ignored and would hold up the new ones in the per-chat limit
+            previous.cancel()
+        attempt_id = await self.writer.submit(_open_attempt, student_id, test_file, test_id, len(polls))
+        task = application.create_task(self._send(application.bot, chat_id, attempt_id, polls),
+                                       name=f"quiz_{attempt_id}")
+        self._sending[key] = task
+
+        def forget(_):
+            if self._sending.get(key) is task:
+                del self._sending[key]
+        task.add_done_callback(forget)
+        return attempt_id
+
+    async def _send(self, bot, chat_id, attempt_id, polls):
+        for position, (question, labels, correct_option, letters) in enumerate(polls):
+            try:
+                message = await self.sender.send_poll(bot, chat_id, question, labels, type=Poll.QUIZ,
+                                                      correct_option_ids=[correct_option], is_anonymous=False)
+            except Exception as e:
+                logger.error(f"Could not send quiz {attempt_id} to chat {chat_id}: {e}")
+                message = None
+            if message is None:
+                logger.error(f"Gave up sending quiz {attempt_id} to chat {chat_id} after {position} poll(s)")
+                await self._fail(bot, chat_id, attempt_id)
+                return
+            await self.writer.submit(_add_poll, message.poll.id, attempt_id, position, correct_option, letters)
+            self.polls_sent += 1
+
+    async def _fail(self, bot, chat_id, attempt_id):
+        # Answers to the polls already sent stop counting with the attempt
+        await self.writer.submit(_fail_attempt, attempt_id)
+        self.failed += 1
+        keyboard = [[InlineKeyboardButton("Bosh menyu", callback_data="main_menu")]]
+        try:
+            await self.sender.send(bot, chat_id, "Viktorinani to'liq yuborib bo'lmadi, u bekor qilindi. "
+                                   "Iltimos, viktorinani qaytadan boshlang.",
+                                   reply_markup=InlineKeyboardMarkup(keyboard))
+        except Exception as e:
+            logger.error(f"Could not tell chat {chat_id} that quiz {attempt_id} failed: {e}")
+
+    async def answer(self, update, context):
+        """PollAnswer handler: grade the answer and report the result after the last one"""
+        poll_answer = update.poll_answer
+        if not poll_answer.option_ids or poll_answer.user is None:
+            return
+        result = await self.writer.submit(_record_answer, poll_answer.poll_id, poll_answer.option_ids[0])
+        self.answers += 1
+        if result is None:
+            return
+
+        self.finished += 1
+        correct, total = result
+        message = "Viktorina yakunlandi!\n\n"
+        message += f"Jami savollar: {total}\n"
+        message += f"To'g'ri javoblar: {correct}\n"
+        message += f"Noto'g'ri javoblar: {total - correct}\n"
+        message += f"Foiz: {(correct / total) * 100:.2f}%"
+        keyboard = [[InlineKeyboardButton("Bosh menyu", callback_data="main_menu")]]
+        await self.sender.send(context.bot, poll_answer.user.id, message,
+                               reply_markup=InlineKeyboardMarkup(keyboard))
+
+    def stats(self):
+        return {'polls_sent': self.polls_sent, 'answers': self.answers, 'finished': self.finished,
+                'failed': self.failed}
+
+
+# Shared by both bots
+quiz_sender = QuizSender()
@@ -0,0 +1,76 @@
+# Ranks are derived on read instead of being rewritten for every row of a test
+# on each submission. Both expressions below use the
+# idx_students_results_test_score index on (test_id, correct_answers) created
+# in migrations.py, so a submission is a single INSERT and a rank lookup only
+# walks the better scores of one test.
+#
+# The answers behind a result are kept in attempt_answers, one compact row per
+# question keyed by the students_results row (the attempt). They are written
+# with the result, in one executemany inside the same write job, so per-question
+# and per-student analytics read stored answers instead of re-running exams.
+
+import time
+
+ATTEMPT_ANSWERS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS attempt_answers (
+    result_id INTEGER NOT NULL,
+    question_index INTEGER NOT NULL,
+    student_id INTEGER NOT NULL,
+    test_id TEXT NOT NULL,
+    chosen_option TEXT,
+    is_correct INTEGER NOT NULL,
+    response_ms INTEGER,
+    PRIMARY KEY (result_id, question_index),
+    FOREIGN KEY(result_id) REFERENCES students_results(id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_attempt_answers_question ON attempt_answers (test_id, question_index, chosen_option);
+CREATE INDEX IF NOT EXISTS idx_attempt_answers_student ON attempt_answers (student_id, test_id, question_index);
+'''
+
+# Rank of the row aliased ``sr`` within its test (ties share a rank)
+RANK_SQL = '''(
+    SELECT COUNT(*) + 1 FROM students_results better
+    WHERE better.test_id = sr.test_id AND better.correct_answers > sr.correct_answers
+)'''
+
+# Same ranking as RANK_SQL for queries that list many results at once
+RANK_WINDOW_SQL = 'RANK() OVER (PARTITION BY sr.test_id ORDER BY sr.correct_answers DESC)'
+
+
+def save_result(conn, student_id, test_id, correct_answers, wrong_answers, total_questions):
+    """Insert one test result and return its row id"""
+    cursor = conn.execute('''
+    INSERT INTO students_results (student_id, test_id, correct_answers, wrong_answers, total_questions)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (student_id, test_id, correct_answers, wrong_answers, total_questions))
+    return cursor.lastrowid
+
+
+def save_answers(conn, result_id, student_id, test_id, correct_answers, answers, response_times=()):
+    """Insert one row per question of the attempt ``result_id`` in a single executemany"""
+    # Answer i belongs to question i; unanswered questions and unknown response times are NULL
+    rows = []
+    for index, correct_answer in enumerate(correct_answers):
+        answer = answers[index] if index < len(answers) else None
+        response_ms = response_times[index] if index < len(response_times) else None
+        rows.append((result_id, index, student_id, test_id, answer, answer == correct_answer, response_ms))
+    conn.executemany('''
+    INSERT INTO attempt_answers (result_id, question_index, student_id, test_id, chosen_option, is_correct, response_ms)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+
+# Response times are measured in the session (user_data) between showing a
+# question and its answer. Wall-clock time, so a session restored after a
+# restart still measures correctly (the restart counts as thinking time).
+def mark_asked(user_data):
+    user_data['asked_at'] = time.time()
+
+
+def note_response_time(user_data):
+    """Record how long the answer just appended to user_data['answers'] took, in milliseconds"""
+    times = user_data.setdefault('response_times', [])
+    # Sessions started before response times were kept have none for the earlier answers
+    times.extend([None] * (len(user_data['answers']) - 1 - len(times)))
+    asked_at = user_data.pop('asked_at', None)
+    times.append(round((time.time() - asked_at) * 1000) if asked_at is not None else None)
@@ -1,45 +1,37 @@
-import json
-import sqlite3
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
-import asyncio
-import os
+from database import db, write_queue
+from question_bank import bank_cache
+from question_views import render_question
+from results import RANK_SQL, save_result, save_answers, mark_asked, note_response_time
+from leaderboard import top_by_tests_completed, tests_completed_rank
+from progress import Progress
+from callback_tokens import callback_tokens, show_expired
+from students import student_cache
+from answer_key import ANSWER_KEY_HINT, parse_answer_key
+from quiz_polls import quiz_questions, quiz_sender
 
 # Define conversation states
 ENTERING_NAME, ENTERING_SURNAME, SELECTING_ACTION, ANSWERING_QUESTION = range(4)
 
-def load_tests(file_name=None):
-    if file_name:
-        file_path = f"tests/{file_name}"
-        if not os.path.exists(file_path):
-            return []
-        try:
-            with open(file_path, 'r') as f:
-                content = f.read().strip()
-                if not content:
-                    return []
-                return json.loads(content)
-        except json.JSONDecodeError:
-            print(f"Error: {file_name} contains invalid JSON.")
-            return []
-        except Exception as e:
-            print(f"Error loading {file_name}: {str(e)}")
-            return []
-    else:
-        try:
-            with open('tests.json', 'r') as f:
-                content = f.read().strip()
-                if not content:
-                    return []
-                return json.loads(content)
-        except FileNotFoundError:
-            return []
-        except json.JSONDecodeError:
-            print("Error: tests.json contains invalid JSON.")
-            return []
-        except Exception as e:
-            print(f"Error loading tests.json: {str(e)}")
-            return []
+# Returns the shared, read-only TestBank of a file (None if missing or failing)
+async def load_bank(file_name):
+    try:
+        return await bank_cache.get(file_name)
+    except Exception as e:
+        print(f"Error loading {file_name}: {str(e)}")
+        return None
+
+# A session is a reference to the shared bank, a cursor and the answers given so far (with their response times)
+def start_session(context, bank):
+    context.user_data['bank'] = bank
+    context.user_data['current_question'] = 0
+    context.user_data['answers'] = []
+    context.user_data['response_times'] = []
+
+# Students take the first test of a file
+def current_test(context):
+    return context.user_data['bank'].tests[0]
 
 async def register_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -49,14 +41,10 @@ async def register_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         message = update.message
 
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM students WHERE telegram_id = ?', (user.id,))
-    existing_user = cursor.fetchone()
-    conn.close()
+    existing_user = await student_cache.get(user.id)
 
     if existing_user:
-        await message.reply_text(f"Siz allaqachon ro'yxatdan o'tgansiz, {existing_user[1]} {existing_user[2]}!")
+        await message.reply_text(f"Siz allaqachon ro'yxatdan o'tgansiz, {existing_user.first_name} {existing_user.last_name}!")
         return ConversationHandler.END
 
     await message.reply_text("Ro'yxatdan o'tish uchun ismingizni kiriting:")
@@ -75,35 +63,24 @@ async def process_surname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['last_name'] = update.message.text
     user = update.effective_user
     
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO students (first_name, last_name, telegram_id) VALUES (?, ?, ?)',
-                   (context.user_data['first_name'], context.user_data['last_name'], user.id))
-    conn.commit()
-    conn.close()
-
-    # Animate registration process
-    message = await update.message.reply_text("Ro'yxatdan o'tkazilmoqda...")
-    for i in range(5):
-        await message.edit_text(f"Ro'yxatdan o'tkazilmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
+    async with Progress(update.message.reply_text, "Ro'yxatdan o'tkazilmoqda...") as progress:
+        await db.execute('INSERT INTO students (first_name, last_name, telegram_id) VALUES (?, ?, ?)',
+                         (context.user_data['first_name'], context.user_data['last_name'], user.id))
+        student_cache.invalidate(user.id)
 
     keyboard = [
         [InlineKeyboardButton("Bosh menyu", callback_data="main_menu")],
         [InlineKeyboardButton("Mavjud testlarni ko'rish", callback_data="view_available_tests")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text(f"Rahmat, {context.user_data['first_name']}! Siz muvaffaqiyatli ro'yxatdan o'tdingiz.", reply_markup=reply_markup)
+    await progress.finish(f"Rahmat, {context.user_data['first_name']}! Siz muvaffaqiyatli ro'yxatdan o'tdingiz.", reply_markup=reply_markup)
 
     context.user_data.clear()
     return ConversationHandler.END
 
 async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM students WHERE telegram_id = ?', (user.id,))
-    student = cursor.fetchone()
+    student = await student_cache.get(user.id)
 
     if not student:
         keyboard = [[InlineKeyboardButton("Ro'yxatdan o'tish", callback_data="register")]]
@@ -112,19 +89,16 @@ async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.callback_query.edit_message_text("Iltimos, avval ro'yxatdan o'ting.", reply_markup=reply_markup)
         else:
             await update.message.reply_text("Iltimos, avval ro'yxatdan o'ting.", reply_markup=reply_markup)
-        conn.close()
         return ConversationHandler.END
 
     # Check if there's an available test for this student that hasn't been taken yet
-    cursor.execute('''
+    available_test = await db.fetchone('''
     SELECT at.test_file
     FROM available_tests at
     LEFT JOIN students_results sr ON at.id = sr.test_id AND sr.student_id = ?
     WHERE at.student_id = ? AND sr.id IS NULL
     LIMIT 1
-    ''', (student[0], student[0]))
-    available_test = cursor.fetchone()
-    conn.close()
+    ''', (student.id, student.id))
 
     if not available_test:
         keyboard = [
@@ -140,9 +114,9 @@ async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     test_file = available_test[0]
-    tests = load_tests(test_file)
+    bank = await load_bank(test_file)
 
-    if not tests:
+    if not bank:
         keyboard = [
             [InlineKeyboardButton("Bosh menyu", callback_data="main_menu")],
             [InlineKeyboardButton("Yangi testlar bormi?", callback_data="check_new_tests")]
@@ -156,19 +130,13 @@ async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Start the first test in the file
-    test = tests[0]
-    context.user_data['current_test'] = test
-    context.user_data['current_question'] = 0
-    context.user_data['answers'] = []
+    start_session(context, bank)
     context.user_data['test_file'] = test_file
-    await send_question(update, context)
+    return await send_question(update, context, ANSWER_KEY_HINT)
 
 async def view_available_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM students WHERE telegram_id = ?', (user.id,))
-    student = cursor.fetchone()
+    student = await student_cache.get(user.id)
 
     if not student:
         keyboard = [[InlineKeyboardButton("Ro'yxatdan o'tish", callback_data="register")]]
@@ -176,9 +144,7 @@ async def view_available_tests(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.callback_query.edit_message_text("Iltimos, avval ro'yxatdan o'ting.", reply_markup=reply_markup)
         return ConversationHandler.END
 
-    cursor.execute('SELECT test_file FROM available_tests WHERE student_id = ?', (student[0],))
-    available_tests = cursor.fetchall()
-    conn.close()
+    available_tests = await db.fetchall('SELECT test_file FROM available_tests WHERE student_id = ?', (student.id,))
 
     if not available_tests:
         keyboard = [[InlineKeyboardButton("Bosh menyu", callback_data="main_menu")]]
@@ -186,39 +152,33 @@ async def view_available_tests(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.callback_query.edit_message_text("Hozircha sizga tayinlangan testlar yo'q.", reply_markup=reply_markup)
         return ConversationHandler.END
 
-    keyboard = [[InlineKeyboardButton(test[0], callback_data=f"start_test_{test[0]}")] for test in available_tests]
+    tokens = await callback_tokens.encode_many([(test[0],) for test in available_tests])
+    keyboard = [[InlineKeyboardButton(test[0], callback_data=f"start_test_{token}"),
+                 InlineKeyboardButton("Viktorina", callback_data=f"quiz_test_{token}")]
+                for test, token in zip(available_tests, tokens)]
     keyboard.append([InlineKeyboardButton("Bosh menyu", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Animate the process of loading available tests
-    message = await update.callback_query.edit_message_text("Mavjud testlar yuklanmoqda...")
-    for i in range(3):
-        await message.edit_text(f"Mavjud testlar yuklanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
-    
-    await message.edit_text("Quyidagi testlardan birini tanlang:", reply_markup=reply_markup)
+    await update.callback_query.edit_message_text("Quyidagi testlardan birini tanlang:", reply_markup=reply_markup)
     return SELECTING_ACTION
 
-async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_test = context.user_data['current_test']
+# ``feedback`` (the verdict on the previous answer, or a hint) is shown above the question in the same edit
+async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE, feedback=None):
+    test = current_test(context)
     current_question = context.user_data['current_question']
 
-    if current_question >= len(current_test['questions']):
-        return await finish_test(update, context)
-
-    question = current_test['questions'][current_question]
-    answers = current_test['answers'][current_question]
+    if current_question >= len(test.questions):
+        return await finish_test(update, context, feedback)
 
-    keyboard = [
-        [InlineKeyboardButton(answer.split(') ')[1], callback_data=f"answer_{answer.split(') ')[0]}")]
-        for answer in answers
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Pre-rendered once per bank version and shared by all students
+    text, reply_markup = render_question(context.user_data['bank'], current_question)
+    if feedback:
+        text = f"{feedback}\n\n{text}"
 
     if update.callback_query:
-        await update.callback_query.edit_message_text(f"Savol {current_question + 1}: {question}", reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
     else:
-        await update.message.reply_text(f"Savol {current_question + 1}: {question}", reply_markup=reply_markup)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    mark_asked(context.user_data)
 
     return ANSWERING_QUESTION
 
@@ -228,57 +188,63 @@ async def process_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_answer = query.data.split('_')[1]
     context.user_data['answers'].append(user_answer)
+    note_response_time(context.user_data)
 
-    current_test = context.user_data['current_test']
     current_question = context.user_data['current_question']
-    correct_answer = current_test['correct_answers'][current_question]
+    correct_answer = current_test(context).questions[current_question].correct_answer
 
     if user_answer == correct_answer:
-        await query.edit_message_text("To'g'ri javob! 👍")
+        feedback = "To'g'ri javob! 👍"
     else:
-        await query.edit_message_text(f"Noto'g'ri javob. To'g'ri javob: {correct_answer}")
-
-    await asyncio.sleep(1)  # Give the user a moment to see the result
+        feedback = f"Noto'g'ri javob. To'g'ri javob: {correct_answer}"
 
+    # One edit shows the verdict together with the next question (or the final result)
     context.user_data['current_question'] += 1
-    return await send_question(update, context)
+    return await send_question(update, context, feedback)
+
+# The whole test answered in one message (see answer_key.py), graded and stored at once
+async def process_answer_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    questions = current_test(context).questions
+    try:
+        answers = parse_answer_key(update.message.text, questions)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{ANSWER_KEY_HINT}")
+        return ANSWERING_QUESTION
+
+    # One message for the whole test: there are no per-question response times
+    context.user_data['answers'] = answers
+    context.user_data['response_times'] = []
+    wrong = [f"{number} ({question.correct_answer})"
+             for number, (answer, question) in enumerate(zip(answers, questions), 1)
+             if answer != question.correct_answer]
+    if wrong:
+        feedback = f"Xato javoblar (qavsda to'g'ri javob): {', '.join(wrong)}"
+    else:
+        feedback = "Barcha javoblar to'g'ri! 👍"
+    return await finish_test(update, context, feedback)
 
-async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_test = context.user_data['current_test']
+async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE, feedback=None):
+    test = current_test(context)
     user_answers = context.user_data['answers']
-    correct_answers = current_test['correct_answers']
+    correct_answers = [question.correct_answer for question in test.questions]
 
     total_questions = len(correct_answers)
     correct_count = sum([1 for user, correct in zip(user_answers, correct_answers) if user == correct])
     wrong_count = total_questions - correct_count
 
-    user = update.effective_user
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM students WHERE telegram_id = ?', (user.id,))
-    student_id = cursor.fetchone()[0]
-
-    cursor.execute('''
-    INSERT INTO students_results (student_id, test_id, correct_answers, wrong_answers, total_questions)
-    VALUES (?, ?, ?, ?, ?)
-    ''', (student_id, current_test['id'], correct_count, wrong_count, total_questions))
-    conn.commit()
-
-    # Calculate and update rank
-    cursor.execute('''
-    SELECT id, correct_answers FROM students_results
-    WHERE test_id = ?
-    ORDER BY correct_answers DESC
-    ''', (current_test['id'],))
-    results = cursor.fetchall()
-
-    for rank, (result_id, _) in enumerate(results, start=1):
-        cursor.execute('UPDATE students_results SET rank = ? WHERE id = ?', (rank, result_id))
-
-    conn.commit()
-    conn.close()
-
-    message = f"Test yakunlandi!\n\n"
+    response_times = context.user_data.get('response_times', [])
+    student = await student_cache.get(update.effective_user.id)
+
+    def store_result(conn):
+        # Ranks are computed on read (see results.RANK_SQL), so this is a single insert
+        result_id = save_result(conn, student.id, test.id, correct_count, wrong_count, total_questions)
+        save_answers(conn, result_id, student.id, test.id, correct_answers, user_answers, response_times)
+
+    # Batched with other submissions into one transaction; returns once committed
+    await write_queue.submit(store_result)
+
+    message = f"{feedback}\n\n" if feedback else ""
+    message += f"Test yakunlandi!\n\n"
     message += f"Jami savollar: {total_questions}\n"
     message += f"To'g'ri javoblar: {correct_count}\n"
     message += f"Noto'g'ri javoblar: {wrong_count}\n"
@@ -304,10 +270,14 @@ async def select_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    tests = load_tests(file_name)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+    bank = await load_bank(file_name)
 
-    if not tests:
+    if not bank:
         keyboard = [
             [InlineKeyboardButton("Bosh menyu", callback_data="main_menu")],
             [InlineKeyboardButton("Boshqa testni tanlash", callback_data="view_available_tests")]
@@ -316,20 +286,22 @@ async def select_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(f"Kechirasiz, '{file_name}' fayli bo'sh yoki mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    context.user_data['current_test'] = tests[0]
-    context.user_data['current_question'] = 0
-    context.user_data['answers'] = []
+    start_session(context, bank)
 
-    return await send_question(update, context)
+    return await send_question(update, context, ANSWER_KEY_HINT)
 
 async def start_selected_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    tests = load_tests(file_name)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+    bank = await load_bank(file_name)
 
-    if not tests:
+    if not bank:
         keyboard = [
             [InlineKeyboardButton("Bosh menyu", callback_data="main_menu")],
             [InlineKeyboardButton("Boshqa testni tanlash", callback_data="view_available_tests")]
@@ -338,26 +310,56 @@ async def start_selected_test(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.edit_message_text(f"Kechirasiz, '{file_name}' fayli bo'sh yoki mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    context.user_data['current_test'] = tests[0]
-    context.user_data['current_question'] = 0
-    context.user_data['answers'] = []
+    start_session(context, bank)
 
-    return await send_question(update, context)
+    return await send_question(update, context, ANSWER_KEY_HINT)
+
+# The first test of a file sent as quiz polls (see quiz_polls.py); graded as the answers come in
+async def start_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+
+    student = await student_cache.get(update.effective_user.id)
+    if not student:
+        keyboard = [[InlineKeyboardButton("Ro'yxatdan o'tish", callback_data="register")]]
+        await query.edit_message_text("Iltimos, avval ro'yxatdan o'ting.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return ConversationHandler.END
+
+    keyboard = [[InlineKeyboardButton("Bosh menyu", callback_data="main_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    bank = await load_bank(file_name)
+    if not bank:
+        await query.edit_message_text(f"Kechirasiz, '{file_name}' fayli bo'sh yoki mavjud emas.", reply_markup=reply_markup)
+        return SELECTING_ACTION
+
+    test = bank.tests[0]
+    try:
+        polls = quiz_questions(test.questions)
+    except ValueError as e:
+        await query.edit_message_text(f"Bu testni viktorina sifatida yuborib bo'lmaydi. {e}", reply_markup=reply_markup)
+        return SELECTING_ACTION
+
+    await quiz_sender.start(context.application, update.effective_chat.id, student.id, file_name, test.id, polls)
+    await query.edit_message_text(
+        f"'{file_name}': {len(polls)} ta savol viktorina sifatida yuborilmoqda. "
+        "Javoblarni istalgan tartibda belgilang, natija oxirgi javobdan keyin chiqadi.",
+        reply_markup=reply_markup)
+    return SELECTING_ACTION
 
 async def view_my_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT sr.test_id, sr.correct_answers, sr.wrong_answers, sr.total_questions, sr.rank
+    results = await db.fetchall(f'''
+    SELECT sr.test_id, sr.correct_answers, sr.wrong_answers, sr.total_questions, {RANK_SQL} AS rank
     FROM students_results sr
     JOIN students s ON s.id = sr.student_id
     WHERE s.telegram_id = ?
     ORDER BY sr.id DESC
     LIMIT 5
     ''', (user.id,))
-    results = cursor.fetchall()
-    conn.close()
 
     if not results:
         message = "Siz hali hech qanday test yechmagansiz."
@@ -382,16 +384,12 @@ async def view_my_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def check_new_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+    new_tests = await db.fetchall('''
     SELECT at.test_file
     FROM available_tests at
     JOIN students s ON s.id = at.student_id
     WHERE s.telegram_id = ? AND at.id NOT IN (SELECT test_id FROM students_results WHERE student_id = s.id)
     ''', (user.id,))
-    new_tests = cursor.fetchall()
-    conn.close()
 
     if not new_tests:
         message = "Hozircha sizga yangi testlar yo'q."
@@ -416,39 +414,14 @@ async def check_new_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def view_class_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT s.first_name, s.last_name, COUNT(sr.id) as tests_completed
-    FROM students s
-    LEFT JOIN students_results sr ON s.id = sr.student_id
-    GROUP BY s.id
-    ORDER BY tests_completed DESC
-    LIMIT 10
-    ''')
-    rankings = cursor.fetchall()
-    
-    cursor.execute('''
-    SELECT COUNT(sr.id) as tests_completed
-    FROM students s
-    LEFT JOIN students_results sr ON s.id = sr.student_id
-    WHERE s.telegram_id = ?
-    ''', (user.id,))
-    user_tests_completed = cursor.fetchone()[0]
-    
-    cursor.execute('''
-    SELECT COUNT(*) + 1
-    FROM (
-        SELECT s.id, COUNT(sr.id) as tests_completed
-        FROM students s
-        LEFT JOIN students_results sr ON s.id = sr.student_id
-        GROUP BY s.id
-        HAVING tests_completed > ?
-    ) as rankings
-    ''', (user_tests_completed,))
-    user_rank = cursor.fetchone()[0]
-    
-    conn.close()
+
+    # Both lookups are served by the class_leaderboard index
+    def load_ranking(conn):
+        rankings = top_by_tests_completed(conn)
+        user_tests_completed, user_rank = tests_completed_rank(conn, user.id)
+        return rankings, user_tests_completed, user_rank
+
+    rankings, user_tests_completed, user_rank = await db.run(load_ranking)
 
     message = "Sinf reytingi (eng ko'p test yechganlar):\n\n"
     for i, (first_name, last_name, tests_completed) in enumerate(rankings, 1):
@@ -0,0 +1,82 @@
+# Student records looked up by Telegram id.
+#
+# Almost every handler starts by asking who the user is: the main menu
+# greets them by name, test handlers need their students.id. The answers are
+# kept in memory for STUDENT_CACHE_TTL seconds, including "not registered",
+# so moving around the menus does not query the database. Registration calls
+# invalidate() for the user; the TTL bounds how long a change made outside
+# this process (another bot instance, a manual edit of test_bot.db) can go
+# unseen.
+#
+# The table has no role column: admins are the ADMIN_TELEGRAM_ID users and
+# are recognised by is_admin without a lookup.
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from database import db
+
+STUDENT_CACHE_SIZE = 10000
+STUDENT_CACHE_TTL = 600  # seconds
+
+
+class Student(NamedTuple):
+    id: int
+    first_name: str
+    last_name: str
+    telegram_id: int
+
+
+def fetch_student(conn, telegram_id):
+    row = conn.execute('SELECT id, first_name, last_name, telegram_id FROM students WHERE telegram_id = ?',
+                       (telegram_id,)).fetchone()
+    return Student(*row) if row else None
+
+
+class StudentCache:
+    """Students by Telegram id, least recently used first out, each entry kept for ``ttl`` seconds"""
+
+    def __init__(self, database=db, max_size=STUDENT_CACHE_SIZE, ttl=STUDENT_CACHE_TTL):
+        self.database = database
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # telegram_id -> (Student or None, time it was read)
+        self._generation = 0
+
+    async def get(self, telegram_id):
+        """Return the Student with this Telegram id, or None if they have not registered"""
+        entry = self._entries.get(telegram_id)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        generation = self._generation
+        student = await self.database.run(fetch_student, telegram_id)
+        # Don't store a read that raced with a registration
+        if generation == self._generation:
+            self._entries[telegram_id] = (student, time.monotonic())
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return student
+
+    def invalidate(self, telegram_id=None):
+        """Forget one user (or everyone) after their record was added or changed"""
+        self._generation += 1
+        if telegram_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(telegram_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+# Shared by every handler that needs to know who the user is
+student_cache = StudentCache()
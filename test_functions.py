@@ -1,53 +1,18 @@
-import json
-import sqlite3
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CallbackQueryHandler, ConversationHandler
-import os
-import asyncio
+from database import db
+import question_bank
+from question_bank import bank_cache
+from results import RANK_WINDOW_SQL
+from assignments import assign_test as assign_test_to_student
+from outbox import enqueue as enqueue_notification, outbox_sender
+from progress import Progress
+from callback_tokens import callback_tokens, show_expired
+from config import is_admin
 
 # Define conversation states
 SELECTING_ACTION, CREATING_TEST_FILE, CREATING_TEST, ANSWERING_QUESTION = range(4)
 
-def ensure_tests_directory_exists():
-    if not os.path.exists("tests"):
-        os.makedirs("tests")
-
-# Load tests from JSON file
-def load_tests(file_name):
-    file_path = f"tests/{file_name}"
-    if not os.path.exists(file_path):
-        return []
-    try:
-        with open(file_path, 'r') as f:
-            content = f.read().strip()
-            if not content:
-                # If the file is empty, create a default structure
-                default_content = []
-                with open(file_path, 'w') as f:
-                    json.dump(default_content, f)
-                return default_content
-            return json.loads(content)
-    except json.JSONDecodeError:
-        print(f"Error: {file_name} contains invalid JSON. Creating a new empty file.")
-        default_content = []
-        with open(file_path, 'w') as f:
-            json.dump(default_content, f)
-        return default_content
-    except Exception as e:
-        print(f"Error loading {file_name}: {str(e)}")
-        return []
-
-# Save tests to JSON file
-def save_tests(tests, file_name):
-    file_path = f"tests/{file_name}"
-    with open(file_path, 'w') as f:
-        json.dump(tests, f)
-
-# Function to check if user is admin
-def is_admin(user_id):
-    from main import ADMIN_IDS
-    return user_id in ADMIN_IDS
-
 # Create a new test file
 async def create_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -55,7 +20,6 @@ async def create_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    ensure_tests_directory_exists()
     await update.callback_query.edit_message_text("Yangi test file yaratish uchun file nomini kiriting:")
     return CREATING_TEST_FILE
 
@@ -64,27 +28,19 @@ async def process_test_file_creation(update: Update, context: ContextTypes.DEFAU
     if not file_name.endswith('.json'):
         file_name += '.json'
 
-    file_path = f"tests/{file_name}"
-    if os.path.exists(file_path):
-        await update.message.reply_text(f"'{file_name}' nomli file allaqachon mavjud. Boshqa nom tanlang.")
+    async with Progress(update.message.reply_text, "File yaratilmoqda...") as progress:
+        created = await db.transaction(question_bank.create_file, file_name)
+    if not created:
+        await progress.finish(f"'{file_name}' nomli file allaqachon mavjud. Boshqa nom tanlang.")
         return CREATING_TEST_FILE
 
-    # Create an empty JSON file
-    with open(file_path, 'w') as f:
-        json.dump([], f)
-
-    # Animate file creation
-    message = await update.message.reply_text("File yaratilmoqda...")
-    for i in range(5):
-        await message.edit_text(f"File yaratilmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
-
+    context.user_data['current_test_file'] = file_name
     keyboard = [
-        [InlineKeyboardButton("Test yaratishni boshlash", callback_data=f"start_test_creation_{file_name}")],
+        [InlineKeyboardButton("Test yaratishni boshlash", callback_data="add_new_test")],
         [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text(f"'{file_name}' nomli yangi test file yaratildi.", reply_markup=reply_markup)
+    await progress.finish(f"'{file_name}' nomli yangi test file yaratildi.", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 # Create a new test
@@ -94,8 +50,7 @@ async def create_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    ensure_tests_directory_exists()
-    test_files = [f for f in os.listdir("tests") if f.endswith('.json')]
+    test_files = await db.run(question_bank.list_files)
     
     if not test_files:
         keyboard = [
@@ -106,34 +61,27 @@ async def create_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Hozircha test file'lari mavjud emas. Yangi file yaratishni xohlaysizmi?", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    keyboard = [[InlineKeyboardButton(file, callback_data=f"select_file_{file}")] for file in test_files]
+    tokens = await callback_tokens.encode_many([(file,) for file in test_files])
+    keyboard = [[InlineKeyboardButton(file, callback_data=f"select_file_{token}")] for file, token in zip(test_files, tokens)]
     keyboard.append([InlineKeyboardButton("Yangi test file yaratish", callback_data="create_test_file")])
     keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Animate the process of loading test files
-    message = await update.callback_query.edit_message_text("Test fayllari yuklanmoqda...")
-    for i in range(3):
-        await message.edit_text(f"Test fayllari yuklanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
-    
-    await message.edit_text("Qaysi file'ga test qo'shmoqchisiz?", reply_markup=reply_markup)
+    await update.callback_query.edit_message_text("Qaysi file'ga test qo'shmoqchisiz?", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 async def select_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
     context.user_data['current_test_file'] = file_name
 
-    # Animate file selection
-    message = await query.edit_message_text("File tanlanmoqda...")
-    for i in range(3):
-        await message.edit_text(f"File tanlanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
-
-    tests = load_tests(file_name)
+    async with Progress(query.edit_message_text, "File tanlanmoqda...") as progress:
+        tests = await db.run(question_bank.test_summaries, file_name)
     if not tests:
         keyboard = [
             [InlineKeyboardButton("Yangi test qo'shish", callback_data="add_new_test")],
@@ -141,10 +89,10 @@ async def select_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await message.edit_text(f"'{file_name}' file'ida hozircha testlar mavjud emas. Nima qilishni xohlaysiz?", reply_markup=reply_markup)
+        await progress.finish(f"'{file_name}' file'ida hozircha testlar mavjud emas. Nima qilishni xohlaysiz?", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    await message.edit_text("Yangi savolni kiriting:")
+    await progress.finish("Yangi savolni kiriting:")
     context.user_data['creating_test'] = True
     context.user_data['current_test'] = {"questions": [], "answers": [], "correct_answers": []}
     context.user_data['current_step'] = 'question'
@@ -193,18 +141,12 @@ async def process_correct_answer(update: Update, context: ContextTypes.DEFAULT_T
     current_test = context.user_data['current_test']
     current_test['correct_answers'].append(query.data.split('_')[1])
 
-    # Animate saving process
-    message = await query.edit_message_text("To'g'ri javob saqlanmoqda...")
-    for i in range(3):
-        await message.edit_text(f"To'g'ri javob saqlanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
-
     keyboard = [
         [InlineKeyboardButton("Ha", callback_data="add_question"),
          InlineKeyboardButton("Yo'q", callback_data="finish_test")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text("To'g'ri javob saqlandi. Yana savol qo'shmoqchimisiz?", reply_markup=reply_markup)
+    await query.edit_message_text("To'g'ri javob saqlandi. Yana savol qo'shmoqchimisiz?", reply_markup=reply_markup)
     return CREATING_TEST
 
 async def add_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -221,16 +163,15 @@ async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     current_test = context.user_data['current_test']
     file_name = context.user_data['current_test_file']
-    tests = load_tests(file_name)
-    current_test['id'] = len(tests) + 1
-    tests.append(current_test)
-    save_tests(tests, file_name)
-
-    # Animate test saving process
-    message = await query.edit_message_text("Test saqlanmoqda...")
-    for i in range(5):
-        await message.edit_text(f"Test saqlanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
+    try:
+        question_bank.check_test(current_test)
+    except ValueError as e:
+        # Usually the last question is not finished yet; its step still takes input
+        await query.message.reply_text(f"Testni saqlab bo'lmadi: {e} Oxirgi savolni to'liq kiriting.")
+        return CREATING_TEST
+    async with Progress(query.edit_message_text, "Test saqlanmoqda...") as progress:
+        current_test['id'] = await db.transaction(question_bank.add_test, file_name, current_test)
+    bank_cache.invalidate(file_name)
 
     context.user_data['creating_test'] = False
     context.user_data['current_test'] = None
@@ -242,7 +183,7 @@ async def finish_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text(f"Test muvaffaqiyatli yaratildi va '{file_name}' file'ga saqlandi!", reply_markup=reply_markup)
+    await progress.finish(f"Test muvaffaqiyatli yaratildi va '{file_name}' file'ga saqlandi!", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 async def send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -251,12 +192,13 @@ async def send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    test_files = [f for f in os.listdir("tests") if f.endswith('.json')]
+    test_files = await db.run(question_bank.list_files)
     if not test_files:
         await update.callback_query.edit_message_text("Hozircha test file'lari mavjud emas.")
         return ConversationHandler.END
 
-    keyboard = [[InlineKeyboardButton(file, callback_data=f"send_file_{file}")] for file in test_files]
+    tokens = await callback_tokens.encode_many([(file,) for file in test_files])
+    keyboard = [[InlineKeyboardButton(file, callback_data=f"send_file_{token}")] for file, token in zip(test_files, tokens)]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.callback_query.edit_message_text("Qaysi file'dagi testlarni jo'natmoqchisiz?", reply_markup=reply_markup)
     return SELECTING_ACTION
@@ -265,8 +207,12 @@ async def process_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    tests = load_tests(file_name)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+    tests = await db.run(question_bank.test_summaries, file_name)
 
     if not tests:
         await query.edit_message_text(f"'{file_name}' file'ida hozircha testlar mavjud emas.")
@@ -274,11 +220,7 @@ async def process_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     context.user_data['selected_test_file'] = file_name
 
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, first_name, last_name FROM students')
-    students = cursor.fetchall()
-    conn.close()
+    students = await db.fetchall('SELECT id, first_name, last_name FROM students')
 
     if not students:
         await query.edit_message_text("Hozircha ro'yxatdan o'tgan o'quvchilar yo'q.")
@@ -297,28 +239,22 @@ async def confirm_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     student_id = int(query.data.split('_')[-1])
     file_name = context.user_data['selected_test_file']
 
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO available_tests (student_id, test_file) VALUES (?, ?)', (student_id, file_name))
-    cursor.execute('SELECT telegram_id FROM students WHERE id = ?', (student_id,))
-    student_telegram_id = cursor.fetchone()[0]
-    conn.commit()
-    conn.close()
-
-    # Animate sending process
-    message = await query.edit_message_text("Test jo'natilmoqda...")
-    for i in range(5):
-        await message.edit_text(f"Test jo'natilmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
-
-    # Notify the student
     keyboard = [[InlineKeyboardButton("Testni boshlash", callback_data="start_test")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await context.bot.send_message(chat_id=student_telegram_id, text="Sizga yangi test tayinlandi!", reply_markup=reply_markup)
+
+    def assign_test(conn):
+        # The notification is queued in the same transaction and sent by the outbox sender
+        assign_test_to_student(conn, student_id, file_name)
+        student_telegram_id = conn.execute('SELECT telegram_id FROM students WHERE id = ?', (student_id,)).fetchone()[0]
+        enqueue_notification(conn, student_telegram_id, "Sizga yangi test tayinlandi!", reply_markup)
+
+    async with Progress(query.edit_message_text, "Test jo'natilmoqda...") as progress:
+        await db.transaction(assign_test)
+    outbox_sender.wake()
 
     keyboard = [[InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text(f"Test muvaffaqiyatli jo'natildi!", reply_markup=reply_markup)
+    await progress.finish(f"Test muvaffaqiyatli jo'natildi!", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 async def cancel_send_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -337,16 +273,13 @@ async def view_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    conn = sqlite3.connect('test_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT s.first_name, s.last_name, s.telegram_id, sr.correct_answers, sr.wrong_answers, sr.total_questions, sr.rank
+    results = await db.fetchall(f'''
+    SELECT s.first_name, s.last_name, s.telegram_id, sr.correct_answers, sr.wrong_answers, sr.total_questions,
+           {RANK_WINDOW_SQL} AS rank
     FROM students s
     JOIN students_results sr ON s.id = sr.student_id
-    ORDER BY sr.rank
+    ORDER BY rank
     ''')
-    results = cursor.fetchall()
-    conn.close()
 
     if not results:
         keyboard = [
@@ -385,7 +318,7 @@ async def view_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Kechirasiz, siz admin emassiz.")
         return ConversationHandler.END
 
-    test_files = [f for f in os.listdir("tests") if f.endswith('.json')]
+    test_files = await db.run(question_bank.list_files)
     if not test_files:
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
@@ -394,7 +327,8 @@ async def view_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text("Hozircha test file'lari mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    keyboard = [[InlineKeyboardButton(file, callback_data=f"view_file_{file}")] for file in test_files]
+    tokens = await callback_tokens.encode_many([(file,) for file in test_files])
+    keyboard = [[InlineKeyboardButton(file, callback_data=f"view_file_{token}")] for file, token in zip(test_files, tokens)]
     keyboard.append([InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.callback_query.edit_message_text("Qaysi file'dagi testlarni ko'rmoqchisiz?", reply_markup=reply_markup)
@@ -404,8 +338,12 @@ async def view_file_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    tests = load_tests(file_name)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+    tests = await db.run(question_bank.test_summaries, file_name)
 
     if not tests:
         keyboard = [
@@ -416,12 +354,13 @@ async def view_file_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(f"'{file_name}' file'ida hozircha testlar mavjud emas.", reply_markup=reply_markup)
         return SELECTING_ACTION
 
-    for test in tests:
+    tokens = await callback_tokens.encode_many([(file_name, test_no) for test_no, _ in tests])
+    for (test_no, question_count), token in zip(tests, tokens):
         keyboard = [
-            [InlineKeyboardButton("O'chirish", callback_data=f"delete_test_{file_name}_{test['id']}")]
+            [InlineKeyboardButton("O'chirish", callback_data=f"delete_test_{token}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(f"Test ID: {test['id']}\nSavollar soni: {len(test['questions'])}", reply_markup=reply_markup)
+        await query.message.reply_text(f"Test ID: {test_no}\nSavollar soni: {question_count}", reply_markup=reply_markup)
 
     keyboard = [
         [InlineKeyboardButton("Ortga", callback_data="view_tests")],
@@ -435,43 +374,41 @@ async def delete_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name, test_id = query.data.split('_')[-2:]
-    tests = load_tests(file_name)
-    tests = [test for test in tests if str(test['id']) != test_id]
-    save_tests(tests, file_name)
-
-    # Animate deletion process
-    message = await query.edit_message_text("Test o'chirilmoqda...")
-    for i in range(3):
-        await message.edit_text(f"Test o'chirilmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, test_id = args
+    async with Progress(query.edit_message_text, "Test o'chirilmoqda...") as progress:
+        await db.transaction(question_bank.delete_test, file_name, test_id)
+    bank_cache.invalidate(file_name)
 
     keyboard = [
         [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.edit_text(f"Test (ID: {test_id}) o'chirildi.", reply_markup=reply_markup)
+    await progress.finish(f"Test (ID: {test_id}) o'chirildi.", reply_markup=reply_markup)
     return SELECTING_ACTION
 
 async def delete_test_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    file_name = query.data.split('_')[-1]
-    file_path = f"tests/{file_name}"
-    
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        # Animate deletion process
-        message = await query.edit_message_text("Test file o'chirilmoqda...")
-        for i in range(3):
-            await message.edit_text(f"Test file o'chirilmoqda{'.' * (i + 1)}")
-            await asyncio.sleep(0.5)
+    args = await callback_tokens.decode(query.data)
+    if args is None:
+        await show_expired(query)
+        return SELECTING_ACTION
+    file_name, = args
+
+    async with Progress(query.edit_message_text, "Test file o'chirilmoqda...") as progress:
+        deleted = await db.transaction(question_bank.delete_file, file_name)
+    if deleted:
+        bank_cache.invalidate(file_name)
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await message.edit_text(f"'{file_name}' nomli test file o'chirildi.", reply_markup=reply_markup)
+        await progress.finish(f"'{file_name}' nomli test file o'chirildi.", reply_markup=reply_markup)
     else:
         keyboard = [
             [InlineKeyboardButton("Bosh menyuga qaytish", callback_data="main_menu")]
@@ -484,13 +421,7 @@ async def add_new_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    # Animate the process of preparing to add a new test
-    message = await query.edit_message_text("Yangi test qo'shishga tayyorlanmoqda...")
-    for i in range(3):
-        await message.edit_text(f"Yangi test qo'shishga tayyorlanmoqda{'.' * (i + 1)}")
-        await asyncio.sleep(0.5)
-
-    await message.edit_text("Yangi savolni kiriting:")
+    await query.edit_message_text("Yangi savolni kiriting:")
     context.user_data['creating_test'] = True
     context.user_data['current_test'] = {"questions": [], "answers": [], "correct_answers": []}
     context.user_data['current_step'] = 'question'
@@ -0,0 +1,93 @@
+# Handling updates from different users at the same time.
+#
+# By default PTB processes one update after another, so one student waiting
+# on a slow database write or API call holds up everybody else. This
+# processor runs updates concurrently but serializes them per user: a user's
+# updates are handled strictly one at a time in the order they arrived, so
+# ConversationHandler state and user_data never see two of that user's
+# updates interleaved, while different users proceed in parallel.
+#
+# CONCURRENT_UPDATES caps how many handlers run at once (1 restores the old
+# sequential behaviour). MAX_PENDING_UPDATES caps how many updates may be in
+# the processor at all, including those waiting for their user's turn.
+import asyncio
+import os
+
+from telegram.ext import BaseUpdateProcessor
+
+CONCURRENT_UPDATES = 8
+MAX_PENDING_UPDATES = 256
+
+
+def ordering_key(update):
+    """Updates with the same key are processed one at a time, in arrival order"""
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return ('user', user.id)
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return ('chat', chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs up to ``max_running`` updates concurrently, one at a time per user.
+
+    The per-user lock is taken before a running slot, so a user with a
+    backlog holds at most one slot and cannot starve the others.
+    """
+
+    def __init__(self, max_running=CONCURRENT_UPDATES, max_pending=MAX_PENDING_UPDATES):
+        if max_running < 1:
+            raise ValueError("max_running must be a positive integer")
+        # PTB's own semaphore bounds everything handed to the processor
+        super().__init__(max(max_pending, max_running))
+        self.max_running = max_running
+        self.peak_running = 0
+        self._running = 0
+        self._slots = None
+        self._locks = {}
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.max_running)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        key = ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        # [lock, number of this user's updates holding or waiting for it]
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            self._running += 1
+            self.peak_running = max(self.peak_running, self._running)
+            try:
+                await coroutine
+            finally:
+                self._running -= 1
+
+    def stats(self):
+        return {'running': self._running, 'users_waiting': len(self._locks), 'peak_running': self.peak_running,
+                'max_running': self.max_running}
+
+
+def build_update_processor():
+    """Processor configured from CONCURRENT_UPDATES and MAX_PENDING_UPDATES"""
+    return PerUserUpdateProcessor(int(os.getenv('CONCURRENT_UPDATES', CONCURRENT_UPDATES)),
+                                  int(os.getenv('MAX_PENDING_UPDATES', MAX_PENDING_UPDATES)))
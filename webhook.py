@@ -0,0 +1,267 @@
+# Serving the bot: long polling or a webhook behind a small built-in HTTP server.
+#
+# BOT_MODE=webhook makes Telegram push updates to WEBHOOK_URL instead of the
+# bot polling for them. Requests must carry WEBHOOK_SECRET in the
+# X-Telegram-Bot-Api-Secret-Token header. Accepted updates go into a bounded
+# queue, and are taken out only while fewer than the update processor's
+# max_concurrent_updates are in flight; once both are full the server
+# answers 503 and Telegram retries later. On SIGTERM/SIGINT the server stops
+# accepting, every update already queued or running is processed (or, after
+# the drain timeout, cancelled and reported), and only then is the
+# application shut down.
+#
+# TELEGRAM_API_URL points the bot at another Bot API server (a local fake for
+# testing, or a self-hosted telegram-bot-api).
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_MAX_BODY = 1024 * 1024
+WEBHOOK_DRAIN_TIMEOUT = 30
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+def apply_api_url(builder):
+    """Use TELEGRAM_API_URL (e.g. http://127.0.0.1:8081/bot) as the Bot API endpoint if set"""
+    api_url = os.getenv('TELEGRAM_API_URL')
+    if api_url:
+        builder.base_url(api_url)
+        builder.base_file_url(api_url.replace('/bot', '/file/bot', 1))
+    return builder
+
+
+class WebhookServer:
+    """Receives webhook POSTs and feeds them to the application through a bounded queue"""
+
+    def __init__(self, application, secret_token, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 queue_size=WEBHOOK_QUEUE_SIZE, max_body=WEBHOOK_MAX_BODY):
+        self.application = application
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_body = max_body
+        self.accepted = 0
+        self.rejected = 0
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._accepting = False
+        self._server = None
+        self._consumer = None
+        self._running = set()
+        self._connections = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._consumer = asyncio.create_task(self._consume())
+        self._accepting = True
+        logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+
+    async def drain(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Stop accepting updates and wait until the queued and running ones are processed.
+
+        Returns the number of updates given up on when ``timeout`` runs out.
+        """
+        self._accepting = False
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+
+        async def finish():
+            # With the queue full, the end marker waits for the consumer to make room
+            await self._queue.put(None)
+            # Shielded, so a timeout leaves the running updates for the count below
+            await asyncio.shield(self._consumer)
+
+        try:
+            await asyncio.wait_for(finish(), timeout)
+            return 0
+        except asyncio.TimeoutError:
+            pass
+
+        self._consumer.cancel()
+        queued = 0
+        while not self._queue.empty():
+            queued += self._queue.get_nowait() is not None
+        running = list(self._running)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(self._consumer, *running, return_exceptions=True)
+        logger.warning(f"Webhook drain timed out: cancelled {len(running)} running update(s), "
+                       f"dropped {queued} queued update(s)")
+        return len(running) + queued
+
+    def stats(self):
+        return {'accepted': self.accepted, 'rejected': self.rejected, 'queued': self._queue.qsize(),
+                'running': len(self._running)}
+
+    async def _consume(self):
+        # Same hand-off PTB's own update fetcher does, including the update processor. An
+        # update leaves the queue only when it can run, so a busy bot fills the queue (503s)
+        # instead of piling up tasks.
+        processor = self.application.update_processor
+        slots = asyncio.Semaphore(processor.max_concurrent_updates)
+        while True:
+            await slots.acquire()
+            update = await self._queue.get()
+            if update is None:
+                slots.release()
+                break
+            task = asyncio.create_task(self._process(processor, update))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            task.add_done_callback(lambda _: slots.release())
+        if self._running:
+            await asyncio.gather(*self._running)
+
+    async def _process(self, processor, update):
+        coroutine = self.application.process_update(update)
+        try:
+            await processor.process_update(update, coroutine)
+        except asyncio.CancelledError:
+            # Cancelled while waiting for the processor: the handler never started
+            coroutine.close()
+            raise
+        except Exception as e:
+            logger.error(f"Error processing update {update.update_id}: {e}")
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except ValueError as e:
+                    # Malformed request (a line longer than the stream limit also ends up here)
+                    status = e.args[0] if e.args and e.args[0] in REASONS else 400
+                    keep_alive = False
+                else:
+                    if request is None:
+                        break
+                    status, keep_alive = self._accept(*request)
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode())
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise ValueError(400)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise ValueError(400)
+        if length > self.max_body:
+            raise ValueError(413)
+        body = await reader.readexactly(length)
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        return method, target, headers, body, keep_alive
+
+    def _accept(self, method, target, headers, body, keep_alive):
+        """Validate one request and queue its update. Returns (status, keep_alive)."""
+        if target.split('?', 1)[0] != self.path:
+            return 404, keep_alive
+        if method != 'POST':
+            return 405, keep_alive
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), self.secret_token.encode()):
+            self.rejected += 1
+            return 403, keep_alive
+        if not self._accepting:
+            return 503, False
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, keep_alive
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 503, keep_alive
+        self.accepted += 1
+        return 200, keep_alive
+
+
+async def serve_webhook(application, url, secret_token, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                        queue_size=WEBHOOK_QUEUE_SIZE, stop_event=None):
+    """Run the application on a webhook until SIGINT/SIGTERM (or ``stop_event``), then drain and shut down"""
+    loop = asyncio.get_running_loop()
+    stop_event = stop_event or asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Signal handlers are not supported on Windows
+            pass
+
+    server = WebhookServer(application, secret_token, host, port, path, queue_size)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start()
+        await application.bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        await stop_event.wait()
+
+        logger.info("Stopping: draining queued updates")
+        await server.drain()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run(application):
+    """Start the bot in the mode chosen by BOT_MODE (polling by default)"""
+    if os.getenv('BOT_MODE', 'polling') != 'webhook':
+        # run_polling stops gracefully on SIGINT/SIGTERM by itself
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+
+    url = os.getenv('WEBHOOK_URL')
+    secret_token = os.getenv('WEBHOOK_SECRET')
+    if not url or not secret_token:
+        raise ValueError("BOT_MODE=webhook needs WEBHOOK_URL and WEBHOOK_SECRET in the .env file.")
+    asyncio.run(serve_webhook(
+        application, url, secret_token,
+        host=os.getenv('WEBHOOK_LISTEN', WEBHOOK_LISTEN),
+        port=int(os.getenv('WEBHOOK_PORT', WEBHOOK_PORT)),
+        path=os.getenv('WEBHOOK_PATH', WEBHOOK_PATH),
+        queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', WEBHOOK_QUEUE_SIZE)),
+    ))